@@ -13,11 +13,16 @@ from torchvision import transforms
 from torchvision.transforms import AutoAugmentPolicy
 
 from datas.DistillforLargeModel import mixup
-from datas.SDAGAN import SDAGenerator
-from helpers.correct_num import correct_num
-from helpers.log import Log
+from datas.Augmention import after_tran
+from datas.ConvertorSampler import ConvertorSubsetSampler, DisagreementScores
+from datas.IndexDataset import IndexDataset
+from datas.PackedDataset import dataset_mean_std
+from datas.SDAGAN import AugmentPrefetcher, SDAGenerator
+from helpers.correct_num import AccuracyMeter, correct_num
+from helpers.metrics import build_metrics
 from losses.DISTKD import DIST
 from utils.ema import ModelEMA
+from utils.teacher_cache import TeacherLogitCache
 
 
 class LearnDiversifyEnv(object):
@@ -59,11 +64,12 @@ class LearnDiversifyEnv(object):
         if "convnext" in self.yaml["tarch"] or "swin" in self.yaml["tarch"]:
             self.mixup = mixup()
         self.scaler = torch.cuda.amp.GradScaler()
+        time_path = time.strftime("%Y^%m^%d^%H^%M^%S", time.localtime()) + ".jsonl"
+        # TODO: metrics stay on device and are flushed to wandb/jsonl/console by a background thread
         if self.gpu == 0:
-            self.log = Log(log_each=yaml["log_each"])
-        time_path = time.strftime("%Y^%m^%d^%H^%M^%S", time.localtime()) + ".txt"
-        if self.gpu == 0:
-            self.ff = open(time_path, "w")
+            self.metrics = build_metrics(yaml, wandb, time_path)
+        else:
+            self.metrics = build_metrics({"metrics": {"sinks": ["none"]}, "log_each": yaml["log_each"]})
 
         # TODO: Learning to diversify
         print("pretrain finished successfully!")
@@ -75,6 +81,40 @@ class LearnDiversifyEnv(object):
         self.only_satge_one = self.yaml["only_stage_one"]
         self.convertor_training_epoch = self.yaml["SDA"]["convertor_training_epoch"]
         self.convertor_epoch_number = self.yaml["SDA"]["convertor_epoch_number"]
+        self.prefetch = "prefetch" in self.yaml["SDA"] and self.yaml["SDA"]["prefetch"] == True
+        # TODO: the convertor epochs iterate a coreset of the training set
+        self.convertor_sampler = None
+        self.disagreement = None
+        self.convertor_round = 0
+        if "convertor_subset" in self.yaml["SDA"]:
+            subset_yaml = self.yaml["SDA"]["convertor_subset"]
+            self.convertor_sampler = ConvertorSubsetSampler(
+                self.dataloader.dataset,
+                ratio=subset_yaml["ratio"],
+                mode=subset_yaml["mode"],
+                seed=subset_yaml["seed"] if "seed" in subset_yaml else 0,
+            )
+            self.convertor_dataloader = DataLoader(
+                self.dataloader.dataset,
+                batch_size=self.dataloader.batch_size,
+                sampler=self.convertor_sampler,
+                num_workers=self.dataloader.num_workers,
+                pin_memory=self.dataloader.pin_memory,
+            )
+            if subset_yaml["mode"] == "disagreement":
+                self.disagreement = DisagreementScores(
+                    len(self.dataloader.dataset), torch.device("cuda", gpu)
+                )
+        else:
+            self.convertor_dataloader = self.dataloader
+        # TODO: deferred accuracy reduction, one all_reduce per log interval or epoch
+        self.deferred_reduce = "deferred_reduce" in self.yaml and self.yaml["deferred_reduce"] == True
+        # TODO: packed datasets yield uint8 images, normalised on device by normalize_batch
+        mean, std = dataset_mean_std(self.yaml["SDA"]["dataset_type"])
+        self.mean = torch.Tensor(mean)[None, :, None, None].cuda(gpu)
+        self.std = torch.Tensor(std)[None, :, None, None].cuda(gpu)
+        self.train_meter = AccuracyMeter(torch.device("cuda", gpu), topk=(1, 5))
+        self.val_meter = AccuracyMeter(torch.device("cuda", gpu), topk=(1, 5))
 
         if "ema_update" in self.yaml and self.yaml["ema_update"] == True:
             self.ema_model = ModelEMA(self.student_model, decay=0.9999)
@@ -82,6 +122,25 @@ class LearnDiversifyEnv(object):
         else:
             self.ema_model = None
 
+        # TODO: offline teacher logits of the clean half
+        self.teacher_cache = None
+        if "teacher_cache" in self.yaml and self.yaml["teacher_cache"]["enable"] == True:
+            if hasattr(self, "mixup"):
+                print("mixup mixes the clean half, so the teacher logit cache is disabled")
+            else:
+                assert isinstance(self.dataloader.dataset, IndexDataset)
+                cache_yaml = self.yaml["teacher_cache"]
+                self.dataloader.dataset.aug_views = cache_yaml["views"]
+                self.dataloader.dataset.aug_seed = cache_yaml["seed"]
+                self.teacher_cache = TeacherLogitCache(
+                    path=cache_yaml["path"],
+                    dataset_len=len(self.dataloader.dataset),
+                    num_views=cache_yaml["views"],
+                    num_classes=self.num_classes,
+                    aug_seed=cache_yaml["seed"],
+                    tag=f"{self.yaml['data']}-{self.yaml['tarch']}-{self.yaml['tcheckpoint']}",
+                )
+
         if yaml["resume"] != "none":
             dict = torch.load(yaml["resume"])
             self.optimizer.load_state_dict(dict["optimizer"])
@@ -135,37 +194,79 @@ class LearnDiversifyEnv(object):
         )
         return original_hard_loss / 2 + augment_soft_loss / 2 + original_soft_loss / 2
 
-    def run_one_train_batch_size(self, batch_idx, indexs, input, target):
+    @torch.no_grad()
+    def run_teacher(self, input):
+        if "convnext" in self.yaml["tarch"] or "swin" in self.yaml["tarch"]:
+            (teacher_tuple, teacher_logits) = self.teacher_model.module(input)
+        else:
+            (teacher_tuple, teacher_logits) = self.teacher_model.module(input, is_feat=True)
+        return teacher_logits
+
+    @torch.no_grad()
+    def teacher_forward(self, inputs_max, input, indexs):
+        """
+        teacher logits of torch.cat([inputs_max, input]), the clean half is served from the
+        teacher logit cache if possible and only the missed clean images are forwarded.
+        """
+        if self.teacher_cache is None or not isinstance(indexs, torch.Tensor) or indexs.ndim != 2:
+            return self.run_teacher(torch.cat([inputs_max, input]))
+        hit, cached_logits = self.teacher_cache.lookup(indexs)
+        hit_index = torch.nonzero(hit).view(-1).cuda(self.gpu, non_blocking=True)
+        miss_index = torch.nonzero(~hit).view(-1).cuda(self.gpu, non_blocking=True)
+        logits = self.run_teacher(torch.cat([inputs_max, input[miss_index]]))
+        aug_logits, miss_logits = logits[: inputs_max.shape[0]], logits[inputs_max.shape[0]:]
+        clean_logits = logits.new_empty((input.shape[0], logits.shape[1]))
+        clean_logits[hit_index] = cached_logits.cuda(self.gpu, non_blocking=True).to(logits.dtype)
+        clean_logits[miss_index] = miss_logits
+        if miss_logits.shape[0] > 0:
+            self.teacher_cache.write(indexs[~hit], miss_logits)
+        return torch.cat([aug_logits, clean_logits])
+
+    def normalize_batch(self, input):
+        """
+        return the normalised float input and, for uint8 input, the uint8 batch itself
+        """
+        if input.dtype == torch.uint8:
+            return after_tran(input, self.mean, self.std), input
+        return input.float(), None
+
+    def prepare_batch(self, input, target):
         input = input.cuda(self.gpu, non_blocking=True)
         target = target.cuda(self.gpu, non_blocking=True)
+        input, input_uint8 = self.normalize_batch(input)
         target = target.view(-1)
         if ("convnext" in self.yaml["tarch"] or "swin" in self.yaml["tarch"]) and input.shape[
             0
         ] % 2 == 0:
             input, target = self.mixup(input, target)
-
+            input_uint8 = None
         else:
             target = F.one_hot(target, num_classes=self.num_classes).float()
+        return input, target, input_uint8
 
-        # TODO: Learning to diversify
-        with torch.no_grad(), torch.cuda.amp.autocast(enabled=True):
-            inputs_max, target_temp, ne_s_ce_loss, ne_t_ce_loss = self.convertor(
-                self.student_model, self.teacher_model, input, target, False
+    @torch.no_grad()
+    def augment_batch(self, input, target, input_uint8=None):
+        with torch.cuda.amp.autocast(enabled=True):
+            inputs_max, target_temp, _, _ = self.convertor(
+                self.student_model, self.teacher_model, input, target, False, x_uint8=input_uint8
             )
-        ne_ce_loss = ne_s_ce_loss + ne_t_ce_loss
+        return inputs_max, target_temp
+
+    def run_one_train_batch_size(
+            self, batch_idx, indexs, input, target, inputs_max=None, target_temp=None
+    ):
+        if inputs_max is None:
+            input, target, input_uint8 = self.prepare_batch(input, target)
+            # TODO: Learning to diversify
+            inputs_max, target_temp = self.augment_batch(input, target, input_uint8)
+        ne_ce_loss = self.convertor.loss_s + self.convertor.loss_t
         data_aug = torch.cat([inputs_max, input])
         labels = torch.cat([target_temp, target])
-        t_data_aug = data_aug
         b, c, h, w = data_aug.shape
         with torch.cuda.amp.autocast(enabled=True):
             (student_tuple, student_logits) = self.student_model(data_aug, is_feat=True)
             with torch.no_grad():
-                if "convnext" in self.yaml["tarch"] or "swin" in self.yaml["tarch"]:
-                    (teacher_tuple, teacher_logits) = self.teacher_model.module(t_data_aug)
-                else:
-                    (teacher_tuple, teacher_logits) = self.teacher_model.module(
-                        t_data_aug, is_feat=True
-                    )
+                teacher_logits = self.teacher_forward(inputs_max, input, indexs)
                 # TODO: compute relative loss
                 # print((teacher_logits.argmax(1)==labels.argmax(1)).sum().item()/student_logits.shape[0])
         # TODO: 1, vanilla KD Loss
@@ -186,11 +287,15 @@ class LearnDiversifyEnv(object):
         ) / 2
 
         aug_stduent_logits_confidence = (
-            student_logits[: b // 2].softmax(1)[target.bool()].mean().item()
+            student_logits[: b // 2].detach().softmax(1)[target.bool()].mean()
         )
         aug_teacher_logits_confidence = (
-            teacher_logits[: b // 2].softmax(1)[target.bool()].mean().item()
+            teacher_logits[: b // 2].softmax(1)[target.bool()].mean()
         )
+        if self.disagreement is not None:
+            self.disagreement.update(
+                indexs, student_logits[b // 2:].detach(), teacher_logits[b // 2:]
+            )
         # TODO: 2. Combine all Loss in stage one
         loss = self.weights[0] * vanilla_kd_loss
         if self.accumuate_count % self.yaml["accumulate_step"] == 0:
@@ -208,96 +313,85 @@ class LearnDiversifyEnv(object):
         if "ema_update" in self.yaml and self.yaml["ema_update"] == True:
             self.ema_model.update(self.student_model)
         # TODO: Compute top1 and top5
-        top1, top5 = correct_num(student_logits[: input.shape[0]], target, topk=(1, 5))
-        dist.all_reduce(top1, op=dist.ReduceOp.SUM)
-        dist.all_reduce(top5, op=dist.ReduceOp.SUM)
-        top1 /= torch.cuda.device_count()
-        top5 /= torch.cuda.device_count()
-        lr = self.get_lr()
+        top1, top5 = correct_num(student_logits[: input.shape[0]].detach(), target, topk=(1, 5))
+        if self.deferred_reduce:
+            # TODO: the logged top1 and top5 are local, the exact global ones come from train_meter
+            self.train_meter.update(student_logits[: input.shape[0]].detach(), target, loss)
+        else:
+            dist.all_reduce(top1, op=dist.ReduceOp.SUM)
+            dist.all_reduce(top5, op=dist.ReduceOp.SUM)
+            top1 /= torch.cuda.device_count()
+            top5 /= torch.cuda.device_count()
         # TODO: update CosineLRScheduler
         if isinstance(self.scheduler, timm.scheduler.scheduler.Scheduler):
             self.scheduler.step(self.accumuate_count)
-        if self.gpu == 0:
-            self.log(self.teacher_model, (loss + ne_ce_loss).cpu(), top1.cpu(), top5.cpu(), lr)
         return (
-            top1.cpu().item(),
-            vanilla_kd_loss.cpu().item(),
+            top1,
+            top5,
+            (loss + ne_ce_loss).detach(),
+            vanilla_kd_loss.detach(),
             aug_teacher_logits_confidence,
             aug_stduent_logits_confidence,
             ne_ce_loss,
         )
 
     def run_one_convertor_batch_size(self, batch_idx, indexs, input, target, if_afe):
-        input = input.float().cuda(self.gpu)
-        target = target.cuda(self.gpu)
-        target = target.view(-1)
-        if ("convnext" in self.yaml["tarch"] or "swin" in self.yaml["tarch"]) and input.shape[
-            0
-        ] % 2 == 0:
-            input, target = self.mixup(input, target)
-        else:
-            target = F.one_hot(target, num_classes=self.num_classes).float()
+        input, target, input_uint8 = self.prepare_batch(input, target)
 
         # TODO: Learning to diversify
         with torch.cuda.amp.autocast(enabled=True):
             inputs_max, target_temp, ne_ce_s_loss, ne_ce_t_loss = self.convertor(
-                self.student_model, self.teacher_model, input, target, True, if_afe
+                self.student_model, self.teacher_model, input, target, True, if_afe, input_uint8
             )
         return (ne_ce_s_loss + ne_ce_t_loss,)
 
     @torch.no_grad()
     def run_one_val_batch_size(self, input, target):
-        input = input.float().cuda()
+        input = self.normalize_batch(input.cuda())[0]
         target = target.cuda()
         target = target.view(-1)
         logits = self.student_model(input).float()
         _, t_logits = self.teacher_model(input)
         loss = self.loss(logits, t_logits, target)
         top1, top5 = correct_num(logits, target, topk=(1, 5))
-        top1 = dist.all_reduce(top1, op=dist.ReduceOp.SUM) / torch.cuda.device_count()
-        return top1.cpu().item(), loss.cpu().item()
+        dist.all_reduce(top1, op=dist.ReduceOp.SUM)
+        top1 /= torch.cuda.device_count()
+        return top1, loss
+
+    def sda_metrics(self):
+        return {
+            "p": self.convertor.SDA.module.probabilities.detach().sigmoid(),
+            "m": self.convertor.SDA.module.magnitudes.detach().sigmoid(),
+        }
 
     def run_one_convertor_epoch(self, if_afe):
         self.student_model.train()
         self.convertor.SDA.train()
         total_ne_ce_loss = 0
-        for batch_idx, (index, input, target) in enumerate(self.dataloader):
+        if self.convertor_sampler is not None:
+            self.convertor_sampler.set_epoch(self.convertor_round)
+            self.convertor_round += 1
+        for batch_idx, (index, input, target) in enumerate(self.convertor_dataloader):
             (ne_ce_loss,) = self.run_one_convertor_batch_size(
                 batch_idx, index, input, target, if_afe
             )
-            if self.gpu == 0:
-                self.wandb.log(
-                    {
-                        "ne_ce_loss": ne_ce_loss,
-                        "aug_s_con": self.convertor.aug_stduent_logits_confidence,
-                        "aug_t_con": self.convertor.aug_teacher_logits_confidence,
-                        **{
-                            f"p_{i}": p
-                            for i, p in enumerate(
-                                self.convertor.SDA.module.probabilities.data.clone()
-                                    .detach()
-                                    .sigmoid()
-                                    .tolist()
-                            )
-                        },
-                        **{
-                            f"m_{i}": m
-                            for i, m in enumerate(
-                                self.convertor.SDA.module.magnitudes.data.clone()
-                                    .detach()
-                                    .sigmoid()
-                                    .tolist()
-                            )
-                        },
-                    },
-                    step=self.accumuate_count,
-                )
+            self.metrics.log(
+                {
+                    "ne_ce_loss": ne_ce_loss,
+                    "aug_s_con": self.convertor.aug_stduent_logits_confidence,
+                    "aug_t_con": self.convertor.aug_teacher_logits_confidence,
+                    **self.sda_metrics(),
+                },
+                step=self.accumuate_count,
+            )
             total_ne_ce_loss = total_ne_ce_loss + ne_ce_loss
             self.accumuate_count += 1
-        total_ne_ce_loss = total_ne_ce_loss / len(self.dataloader)
+        total_ne_ce_loss = float(total_ne_ce_loss / len(self.convertor_dataloader))
         self.convertor.scheduler.step(total_ne_ce_loss)
+        self.metrics.log(
+            {"epoch": self.epoch, "convertor_ne_ce_loss": total_ne_ce_loss}, step=self.accumuate_count
+        )
         if self.gpu == 0:
-            self.ff.write(f"epoch:{self.epoch}, ne_ce_loss:{total_ne_ce_loss}\n")
             print(f"when train {'AFE' if if_afe else 'SDA'}, ne_ce_loss is: {total_ne_ce_loss}")
 
     def run_one_train_epoch(self):
@@ -305,70 +399,82 @@ class LearnDiversifyEnv(object):
         start_time = time.time()
         self.student_model.train()
         self.convertor.SDA.train()
-        if self.gpu == 0:
-            self.log.train(len_dataset=len(self.dataloader))
 
         # TODO: DIVERSIFY LEARNING
         if self.epoch in self.convertor_training_epoch:
             self.convertor.reset()
+            if self.disagreement is not None:
+                self.convertor_sampler.set_scores(self.disagreement.reduce())
             for i in range(int(self.convertor_epoch_number)):
                 self.run_one_convertor_epoch(False)
 
+        self.train_meter.reset()
+        total_top1 = 0.0
+        total_loss = 0.0
         total_aug_s_con = 0.0
         total_aug_t_con = 0.0
-        for batch_idx, (index, input, target) in enumerate(self.dataloader):
+        if self.prefetch:
+            # augment batch k+1 while the student trains on batch k
+            loader = AugmentPrefetcher(
+                self.dataloader, self.prepare_batch, self.augment_batch, self.gpu
+            )
+        else:
+            loader = self.dataloader
+        for batch_idx, (index, input, target, *augmented) in enumerate(loader):
             (
                 top1,
+                top5,
+                loss,
                 vanilla_kd_loss,
                 aug_t_con,
                 aug_s_con,
                 ne_ce_loss,
-            ) = self.run_one_train_batch_size(batch_idx, index, input, target)
-            if self.gpu == 0:
-                self.wandb.log(
-                    {
-                        "top1": top1,
-                        "vanilla_kd_loss": vanilla_kd_loss,
-                        "ne_ce_loss": ne_ce_loss,
-                        "aug_s_con": aug_s_con,
-                        "aug_t_con": aug_t_con,
-                        **{
-                            f"p_{i}": p
-                            for i, p in enumerate(
-                                self.convertor.SDA.module.probabilities.data.clone()
-                                    .detach()
-                                    .sigmoid()
-                                    .tolist()
-                            )
-                        },
-                        **{
-                            f"m_{i}": m
-                            for i, m in enumerate(
-                                self.convertor.SDA.module.magnitudes.data.clone()
-                                    .detach()
-                                    .sigmoid()
-                                    .tolist()
-                            )
-                        },
-                    },
+            ) = self.run_one_train_batch_size(batch_idx, index, input, target, *augmented)
+            self.metrics.log(
+                {
+                    "top1": top1,
+                    "top5": top5,
+                    "loss": loss,
+                    "vanilla_kd_loss": vanilla_kd_loss,
+                    "ne_ce_loss": ne_ce_loss,
+                    "aug_s_con": aug_s_con,
+                    "aug_t_con": aug_t_con,
+                    "lr": self.get_lr(),
+                    **self.sda_metrics(),
+                },
+                step=self.accumuate_count,
+            )
+            if self.deferred_reduce and (batch_idx + 1) % self.yaml["log_each"] == 0:
+                running_top1, running_top5, _ = self.train_meter.reduce()
+                self.metrics.log(
+                    {"running_top1": running_top1, "running_top5": running_top5},
                     step=self.accumuate_count,
                 )
-                total_aug_s_con += aug_s_con * input.shape[0]
-                total_aug_t_con += aug_t_con * input.shape[0]
+            total_top1 = total_top1 + top1
+            total_loss = total_loss + loss
+            total_aug_s_con = total_aug_s_con + aug_s_con * input.shape[0]
+            total_aug_t_con = total_aug_t_con + aug_t_con * input.shape[0]
 
             self.accumuate_count += 1
-        if self.gpu == 0:
-            train_acc, train_loss = (
-                self.log.epoch_state["top_1"] / self.log.epoch_state["steps"],
-                self.log.epoch_state["loss"] / self.log.epoch_state["steps"],
-            )
+        if self.teacher_cache is not None:
+            self.teacher_cache.flush()
+        if self.deferred_reduce:
+            train_acc = self.train_meter.reduce()[0]
         else:
-            train_acc, train_loss = 0, 0
+            train_acc = float(total_top1 / len(loader))
+        train_loss = float(total_loss / len(loader))
         use_time = round((time.time() - start_time) / 60, 2)
-        if self.gpu == 0:
-            self.ff.write(
-                f"epoch:{self.epoch}, train_acc:{train_acc}, train_loss:{train_loss},aug_t_con:{total_aug_t_con / len(self.dataloader.dataset)}, aug_s_con:{total_aug_s_con / len(self.dataloader.dataset)}, min:{use_time}\n"
-            )
+        self.metrics.log(
+            {
+                "epoch": self.epoch,
+                "train_acc": train_acc,
+                "train_loss": train_loss,
+                "epoch_aug_t_con": float(total_aug_t_con / len(self.dataloader.dataset)),
+                "epoch_aug_s_con": float(total_aug_s_con / len(self.dataloader.dataset)),
+                "train_min": use_time,
+            },
+            step=self.accumuate_count,
+        )
         return train_acc, train_loss
 
     @torch.no_grad()
@@ -380,10 +486,10 @@ class LearnDiversifyEnv(object):
         else:
             self.student_model.eval()
         self.convertor.SDA.eval()
-        if self.gpu == 0:
-            self.log.eval(len_dataset=len(self.testloader))
+        self.val_meter.reset()
+        total_top1, total_top5, total_loss = 0.0, 0.0, 0.0
         for batch_idx, (input, target) in enumerate(self.testloader):
-            input = input.float().cuda()
+            input = self.normalize_batch(input.cuda())[0]
             target = target.cuda()
             torch.cuda.synchronize()
             if if_teacher:
@@ -399,33 +505,40 @@ class LearnDiversifyEnv(object):
                     _, logits = self.student_model.module(input, is_feat=True)
             torch.cuda.synchronize()
             loss = F.cross_entropy(logits, target, reduction="mean")
+            if self.deferred_reduce:
+                self.val_meter.update(logits, target, loss)
+                continue
             top1, top5 = correct_num(logits, target, topk=(1, 5))
             dist.all_reduce(top1, op=dist.ReduceOp.SUM)
             dist.all_reduce(top5, op=dist.ReduceOp.SUM)
             top1 /= torch.cuda.device_count()
             top5 /= torch.cuda.device_count()
-            if self.gpu == 0:
-                if if_teacher:
-                    self.log(self.teacher_model, loss.cpu(), top1.cpu(), top5.cpu())
-                else:
-                    self.log(self.student_model, loss.cpu(), top1.cpu(), top5.cpu())
-        if self.gpu == 0:
-            test_top1_acc, test_top5_acc, test_loss = (
-                self.log.epoch_state["top_1"] / self.log.epoch_state["steps"],
-                self.log.epoch_state["top_5"] / self.log.epoch_state["steps"],
-                self.log.epoch_state["loss"] / self.log.epoch_state["steps"],
-            )
+            total_top1 = total_top1 + top1
+            total_top5 = total_top5 + top5
+            total_loss = total_loss + loss
+        if self.deferred_reduce:
+            test_top1_acc, test_top5_acc, test_loss = self.val_meter.reduce()
         else:
-            test_top1_acc, test_top5_acc, test_loss = 0, 0, 0
+            test_top1_acc, test_top5_acc, test_loss = (
+                torch.cat([total_top1, total_top5, total_loss.view(-1)]) / len(self.testloader)
+            ).tolist()
         use_time = round((time.time() - start_time) / 60, 2)
         if self.gpu == 0:
             if if_teacher:
                 print("Teacher's Top-1 Acc is", test_top1_acc, "%", "Top-5 Acc is", test_top5_acc)
             else:
                 print("Student's Top-1 Acc is", test_top1_acc, "%", "Top-5 Acc is", test_top5_acc)
-                self.ff.write(
-                    f"epoch:{self.epoch}, test_top1_acc:{test_top1_acc}, test_top1_acc:{test_top5_acc}, min:{use_time}\n"
-                )
+        if not if_teacher:
+            self.metrics.log(
+                {
+                    "epoch": self.epoch,
+                    "test_top1_acc": test_top1_acc,
+                    "test_top5_acc": test_top5_acc,
+                    "test_loss": test_loss,
+                    "test_min": use_time,
+                },
+                step=self.accumuate_count,
+            )
         return test_top1_acc
 
     def scheduler_step(self):
@@ -454,10 +567,11 @@ class LearnDiversifyEnv(object):
             vtop1 = self.run_one_val_epoch()
             if not isinstance(self.scheduler, timm.scheduler.scheduler.Scheduler):
                 self.scheduler_step()
-            if self.gpu == 0:
-                self.wandb.log(
-                    {"train_loss": tloss, "train_top1": ttop1, "val_top1": vtop1}, step=self.epoch
-                )
+            self.metrics.log(
+                {"epoch": self.epoch, "train_loss": tloss, "train_top1": ttop1, "val_top1": vtop1},
+                step=self.accumuate_count,
+            )
+            self.metrics.flush()
             self.epoch += 1
             if self.best_acc < vtop1:
                 self.best_acc = vtop1
@@ -488,7 +602,4 @@ class LearnDiversifyEnv(object):
                     dict["ema_model"] = self.ema_model.state_dict()
                 torch.save(dict, model_path)
 
-        if self.gpu == 0:
-            self.log.flush()
-            self.ff.close()
-            self.wandb.finish()
+        self.metrics.close()
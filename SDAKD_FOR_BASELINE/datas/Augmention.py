@@ -15,7 +15,7 @@ from torchvision.transforms.autoaugment import (
     Tensor,
 )
 
-from .COLOR import ColorAugmentation, _apply_op
+from .COLOR import ColorAugmentation, _apply_op, batched_equalize, padding_mask
 from .STN import FreezeSTN
 
 
@@ -26,9 +26,10 @@ def relaxed_bernoulli(logits, temp=0.05):
 
 
 def pre_tran(image, mean, std):
-    _image = image.mul(torch.Tensor(std)[None, :, None, None].cuda()).add(
-        torch.Tensor(mean)[None, :, None, None].cuda()
-    )
+    """
+    de-normalise to uint8, mean and std are (1, C, 1, 1) tensors on the device of image
+    """
+    _image = image.mul(std).add(mean)
     _image = _image * 255
     _image = torch.floor(_image + 0.5)
     torch.clip_(_image, 0, 255)
@@ -36,6 +37,13 @@ def pre_tran(image, mean, std):
     return _image
 
 
+def after_tran(image, mean, std):
+    """
+    re-normalise a uint8 image, equal to transforms.Normalize(mean, std)(image / 255)
+    """
+    return image.float().div_(255).sub_(mean).div_(std)
+
+
 class LAMBDA_AUG(nn.Module):
     def __init__(self, dataset_type, lambda_function):
         super(LAMBDA_AUG, self).__init__()
@@ -46,14 +54,31 @@ class LAMBDA_AUG(nn.Module):
             self.mean = [0.485, 0.456, 0.406]
             self.std = [0.229, 0.224, 0.225]
 
-        self.tran = transforms.Normalize(mean=self.mean, std=self.std)
-        self.pre_tran = lambda x: pre_tran(x, self.mean, self.std)
-        self.after_tran = lambda x: self.tran(x / 255)
+        # TODO: persistent device copies of mean and std, moved once on first use
+        self.mean_tensor = torch.Tensor(self.mean)[None, :, None, None]
+        self.std_tensor = torch.Tensor(self.std)[None, :, None, None]
         self.aug = lambda_function
 
-    def forward(self, x):
-        x = self.pre_tran(x)
-        x = self.aug(x)
+    def _to(self, device):
+        if self.mean_tensor.device != device:
+            self.mean_tensor = self.mean_tensor.to(device)
+            self.std_tensor = self.std_tensor.to(device)
+
+    def pre_tran(self, x):
+        self._to(x.device)
+        return pre_tran(x, self.mean_tensor, self.std_tensor)
+
+    def after_tran(self, x):
+        self._to(x.device)
+        return after_tran(x, self.mean_tensor, self.std_tensor)
+
+    def forward(self, x, x_uint8=None):
+        """
+        x_uint8: the de-normalised x, pass it to share one uint8 copy among several LAMBDA_AUG
+        """
+        if x_uint8 is None:
+            x_uint8 = self.pre_tran(x)
+        x = self.aug(x_uint8)
         x = self.after_tran(x)
         return x
 
@@ -94,7 +119,7 @@ class Mulit_Augmentation(nn.Module):
     LEARNING_STN_LIST = ["ShearX", "ShearY", "TranslateX", "TranslateY", "Rotate"]
     OTHER_LIST = ["CUTMIX"]
 
-    def __init__(self, pretrain_path, dataset_type, solve_number):
+    def __init__(self, pretrain_path, dataset_type, solve_number, fused=False):
         super(Mulit_Augmentation, self).__init__()
         self.len_policies = len(self.LEARNING_STN_LIST) + len(self.LEARNING_COLOR_LIST)
         self.probabilities = Parameter(
@@ -125,12 +150,15 @@ class Mulit_Augmentation(nn.Module):
             self.learning_color_model_list.append(model)
 
         self._freeze_parameter()  # TODO: FREEZE
+        # TODO: the fused mode needs linear color convolutions sharing one padding
+        self.fused = fused and all(
+            isinstance(model.conv, nn.Conv2d) and model.conv.padding == (2, 2)
+            for model in self.learning_color_model_list
+        )
 
         equailize = LAMBDA_AUG(
             dataset_type=dataset_type,
-            lambda_function=lambda _image: _apply_op(
-                _image, "Equalize", 0.0, interpolation=InterpolationMode.NEAREST, fill=None
-            ),
+            lambda_function=batched_equalize,
         )
         self.nolearning_model_list.append(equailize)
         invert = LAMBDA_AUG(
@@ -156,13 +184,19 @@ class Mulit_Augmentation(nn.Module):
         self.probabilities.data = torch.clamp(self.probabilities.data, EPS, 1 - EPS)
         self.magnitudes.data = torch.clamp(self.magnitudes.data, EPS, 1 - EPS)
 
-    def forward(self, image):
+    def forward(self, image, image_uint8=None):
+        """
+        image_uint8: the uint8 batch image was normalised from, it saves the de-normalisation
+        of the no-learning ops
+        """
         p = torch.sigmoid(self.probabilities)
         m = torch.sigmoid(self.magnitudes)
         p = relaxed_bernoulli(p)
         len = p.shape[0]
         index = torch.randperm(len).to(image.device)
         index = index[: self.solve_number].tolist()
+        if self.fused:
+            return self.fused_forward(image, p, m, index, image_uint8)
         result = []
         p_iter = 0
         m_iter = 0
@@ -186,7 +220,12 @@ class Mulit_Augmentation(nn.Module):
 
         for tran in self.nolearning_model_list:
             if p_iter in index:
-                now_image = tran(image)
+                if isinstance(tran, LAMBDA_AUG):
+                    if image_uint8 is None:
+                        image_uint8 = tran.pre_tran(image)
+                    now_image = tran(image, image_uint8)
+                else:
+                    now_image = tran(image)
                 now_image = p[p_iter] * now_image + (1 - p[p_iter]) * image
                 result.append(now_image - image)
             p_iter += 1
@@ -194,3 +233,55 @@ class Mulit_Augmentation(nn.Module):
         result = torch.stack(result).sum(0) + image
 
         return result
+
+    def fused_forward(self, image, p, m, index, image_uint8=None):
+        """
+        Evaluate all selected sub-policies in at most two full-resolution passes.
+        The selected color augmentations are one convolution over their stacked scale/shift
+        inputs, the selected STN matrices are composed into a single affine_grid + grid_sample
+        applied after the color result, as in the detection DeAug.
+        """
+        b = image.shape[0]
+        result = []
+        p_iter = 0
+        inputs, weights, color_p = [], [], []
+        for tran in self.learning_color_model_list:
+            if p_iter in index:
+                _m = m[p_iter].view(-1, 1).expand(b, -1)
+                scale, shift = tran.scale_shift(image, _m)
+                inputs.append(scale * image + shift)
+                weights.append(p[p_iter] * tran.conv.weight)
+                color_p.append(p[p_iter])
+            p_iter += 1
+        if len(inputs) > 0:
+            color_image = F.conv2d(
+                torch.cat(inputs, 1) * padding_mask(image), torch.cat(weights, 1), padding=2
+            )
+            result.append(color_image - torch.stack(color_p).sum() * image)
+
+        thetas = []
+        for tran in self.learning_stn_model_list:
+            if p_iter in index:
+                _m = m[p_iter].view(-1, 1).expand(b, -1)
+                H = tran.matrix(image, _m)
+                thetas.append(p[p_iter] * (H - tran.i_matrix))
+            p_iter += 1
+
+        for tran in self.nolearning_model_list:
+            if p_iter in index:
+                if isinstance(tran, LAMBDA_AUG):
+                    if image_uint8 is None:
+                        image_uint8 = tran.pre_tran(image)
+                    now_image = tran(image, image_uint8)
+                else:
+                    now_image = tran(image)
+                result.append(p[p_iter] * (now_image - image))
+            p_iter += 1
+
+        if len(result) > 0:
+            image = torch.stack(result).sum(0) + image
+        if len(thetas) > 0:
+            H = torch.stack(thetas).sum(0) + self.learning_stn_model_list[0].i_matrix
+            grid = F.affine_grid(H, image.size())
+            image = F.grid_sample(image, grid)
+        return image
@@ -0,0 +1,273 @@
+"""
+Batched uint8 (B, C, H, W) counterparts of the PIL SubPolicy operations of PolicyDatasetC10/C100/ImageNet.
+Every op gets the sub-batch selected by its Bernoulli mask and a per-sample random sign.
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms import functional as TF
+
+from datas.COLOR import batched_equalize
+
+
+def _sign(img):
+    return torch.randint(0, 2, (img.shape[0],), device=img.device).float() * 2 - 1
+
+
+def _affine(img, theta, mode, fillcolor):
+    """
+    PIL Image.transform(AFFINE) with output->input matrices theta (B, 2, 3) in normalised coordinates,
+    the pixels sampled from outside the image are set to fillcolor
+    """
+    x = img.float()
+    x = torch.cat([x, torch.ones_like(x[:, :1])], 1)
+    grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+    x = F.grid_sample(x, grid, mode=mode, padding_mode="zeros", align_corners=False)
+    x, mask = x[:, :-1], x[:, -1:]
+    if mode == "nearest":
+        mask = (mask > 0.5).float()
+    fill = torch.Tensor(list(fillcolor)).to(x.device).view(1, -1, 1, 1)
+    x = x * mask + (1 - mask) * fill
+    return x.round().clamp(0, 255).to(torch.uint8)
+
+
+def _blend(img, degenerate, factor):
+    """
+    PIL ImageEnhance: degenerate + factor * (img - degenerate) with a per-sample factor
+    """
+    factor = factor.view(-1, 1, 1, 1)
+    x = degenerate + factor * (img.float() - degenerate)
+    return x.clamp(0, 255).to(torch.uint8)
+
+
+def _grayscale(img):
+    """
+    PIL convert("L"), (R * 19595 + G * 38470 + B * 7471 + 0x8000) >> 16
+    """
+    img = img.int()
+    return (img[:, 0:1] * 19595 + img[:, 1:2] * 38470 + img[:, 2:3] * 7471 + 0x8000) >> 16
+
+
+def shearX(img, magnitude, fillcolor):
+    b, c, h, w = img.shape
+    s = magnitude * _sign(img) * h / w
+    theta = torch.zeros(b, 2, 3, device=img.device)
+    theta[:, 0, 0], theta[:, 0, 1], theta[:, 0, 2], theta[:, 1, 1] = 1, s, s, 1
+    return _affine(img, theta, "bicubic", fillcolor)
+
+
+def shearY(img, magnitude, fillcolor):
+    b, c, h, w = img.shape
+    s = magnitude * _sign(img) * w / h
+    theta = torch.zeros(b, 2, 3, device=img.device)
+    theta[:, 0, 0], theta[:, 1, 0], theta[:, 1, 1], theta[:, 1, 2] = 1, s, 1, s
+    return _affine(img, theta, "bicubic", fillcolor)
+
+
+def translateX(img, magnitude, fillcolor):
+    b = img.shape[0]
+    theta = torch.zeros(b, 2, 3, device=img.device)
+    theta[:, 0, 0], theta[:, 0, 2], theta[:, 1, 1] = 1, 2 * magnitude * _sign(img), 1
+    return _affine(img, theta, "nearest", fillcolor)
+
+
+def translateY(img, magnitude, fillcolor):
+    b = img.shape[0]
+    theta = torch.zeros(b, 2, 3, device=img.device)
+    theta[:, 0, 0], theta[:, 1, 1], theta[:, 1, 2] = 1, 1, 2 * magnitude * _sign(img)
+    return _affine(img, theta, "nearest", fillcolor)
+
+
+def rotate(img, magnitude, fillcolor):
+    # rotate_with_fill composites the rotated image over gray 128
+    return TF.rotate(img, float(magnitude), InterpolationMode.NEAREST, fill=[128.0] * img.shape[1])
+
+
+def color(img, magnitude, fillcolor):
+    return _blend(img, _grayscale(img).float(), 1 + magnitude * _sign(img))
+
+
+def posterize(img, magnitude, fillcolor):
+    mask = ~(2 ** (8 - int(magnitude)) - 1) & 0xFF
+    return img & mask
+
+
+def solarize(img, magnitude, fillcolor):
+    return torch.where(img >= magnitude, 255 - img, img)
+
+
+def contrast(img, magnitude, fillcolor):
+    mean = _grayscale(img).float().mean(dim=(1, 2, 3), keepdim=True)
+    return _blend(img, torch.floor(mean + 0.5), 1 + magnitude * _sign(img))
+
+
+def sharpness(img, magnitude, fillcolor):
+    c = img.shape[1]
+    kernel = torch.ones(3, 3, device=img.device)
+    kernel[1, 1] = 5.0
+    kernel = (kernel / kernel.sum()).expand(c, 1, 3, 3)
+    x = img.float()
+    smooth = F.conv2d(x, kernel, groups=c).add(0.5).floor()
+    # PIL keeps the border pixels of the smoothed image
+    degenerate = x.clone()
+    degenerate[..., 1:-1, 1:-1] = smooth
+    return _blend(img, degenerate, 1 + magnitude * _sign(img))
+
+
+def brightness(img, magnitude, fillcolor):
+    return _blend(img, torch.zeros_like(img, dtype=torch.float), 1 + magnitude * _sign(img))
+
+
+def autocontrast(img, magnitude, fillcolor):
+    x = img.float()
+    lo = x.amin(dim=(2, 3), keepdim=True)
+    hi = x.amax(dim=(2, 3), keepdim=True)
+    scale = 255.0 / (hi - lo).clamp(min=1)
+    out = ((x - lo) * scale).floor().clamp(0, 255)
+    return torch.where(hi > lo, out, x).to(torch.uint8)
+
+
+def equalize(img, magnitude, fillcolor):
+    return batched_equalize(img)
+
+
+def invert(img, magnitude, fillcolor):
+    return 255 - img
+
+
+class BatchSubPolicy:
+    """
+    SubPolicy over a batch: one Bernoulli(p1) draw per sample, the op runs once on the selected sub-batch
+    """
+
+    def __init__(self, p1, operation1, magnitude_idx1, fillcolor=(128, 128, 128)):
+        self.fillcolor = fillcolor
+        ranges = {
+            "shearX": np.linspace(0, 0.3, 10),
+            "shearY": np.linspace(0, 0.3, 10),
+            "translateX": np.linspace(0, 150 / 331, 10),
+            "translateY": np.linspace(0, 150 / 331, 10),
+            "rotate": np.linspace(0, 30, 10),
+            "color": np.linspace(0.0, 0.9, 10),
+            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(int),
+            "solarize": np.linspace(256, 0, 10),
+            "contrast": np.linspace(0.0, 0.9, 10),
+            "sharpness": np.linspace(0.0, 0.9, 10),
+            "brightness": np.linspace(0.0, 0.9, 10),
+            "autocontrast": [0] * 10,
+            "equalize": [0] * 10,
+            "invert": [0] * 10,
+        }
+
+        func = {
+            "shearX": shearX,
+            "shearY": shearY,
+            "translateX": translateX,
+            "translateY": translateY,
+            "rotate": rotate,
+            "color": color,
+            "posterize": posterize,
+            "solarize": solarize,
+            "contrast": contrast,
+            "sharpness": sharpness,
+            "brightness": brightness,
+            "autocontrast": autocontrast,
+            "equalize": equalize,
+            "invert": invert,
+        }
+
+        self.p1 = p1
+        self.operation1 = func[operation1]
+        self.magnitude1 = float(ranges[operation1][magnitude_idx1])
+
+    def __call__(self, img):
+        # the mask is drawn on the host, so selecting the sub-batch never syncs with the device
+        label = torch.rand(img.shape[0]) < self.p1
+        index = label.nonzero().view(-1)
+        if index.numel() > 0:
+            index = index.to(img.device, non_blocking=True)
+            img = img.index_copy(0, index, self.operation1(img[index], self.magnitude1, self.fillcolor))
+        return img, label.float()
+
+
+def batch_random_crop_flip(size, padding):
+    """
+    transforms.RandomCrop(size, padding) + RandomHorizontalFlip with a crop and a flip per sample
+    """
+
+    def crop_flip(img):
+        b, c, h, w = img.shape
+        img = F.pad(img, [padding] * 4)
+        oy = torch.randint(0, h + 2 * padding - size + 1, (b, 1), device=img.device)
+        ox = torch.randint(0, w + 2 * padding - size + 1, (b, 1), device=img.device)
+        rows = oy + torch.arange(size, device=img.device)
+        cols = ox + torch.arange(size, device=img.device)
+        flip = torch.rand(b, 1, device=img.device) < 0.5
+        cols = torch.where(flip, cols.flip(-1), cols)
+        img = img.gather(2, rows[:, None, :, None].expand(-1, c, -1, img.shape[3]))
+        img = img.gather(3, cols[:, None, None, :].expand(-1, c, size, -1))
+        return img
+
+    return crop_flip
+
+
+def batch_random_flip(img):
+    flip = torch.rand(img.shape[0], 1, 1, 1, device=img.device) < 0.5
+    return torch.where(flip, img.flip(-1), img)
+
+
+class BatchPolicy(nn.Module):
+    """
+    On-device PolicyDataset: image is the collated uint8 batch of the un-augmented samples, the policy
+    chain builds new_sample, spatial (crop/flip) is drawn independently for sample and new_sample as
+    the dataset transform was, and the result is normalised. The output matches a collated
+    PolicyDataset batch, (B, 2, C, H, W) samples and (B, 2, 1) targets.
+    """
+
+    def __init__(self, policies, p, mean, std, spatial=None, fillcolor=(128, 128, 128)):
+        super(BatchPolicy, self).__init__()
+        self.policies = [BatchSubPolicy(p, name, index, fillcolor) for name, index in policies]
+        self.policies_len = len(self.policies)
+        self.spatial = spatial
+        self.register_buffer("mean", torch.Tensor(mean)[None, :, None, None])
+        self.register_buffer("std", torch.Tensor(std)[None, :, None, None])
+
+    def normalize(self, img):
+        return img.float().div(255).sub_(self.mean).div_(self.std)
+
+    @torch.no_grad()
+    def forward(self, image, target):
+        new_image = image
+        for i in range(self.policies_len):
+            new_image, _ = self.policies[i](new_image)
+        if self.spatial is not None:
+            image, new_image = self.spatial(image), self.spatial(new_image)
+        sample = torch.stack([self.normalize(image), self.normalize(new_image)], 1)
+        if target.ndim == 2 and target.shape[-1] != 1:
+            target = target.argmax(1)
+        target = target.view(-1, 1).unsqueeze(1).expand(-1, 2, -1)
+        return sample, target
+
+
+class BatchPolicyLoader(object):
+    """
+    wrap a DataLoader of uint8 (image, target) batches, every batch is moved to device and augmented there
+    """
+
+    def __init__(self, dataloader, policy, device):
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.sampler = dataloader.sampler
+        self.policy = policy.to(device)
+        self.device = device
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for image, target in self.dataloader:
+            image = image.to(self.device, non_blocking=True)
+            target = target.to(self.device, non_blocking=True)
+            yield self.policy(image, target)
@@ -9,6 +9,7 @@ from torchvision import datasets, transforms
 from torchvision.transforms import *
 
 from .IndexDataset import IndexDataset
+from .LabelIndex import dataset_labels, stratified_split
 
 
 class BaseDatasetWrapper(Dataset):
@@ -155,6 +156,24 @@ class SubPolicy:
         return img, label
 
 
+C10_POLICIES = [
+    ("invert", 7),
+    ("rotate", 2),
+    ("shearY", 8),
+    ("posterize", 9),
+    ("autocontrast", 8),
+    ("color", 3),
+    ("sharpness", 9),
+    ("equalize", 5),
+    ("contrast", 7),
+    ("translateY", 3),
+    ("brightness", 6),
+    ("solarize", 2),
+    ("translateX", 3),
+    ("shearX", 8),
+]
+
+
 class PolicyDatasetC10(BaseDatasetWrapper):
     def __init__(self, org_dataset, p=0.3):
         super(PolicyDatasetC10, self).__init__(org_dataset)
@@ -162,22 +181,7 @@ class PolicyDatasetC10(BaseDatasetWrapper):
         org_dataset.transform = None
         self.org_dataset = org_dataset
         print("the probability of CIFAR-100 is {}".format(p))
-        self.policies = [
-            SubPolicy(p, "invert", 7),
-            SubPolicy(p, "rotate", 2),
-            SubPolicy(p, "shearY", 8),
-            SubPolicy(p, "posterize", 9),
-            SubPolicy(p, "autocontrast", 8),
-            SubPolicy(p, "color", 3),
-            SubPolicy(p, "sharpness", 9),
-            SubPolicy(p, "equalize", 5),
-            SubPolicy(p, "contrast", 7),
-            SubPolicy(p, "translateY", 3),
-            SubPolicy(p, "brightness", 6),
-            SubPolicy(p, "solarize", 2),
-            SubPolicy(p, "translateX", 3),
-            SubPolicy(p, "shearX", 8),
-        ]
+        self.policies = [SubPolicy(p, name, index) for name, index in C10_POLICIES]
         self.policies_len = len(self.policies)
 
     def __getitem__(self, index):
@@ -203,7 +207,13 @@ class PolicyDatasetC10(BaseDatasetWrapper):
         return sample, target
 
 
-def DataLoader_C10(data_path, val_ratio, num_worker, train_batch_size=64, test_batch_size=64):
+def DataLoader_C10(
+    data_path, val_ratio, num_worker, train_batch_size=64, test_batch_size=64, batched_policy=False
+):
+    """
+    batched_policy: workers only decode to uint8, the SubPolicy chain, crop, flip and Normalize
+    run batched on device (see datas/BatchPolicy.py), the batches keep the PolicyDatasetC10 layout
+    """
     trainset = torchvision.datasets.CIFAR10(
         root=data_path,
         train=True,
@@ -217,12 +227,11 @@ def DataLoader_C10(data_path, val_ratio, num_worker, train_batch_size=64, test_b
             ]
         ),
     )
-    from sklearn.model_selection import StratifiedShuffleSplit
-
-    labels = [trainset[i][1] for i in range(len(trainset))]
-    ss = StratifiedShuffleSplit(n_splits=1, test_size=val_ratio, random_state=0)
-    train_indices, valid_indices = list(ss.split(np.array(labels)[:, np.newaxis], labels))[0]
-    trainset = PolicyDatasetC10(trainset)
+    train_indices, valid_indices = stratified_split(dataset_labels(trainset), val_ratio)
+    if batched_policy:
+        trainset.transform = transforms.PILToTensor()
+    else:
+        trainset = PolicyDatasetC10(trainset)
     trainset, valset = torch.utils.data.Subset(trainset, train_indices), torch.utils.data.Subset(
         trainset, valid_indices
     )
@@ -258,6 +267,19 @@ def DataLoader_C10(data_path, val_ratio, num_worker, train_batch_size=64, test_b
         num_workers=num_worker,
         pin_memory=(torch.cuda.is_available()),
     )
+    if batched_policy:
+        from .BatchPolicy import BatchPolicy, BatchPolicyLoader, batch_random_crop_flip
+
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        policy = BatchPolicy(
+            C10_POLICIES,
+            0.3,
+            [0.5071, 0.4867, 0.4408],
+            [0.2675, 0.2565, 0.2761],
+            spatial=batch_random_crop_flip(32, 4),
+        )
+        trainloader = BatchPolicyLoader(trainloader, policy, device)
+        valloader = BatchPolicyLoader(valloader, policy, device)
     return trainloader, valloader, testloader
 
 
@@ -9,6 +9,7 @@ from torchvision import datasets, transforms
 from torchvision.transforms import *
 
 from .IndexDataset import IndexDataset
+from .LabelIndex import dataset_labels, stratified_split
 
 
 class BaseDatasetWrapper(Dataset):
@@ -155,6 +156,24 @@ class SubPolicy:
         return img, label
 
 
+C100_POLICIES = [
+    ("autocontrast", 2),
+    ("contrast", 3),
+    ("posterize", 0),
+    ("solarize", 4),
+    ("translateY", 8),
+    ("shearX", 5),
+    ("brightness", 3),
+    ("shearY", 0),
+    ("translateX", 1),
+    ("sharpness", 5),
+    ("invert", 4),
+    ("color", 4),
+    ("equalize", 8),
+    ("rotate", 3),
+]
+
+
 class PolicyDatasetC100(BaseDatasetWrapper):
     def __init__(self, org_dataset, p=0.3):
         super(PolicyDatasetC100, self).__init__(org_dataset)
@@ -162,22 +181,7 @@ class PolicyDatasetC100(BaseDatasetWrapper):
         org_dataset.transform = None
         self.org_dataset = org_dataset
         print("the probability of CIFAR-100 is {}".format(p))
-        self.policies = [
-            SubPolicy(p, "autocontrast", 2),
-            SubPolicy(p, "contrast", 3),
-            SubPolicy(p, "posterize", 0),
-            SubPolicy(p, "solarize", 4),
-            SubPolicy(p, "translateY", 8),
-            SubPolicy(p, "shearX", 5),
-            SubPolicy(p, "brightness", 3),
-            SubPolicy(p, "shearY", 0),
-            SubPolicy(p, "translateX", 1),
-            SubPolicy(p, "sharpness", 5),
-            SubPolicy(p, "invert", 4),
-            SubPolicy(p, "color", 4),
-            SubPolicy(p, "equalize", 8),
-            SubPolicy(p, "rotate", 3),
-        ]
+        self.policies = [SubPolicy(p, name, index) for name, index in C100_POLICIES]
         self.policies_len = len(self.policies)
 
     def __getitem__(self, index):
@@ -203,7 +207,13 @@ class PolicyDatasetC100(BaseDatasetWrapper):
         return sample, target
 
 
-def DataLoader_C100(data_path, val_ratio, num_worker, train_batch_size=64, test_batch_size=64):
+def DataLoader_C100(
+    data_path, val_ratio, num_worker, train_batch_size=64, test_batch_size=64, batched_policy=False
+):
+    """
+    batched_policy: workers only decode to uint8, the SubPolicy chain, crop, flip and Normalize
+    run batched on device (see datas/BatchPolicy.py), the batches keep the PolicyDatasetC100 layout
+    """
     trainset = torchvision.datasets.CIFAR100(
         root=data_path,
         train=True,
@@ -217,12 +227,11 @@ def DataLoader_C100(data_path, val_ratio, num_worker, train_batch_size=64, test_
             ]
         ),
     )
-    from sklearn.model_selection import StratifiedShuffleSplit
-
-    labels = [trainset[i][1] for i in range(len(trainset))]
-    ss = StratifiedShuffleSplit(n_splits=1, test_size=val_ratio, random_state=0)
-    train_indices, valid_indices = list(ss.split(np.array(labels)[:, np.newaxis], labels))[0]
-    trainset = PolicyDatasetC100(trainset)
+    train_indices, valid_indices = stratified_split(dataset_labels(trainset), val_ratio)
+    if batched_policy:
+        trainset.transform = transforms.PILToTensor()
+    else:
+        trainset = PolicyDatasetC100(trainset)
     trainset, valset = torch.utils.data.Subset(trainset, train_indices), torch.utils.data.Subset(
         trainset, valid_indices
     )
@@ -258,6 +267,19 @@ def DataLoader_C100(data_path, val_ratio, num_worker, train_batch_size=64, test_
         num_workers=num_worker,
         pin_memory=(torch.cuda.is_available()),
     )
+    if batched_policy:
+        from .BatchPolicy import BatchPolicy, BatchPolicyLoader, batch_random_crop_flip
+
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        policy = BatchPolicy(
+            C100_POLICIES,
+            0.3,
+            [0.5071, 0.4867, 0.4408],
+            [0.2675, 0.2565, 0.2761],
+            spatial=batch_random_crop_flip(32, 4),
+        )
+        trainloader = BatchPolicyLoader(trainloader, policy, device)
+        valloader = BatchPolicyLoader(valloader, policy, device)
     return trainloader, valloader, testloader
 
 
@@ -333,11 +355,8 @@ def LR_Few_Shot_DataLoader_CIFAR100(data_path, num_worker, train_batch_size=64,
                 ]
             ),
         )
-        from sklearn.model_selection import StratifiedShuffleSplit
         few_shot_ratio = 0.75
-        labels = trainset.targets
-        ss = StratifiedShuffleSplit(n_splits=1, test_size=1 - few_shot_ratio, random_state=0)
-        train_indices, valid_indices = list(ss.split(np.array(labels)[:, np.newaxis], labels))[0]
+        train_indices, valid_indices = stratified_split(dataset_labels(trainset), 1 - few_shot_ratio)
         trainset = IndexDataset(torch.utils.data.Subset(trainset, train_indices))
         train_sampler = torch.utils.data.distributed.DistributedSampler(trainset)
 
@@ -111,6 +111,32 @@ import math
 import torch
 import torch.nn as nn
 
+from datas.TargetCache import AlignmentTargetCache
+
+
+def batched_equalize(img: Tensor):
+    """
+    Histogram equalisation of a uint8 image batch (..., C, H, W), equal to F.equalize.
+    All B*C histograms are one bincount over a flattened (B*C) index, the cumulative
+    LUTs are built together and the remap is a single gather.
+    """
+    shape = img.shape
+    flat = img.reshape(-1, shape[-2] * shape[-1]).long()
+    n = flat.shape[0]
+    offset = torch.arange(n, device=img.device).view(-1, 1) * 256
+    hist = torch.bincount((flat + offset).view(-1), minlength=n * 256).view(n, 256)
+    # the count of the last non-zero bin is excluded from step, as in torchvision
+    last = (torch.arange(256, device=img.device) * (hist > 0)).argmax(1, keepdim=True)
+    step = torch.div(hist.sum(1, keepdim=True) - hist.gather(1, last), 255, rounding_mode="floor")
+    lut = torch.div(
+        hist.cumsum(1) + torch.div(step, 2, rounding_mode="floor"),
+        step.clamp(min=1),
+        rounding_mode="floor",
+    )
+    lut = torch.nn.functional.pad(lut, [1, 0])[:, :-1].clamp(0, 255)
+    out = torch.where(step == 0, flat, lut.gather(1, flat))
+    return out.to(torch.uint8).reshape(shape)
+
 
 def relaxed_bernoulli(logits, temp=0.05, device="cpu"):
     u = torch.rand_like(logits, device=device)
@@ -134,6 +160,17 @@ class TriangleWave(torch.autograd.Function):
         return grad
 
 
+def padding_mask(x):
+    # ignore zero padding region
+    with torch.no_grad():
+        h, w = x.shape[-2:]
+        mask = (x.sum(1, keepdim=True) == 0).float()  # mask pixels having (0, 0, 0) color
+        mask = torch.logical_and(
+            mask.sum(-1, keepdim=True) < w, mask.sum(-2, keepdim=True) < h
+        )  # mask zero padding region
+    return mask
+
+
 class ColorAugmentation(nn.Module):
     def __init__(self, ndim=10, scale=1, dataset_type=""):
         super().__init__()
@@ -165,7 +202,7 @@ class ColorAugmentation(nn.Module):
             shift = prob * shift  # omit "+ (1 - prob) * 0"
         return scale, shift
 
-    def forward(self, x, magnitude, re=True):
+    def scale_shift(self, x, magnitude, re=True):
         noise = self.feature + torch.randn_like(self.feature).to(self.feature.data.device) / 100
         if isinstance(magnitude, (float, int)):
             magnitude = torch.Tensor([magnitude]).to(x.device)
@@ -186,25 +223,35 @@ class ColorAugmentation(nn.Module):
         # random apply
         if re == True:
             scale, shift = self.sampling(scale, shift)
+        return scale, shift
+
+    def forward(self, x, magnitude, re=True):
+        scale, shift = self.scale_shift(x, magnitude, re)
         return self.conv(self.transform(x, scale, shift))
 
     def transform(self, x, scale, shift):
-        # ignore zero padding region
-        with torch.no_grad():
-            h, w = x.shape[-2:]
-            mask = (x.sum(1, keepdim=True) == 0).float()  # mask pixels having (0, 0, 0) color
-            mask = torch.logical_and(
-                mask.sum(-1, keepdim=True) < w, mask.sum(-2, keepdim=True) < h
-            )  # mask zero padding region
-
-        x = (scale * x + shift) * mask
+        x = (scale * x + shift) * padding_mask(x)
         return x
 
 
 class Alignment:
-    def __init__(self, policy_name, img_size, save_path, COLOR, dataset_type, epoch=20):
+    def __init__(
+        self,
+        policy_name,
+        img_size,
+        save_path,
+        COLOR,
+        dataset_type,
+        epoch=20,
+        target_cache=None,
+        target_cache_views=1,
+    ):
         self.policy_name = policy_name
         self.img_size = img_size
+        self.dataset_type = dataset_type
+        # TODO: directory of the memory-mapped target cache, None to recompute every epoch
+        self.target_cache = target_cache
+        self.target_cache_views = target_cache_views
         if dataset_type == "CIFAR":
             self.mean = [0.5071, 0.4867, 0.4408]
             self.std = [0.2675, 0.2565, 0.2761]
@@ -219,7 +266,8 @@ class Alignment:
         self.save_path = save_path
         self.tran = transforms.Compose([transforms.Normalize(self.mean, std=self.std)])
 
-    def _augmentation_space(self, num_bins: int, image_size):
+    @staticmethod
+    def _augmentation_space(num_bins: int, image_size):
         return {
             # op_name: (magnitudes, signed)
             "ShearX": (torch.linspace(0.0, 0.3, num_bins), True),
@@ -238,51 +286,89 @@ class Alignment:
             "Invert": (torch.tensor(0.0), False),
         }
 
+    def _draw(self, image, augmentation_space):
+        """
+        (magnitude fed to the surrogate, torchvision magnitude, magnitude bin, sign) of one batch
+        """
+        magnitude = random.random()
+        magnitudes, signed = augmentation_space[self.policy_name]
+        magnitude_id = min(max(int(magnitude * 10), 0), 9)
+        if magnitudes.numel() > 1:
+            magnitude_new = float(magnitudes[magnitude_id].item())
+        else:
+            magnitude_new = 0.0
+        sign = int(signed and torch.randint(2, (1,)).item())
+
+        if sign:
+            magnitude_new *= -1.0
+            magnitude *= -1.0
+        magnitude = (
+            torch.Tensor([magnitude]).to(image.device)[None, ...].expand(image.shape[0], -1)
+        )
+        return magnitude, magnitude_new, magnitude_id, sign
+
+    def _target(self, image, augmentation_space):
+        magnitude, magnitude_new, _, _ = self._draw(image, augmentation_space)
+        return magnitude, self._freeze(image, magnitude_new)
+
+    def _freeze(self, image, magnitude_new):
+        _image = image.mul(torch.Tensor(self.std)[None, :, None, None].cuda()).add(
+            torch.Tensor(self.mean)[None, :, None, None].cuda()
+        )
+        _image = _image * 255
+        _image = torch.floor(_image + 0.5)
+        torch.clip_(_image, 0, 255)
+        _image = _image.type(torch.uint8)
+        freeze_image = _apply_op(
+            _image,
+            self.policy_name,
+            magnitude_new,
+            interpolation=InterpolationMode.NEAREST,
+            fill=None,
+        )
+        return self.tran(freeze_image / 255).float()
+
+    def _step(self, i, j, image, magnitude, freeze_image):
+        color_image = self.color(image, magnitude, False)
+        loss = self.criticion(color_image, freeze_image)
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        self.scheduler.step()
+        print(f"epoch = {i}, iter = {j}, loss = {round(loss.item(), 3)}")
+
     def fit(self, dataloader):
 
         augmentation_space = self._augmentation_space(10, self.img_size)
         self.color.train()
+        cache = None
+        if self.target_cache is not None:
+            image, _ = dataloader.dataset[0]
+            cache = AlignmentTargetCache(
+                self.target_cache,
+                self.policy_name,
+                self.dataset_type,
+                len(dataloader.dataset),
+                tuple(image.shape),
+                views=self.target_cache_views,
+            )
         for i in range(self.epoch):
-            for j, (image, _) in enumerate(dataloader):
-                image = image.cuda()
-                magnitude = random.random()
-                magnitudes, signed = augmentation_space[self.policy_name]
-                magnitude_id = min(max(int(magnitude * 10), 0), 9)
-                if magnitudes.numel() > 1:
-                    magnitude_new = float(magnitudes[magnitude_id].item())
-                else:
-                    magnitude_new = 0.0
-                sign = torch.randint(2, (1,))
-
-                if signed and sign:
-                    magnitude_new *= -1.0
-                    magnitude *= -1.0
-                _image = image.mul(torch.Tensor(self.std)[None, :, None, None].cuda()).add(
-                    torch.Tensor(self.mean)[None, :, None, None].cuda()
-                )
-                _image = _image * 255
-                _image = torch.floor(_image + 0.5)
-                torch.clip_(_image, 0, 255)
-                _image = _image.type(torch.uint8)
-                freeze_image = _apply_op(
-                    _image,
-                    self.policy_name,
-                    magnitude_new,
-                    interpolation=InterpolationMode.NEAREST,
-                    fill=None,
-                )
-                freeze_image = self.tran(freeze_image / 255).float()
-
-                magnitude = (
-                    torch.Tensor([magnitude]).to(image.device)[None, ...].expand(image.shape[0], -1)
-                )
-                stn_image = self.color(image, magnitude, False)
-                loss = self.criticion(stn_image, freeze_image)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                self.scheduler.step()
-                print(f"epoch = {i}, iter = {j}, loss = {round(loss.item(), 3)}")
+            view = i % self.target_cache_views
+            if cache is not None:
+                # the stored input of every image, the targets of its drawn (bin, sign) are computed once
+                for j, (index, image, _) in enumerate(cache.loader(dataloader)):
+                    image = cache.inputs(view, index, image.cuda(non_blocking=True))
+                    magnitude, magnitude_new, magnitude_id, sign = self._draw(image, augmentation_space)
+                    freeze_image = cache.targets(
+                        view, index, magnitude_id, sign, image, lambda x: self._freeze(x, magnitude_new)
+                    )
+                    self._step(i, j, image, magnitude, freeze_image)
+                cache.flush()
+            else:
+                for j, (image, _) in enumerate(dataloader):
+                    image = image.cuda()
+                    magnitude, freeze_image = self._target(image, augmentation_space)
+                    self._step(i, j, image, magnitude, freeze_image)
             torch.save(self.color.state_dict(), self.save_path)
 
 
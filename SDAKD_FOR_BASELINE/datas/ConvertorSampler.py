@@ -0,0 +1,119 @@
+import math
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.data import Sampler
+
+from datas.LabelIndex import dataset_labels
+
+
+class DisagreementScores:
+    """
+    Per-sample KL(teacher || student) on the clean half of the training batches, indexed by the
+    IndexDataset item. Every rank updates the samples it trained on, reduce() merges the most
+    recent score of every sample over the ranks.
+    """
+
+    def __init__(self, dataset_len, device):
+        self.scores = torch.zeros(dataset_len, device=device)
+        self.stamps = torch.zeros(dataset_len, dtype=torch.long, device=device)
+        self.step = 0
+
+    @torch.no_grad()
+    def update(self, index, student_logits, teacher_logits):
+        if index.ndim == 2:
+            # TODO: (item, view) pairs of the replayable transforms
+            index = index[:, 0]
+        index = index.to(self.scores.device, non_blocking=True)
+        teacher_log_prob = F.log_softmax(teacher_logits.float(), dim=1)
+        student_log_prob = F.log_softmax(student_logits.float(), dim=1)
+        kl = (teacher_log_prob.exp() * (teacher_log_prob - student_log_prob)).sum(1)
+        self.step += 1
+        self.scores[index] = kl
+        self.stamps[index] = self.step
+
+    @torch.no_grad()
+    def reduce(self):
+        """
+        scores on the host, -1 for the samples no rank has seen yet
+        """
+        stamps = self.stamps.clone()
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(stamps, op=dist.ReduceOp.MAX)
+        latest = ((self.stamps == stamps) & (stamps > 0)).float()
+        scores, count = self.scores * latest, latest
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(scores)
+            dist.all_reduce(count)
+        scores = scores / count.clamp(min=1)
+        scores[count == 0] = -1
+        return scores.cpu()
+
+
+class ConvertorSubsetSampler(Sampler):
+    """
+    Distributed sampler over a coreset of ratio * len(dataset) samples, drawn again at every set_epoch:
+    "random" a fixed fraction, "balanced" the same fraction of every class, "disagreement" without
+    replacement with probability proportional to the recent student/teacher disagreement (samples
+    without a score yet get the highest one). The coreset is the same on every rank and sharded as in
+    DistributedSampler. With indices (e.g. the cached part of a rank) the coreset is drawn from those
+    dataset indices only, pass num_replicas=1 when every rank has its own indices.
+    """
+
+    def __init__(self, dataset, ratio, mode="random", num_replicas=None, rank=None, seed=0, indices=None):
+        assert mode in ["random", "balanced", "disagreement"]
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+        self.indices = None if indices is None else torch.as_tensor(indices, dtype=torch.long)
+        self.dataset_len = len(dataset) if indices is None else len(self.indices)
+        self.ratio = ratio
+        self.mode = mode
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.scores = None
+        self.labels = torch.from_numpy(dataset_labels(dataset)) if mode == "balanced" else None
+        if self.labels is not None and self.indices is not None:
+            self.labels = self.labels[self.indices]
+        self.subset_len = max(int(round(self.dataset_len * ratio)), 1)
+        self.num_samples = math.ceil(self.subset_len / self.num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_scores(self, scores):
+        self.scores = scores if self.indices is None else scores[self.indices]
+
+    def subset(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.mode == "balanced":
+            indices = []
+            for c in torch.unique(self.labels):
+                members = torch.nonzero(self.labels == c).view(-1)
+                n = max(int(round(members.numel() * self.ratio)), 1)
+                indices.append(members[torch.randperm(members.numel(), generator=g)[:n]])
+            indices = torch.cat(indices)
+            return indices[torch.randperm(indices.numel(), generator=g)]
+        if self.mode == "disagreement" and self.scores is not None and (self.scores >= 0).any():
+            weights = self.scores.clone().double()
+            weights[weights < 0] = weights.max()
+            weights = weights.clamp(min=0) + 1e-8
+            return torch.multinomial(weights, self.subset_len, replacement=False, generator=g)
+        return torch.randperm(self.dataset_len, generator=g)[: self.subset_len]
+
+    def __iter__(self):
+        indices = self.subset()
+        if self.indices is not None:
+            indices = self.indices[indices]
+        indices = indices.tolist()
+        total_size = self.num_samples * self.num_replicas
+        indices += indices[: total_size - len(indices)]
+        return iter(indices[self.rank: total_size: self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
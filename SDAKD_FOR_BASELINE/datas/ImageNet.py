@@ -9,6 +9,7 @@ from torchvision import datasets, transforms
 from torchvision.transforms import *
 
 from .IndexDataset import IndexDataset
+from .LabelIndex import IndexedImageFolder, dataset_labels, stratified_split
 
 
 class BaseDatasetWrapper(Dataset):
@@ -155,6 +156,35 @@ class SubPolicy:
         return img, label
 
 
+IMAGENET_POLICIES = [
+    ("posterize", 8),
+    ("solarize", 5),
+    ("equalize", 8),
+    ("posterize", 7),
+    ("equalize", 7),
+    ("equalize", 4),
+    ("solarize", 3),
+    ("posterize", 5),
+    ("rotate", 3),
+    ("equalize", 8),
+    ("rotate", 8),
+    ("rotate", 9),
+    ("equalize", 7),
+    ("invert", 4),
+    ("color", 4),
+    ("rotate", 8),
+    ("color", 8),
+    ("sharpness", 7),
+    ("shearX", 5),
+    ("color", 0),
+    ("equalize", 7),
+    ("solarize", 5),
+    ("invert", 4),
+    ("color", 4),
+    ("equalize", 8),
+]
+
+
 class PolicyDatasetImageNet(BaseDatasetWrapper):
     def __init__(self, org_dataset, p=0.2):
         super(PolicyDatasetImageNet, self).__init__(org_dataset)
@@ -162,33 +192,7 @@ class PolicyDatasetImageNet(BaseDatasetWrapper):
         org_dataset.transform = None
         self.org_dataset = org_dataset
         print("the probability of ImageNet is {}".format(p))
-        self.policies = [
-            SubPolicy(p, "posterize", 8),
-            SubPolicy(p, "solarize", 5),
-            SubPolicy(p, "equalize", 8),
-            SubPolicy(p, "posterize", 7),
-            SubPolicy(p, "equalize", 7),
-            SubPolicy(p, "equalize", 4),
-            SubPolicy(p, "solarize", 3),
-            SubPolicy(p, "posterize", 5),
-            SubPolicy(p, "rotate", 3),
-            SubPolicy(p, "equalize", 8),
-            SubPolicy(p, "rotate", 8),
-            SubPolicy(p, "rotate", 9),
-            SubPolicy(p, "equalize", 7),
-            SubPolicy(p, "invert", 4),
-            SubPolicy(p, "color", 4),
-            SubPolicy(p, "rotate", 8),
-            SubPolicy(p, "color", 8),
-            SubPolicy(p, "sharpness", 7),
-            SubPolicy(p, "shearX", 5),
-            SubPolicy(p, "color", 0),
-            SubPolicy(p, "equalize", 7),
-            SubPolicy(p, "solarize", 5),
-            SubPolicy(p, "invert", 4),
-            SubPolicy(p, "color", 4),
-            SubPolicy(p, "equalize", 8),
-        ]
+        self.policies = [SubPolicy(p, name, index) for name, index in IMAGENET_POLICIES]
         self.policies_len = len(self.policies)
 
     def __getitem__(self, index):
@@ -320,7 +324,7 @@ def Few_Shot_DataLoader_ImageNet(data_path, num_worker, train_batch_size=64, tes
     """
     few_shot_ratio = 0.1
 
-    trainset = torchvision.datasets.ImageFolder(
+    trainset = IndexedImageFolder(
         data_path + "/train",
         transforms.Compose(
             [
@@ -332,11 +336,7 @@ def Few_Shot_DataLoader_ImageNet(data_path, num_worker, train_batch_size=64, tes
         ),
     )
 
-    from sklearn.model_selection import StratifiedShuffleSplit
-
-    labels = trainset.targets
-    ss = StratifiedShuffleSplit(n_splits=1, test_size=1 - few_shot_ratio, random_state=0)
-    train_indices, valid_indices = list(ss.split(np.array(labels)[:, np.newaxis], labels))[0]
+    train_indices, valid_indices = stratified_split(dataset_labels(trainset), 1 - few_shot_ratio)
     trainset = IndexDataset(torch.utils.data.Subset(trainset, train_indices))
     train_sampler = torch.utils.data.distributed.DistributedSampler(trainset)
     testset = torchvision.datasets.ImageFolder(
@@ -377,7 +377,7 @@ def LR_Few_Shot_DataLoader_ImageNet(data_path, num_worker, train_batch_size=64,
     """
     few_shot_ratio = 0.1
 
-    trainset = torchvision.datasets.ImageFolder(
+    trainset = IndexedImageFolder(
         data_path + "/train",
         transforms.Compose(
             [
@@ -389,11 +389,7 @@ def LR_Few_Shot_DataLoader_ImageNet(data_path, num_worker, train_batch_size=64,
         ),
     )
 
-    from sklearn.model_selection import StratifiedShuffleSplit
-
-    labels = trainset.targets
-    ss = StratifiedShuffleSplit(n_splits=1, test_size=1 - few_shot_ratio, random_state=0)
-    train_indices, valid_indices = list(ss.split(np.array(labels)[:, np.newaxis], labels))[0]
+    train_indices, valid_indices = stratified_split(dataset_labels(trainset), 1 - few_shot_ratio)
     trainset = IndexDataset(torch.utils.data.Subset(trainset, train_indices))
     train_sampler = torch.utils.data.distributed.DistributedSampler(trainset)
     testset = torchvision.datasets.ImageFolder(
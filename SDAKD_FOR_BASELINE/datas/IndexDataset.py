@@ -1,17 +1,40 @@
+import random
+import zlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader, Dataset
 
 
+def aug_seed_hash(item, view, seed=0):
+    """
+    deterministic seed of the view-th random transform of sample item
+    """
+    return zlib.crc32(f"{seed}-{item}-{view}".encode()) & 0x7FFFFFFF
+
+
 class IndexDataset(Dataset):
-    def __init__(self, dataset):
+    def __init__(self, dataset, aug_views=0, aug_seed=0):
         super(IndexDataset, self).__init__()
         self.dataset = dataset
+        # TODO: when aug_views > 0, every sample only has aug_views replayable random transforms
+        self.aug_views = aug_views
+        self.aug_seed = aug_seed
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, item):
-        image, label = self.dataset[item]
-        return item, image, label
+        if self.aug_views <= 0:
+            image, label = self.dataset[item]
+            return item, image, label
+        view = random.randrange(self.aug_views)
+        state = random.getstate()
+        with torch.random.fork_rng(devices=[]):
+            seed = aug_seed_hash(item, view, self.aug_seed)
+            random.seed(seed)
+            torch.manual_seed(seed)
+            image, label = self.dataset[item]
+        random.setstate(state)
+        return torch.LongTensor([item, view]), image, label
@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torchvision
+
+
+def _cache_dir():
+    # TODO: kept outside the dataset root, an extra directory there would become an ImageFolder class
+    return os.environ.get("LABEL_INDEX_CACHE", os.path.expanduser("~/.cache/llacd/label_index"))
+
+
+def _save_npz(path, **arrays):
+    """
+    write through a temporary file and rename, so concurrent ranks never read a partial file.
+    an unwritable cache directory only disables the persisted copy.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"can not persist {path}: {e}")
+
+
+def dataset_labels(dataset):
+    """
+    targets of dataset as an int64 array without decoding or transforming any image,
+    Subset and wrappers holding org_dataset / dataset are followed down to the base dataset
+    """
+    if isinstance(dataset, torch.utils.data.Subset):
+        return dataset_labels(dataset.dataset)[np.asarray(dataset.indices)]
+    if hasattr(dataset, "targets"):
+        return np.asarray(dataset.targets, dtype=np.int64)
+    for attr in ["org_dataset", "dataset"]:
+        if hasattr(dataset, attr):
+            return dataset_labels(getattr(dataset, attr))
+    # TODO: no label attribute, fall back to a full pass
+    return np.asarray([dataset[i][1] for i in range(len(dataset))], dtype=np.int64)
+
+
+def stratified_split(labels, test_size, persist=True, random_state=0):
+    """
+    StratifiedShuffleSplit of labels, the indices are persisted in the label index cache
+    keyed by the labels, the test size and the seed, and reused by every later launch
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    key = hashlib.md5(labels.tobytes() + f"{test_size}-{random_state}".encode()).hexdigest()[:16]
+    path = None
+    if persist:
+        path = os.path.join(_cache_dir(), f"split_{key}.npz")
+        if os.path.exists(path):
+            split = np.load(path)
+            return split["train"], split["valid"]
+    from sklearn.model_selection import StratifiedShuffleSplit
+
+    ss = StratifiedShuffleSplit(n_splits=1, test_size=test_size, random_state=random_state)
+    train_indices, valid_indices = list(ss.split(np.zeros((labels.shape[0], 1)), labels))[0]
+    if path is not None:
+        _save_npz(path, train=train_indices, valid=valid_indices)
+    return train_indices, valid_indices
+
+
+class IndexedImageFolder(torchvision.datasets.ImageFolder):
+    """
+    ImageFolder whose (path, target) list is read from a .npz sidecar keyed by the root and the
+    mtimes of its class directories, the tree is only scanned again when a class directory changed
+    """
+
+    def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None, **kwargs):
+        directory = os.path.expanduser(directory)
+        classes = sorted(class_to_idx.keys())
+        mtimes = [os.stat(os.path.join(directory, name)).st_mtime_ns for name in classes]
+        key = f"{os.path.abspath(directory)}-{classes}-{mtimes}-{extensions}"
+        key = hashlib.md5(key.encode()).hexdigest()[:16]
+        path = os.path.join(_cache_dir(), f"samples_{key}.npz")
+        if is_valid_file is None and os.path.exists(path):
+            index = np.load(path)
+            return [
+                (os.path.join(directory, relative), int(target))
+                for relative, target in zip(index["paths"].tolist(), index["targets"].tolist())
+            ]
+        samples = super(IndexedImageFolder, self).make_dataset(
+            directory, class_to_idx, extensions=extensions, is_valid_file=is_valid_file, **kwargs
+        )
+        if is_valid_file is None:
+            _save_npz(
+                path,
+                paths=np.array([os.path.relpath(p, directory) for p, _ in samples]),
+                targets=np.array([t for _, t in samples], dtype=np.int64),
+            )
+        return samples
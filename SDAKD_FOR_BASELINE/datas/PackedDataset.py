@@ -0,0 +1,197 @@
+"""
+pack a PIL dataset into one contiguous uint8 file plus an offset index
+python -m datas.PackedDataset --dataset CIFAR100 --root /data/cifar100 --output /data/packed/cifar100
+python -m datas.PackedDataset --dataset ImageNet --root /data/imagenet --output /data/packed/imagenet
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+
+from .IndexDataset import IndexDataset
+
+CIFAR_MEAN, CIFAR_STD = [0.5071, 0.4867, 0.4408], [0.2675, 0.2565, 0.2761]
+IMAGENET_MEAN, IMAGENET_STD = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+
+def dataset_mean_std(dataset_type):
+    if dataset_type == "CIFAR":
+        return CIFAR_MEAN, CIFAR_STD
+    return IMAGENET_MEAN, IMAGENET_STD
+
+
+class _Decode(Dataset):
+    """
+    decode, convert to RGB and optionally resize in the DataLoader workers of pack_dataset
+    """
+
+    def __init__(self, dataset, transform=None):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        image, target = self.dataset[item]
+        image = image.convert("RGB")
+        if self.transform is not None:
+            image = self.transform(image)
+        return np.asarray(image, dtype=np.uint8), int(target)
+
+
+def pack_dataset(dataset, path, transform=None, num_workers=8):
+    """
+    dataset yields (PIL image, target) with its transform disabled, transform is a PIL resize/crop
+    applied once here. writes {path}.bin with the HWC uint8 pixels of every sample back to back
+    and {path}.idx.npy with one (offset, height, width, target) row per sample
+    """
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    loader = DataLoader(
+        _Decode(dataset, transform),
+        batch_size=None,
+        shuffle=False,
+        num_workers=num_workers,
+    )
+    index = np.zeros((len(dataset), 4), dtype=np.int64)
+    offset = 0
+    with open(path + ".bin", "wb") as f:
+        for i, (image, target) in enumerate(loader):
+            image = np.asarray(image, dtype=np.uint8)
+            f.write(np.ascontiguousarray(image).tobytes())
+            index[i] = (offset, image.shape[0], image.shape[1], target)
+            offset += image.size
+            if i % 10000 == 0:
+                print(f"pack {path}: {i}/{len(dataset)}")
+    np.save(path + ".idx.npy", index)
+
+
+class PackedDataset(Dataset):
+    """
+    Read a pack_dataset file: every item is a uint8 (C, H, W) tensor viewed from the memory map,
+    transform works on uint8 tensors (crop/flip/resize), ToTensor and Normalize are left to the
+    device, see LearnDiversifyEnv.normalize_batch.
+    """
+
+    def __init__(self, path, transform=None):
+        super(PackedDataset, self).__init__()
+        self.path = path
+        self.transform = transform
+        self.index = np.load(path + ".idx.npy")
+        self.data = None  # opened lazily, once per worker
+
+    @property
+    def targets(self):
+        return self.index[:, 3]
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, item):
+        if self.data is None:
+            self.data = np.memmap(self.path + ".bin", dtype=np.uint8, mode="r")
+        offset, h, w, target = self.index[item]
+        image = np.array(self.data[offset: offset + h * w * 3]).reshape(h, w, 3)
+        image = torch.from_numpy(image).permute(2, 0, 1).contiguous()
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(target)
+
+
+def Packed_DataLoader_C100(data_path, num_worker, train_batch_size=64, test_batch_size=64):
+    """
+    Original_DataLoader_C100 over the packed train/test files under data_path
+    """
+    trainset = IndexDataset(
+        PackedDataset(
+            os.path.join(data_path, "train"),
+            transforms.Compose(
+                [
+                    transforms.RandomCrop(32, padding=4),
+                    transforms.RandomHorizontalFlip(),
+                ]
+            ),
+        )
+    )
+    testset = PackedDataset(os.path.join(data_path, "test"))
+    train_sampler = torch.utils.data.distributed.DistributedSampler(trainset)
+    trainloader = torch.utils.data.DataLoader(
+        trainset,
+        batch_size=train_batch_size,
+        sampler=train_sampler,
+        num_workers=num_worker,
+        pin_memory=(torch.cuda.is_available()),
+    )
+    test_sampler = torch.utils.data.distributed.DistributedSampler(testset)
+    testloader = torch.utils.data.DataLoader(
+        testset,
+        batch_size=test_batch_size,
+        sampler=test_sampler,
+        num_workers=num_worker,
+        pin_memory=(torch.cuda.is_available()),
+    )
+    return trainloader, testloader
+
+
+def Packed_DataLoader_ImageNet(data_path, num_worker, train_batch_size=64, test_batch_size=64):
+    """
+    Original_DataLoader_ImageNet over the packed train/val files under data_path,
+    train images are stored with the shorter side resized to 256, val images center cropped to 224
+    """
+    trainset = IndexDataset(
+        PackedDataset(
+            os.path.join(data_path, "train"),
+            transforms.Compose(
+                [
+                    transforms.RandomResizedCrop(224, antialias=True),
+                    transforms.RandomHorizontalFlip(),
+                ]
+            ),
+        )
+    )
+    testset = PackedDataset(os.path.join(data_path, "val"))
+    train_sampler = torch.utils.data.distributed.DistributedSampler(trainset)
+    trainloader = torch.utils.data.DataLoader(
+        trainset,
+        batch_size=train_batch_size,
+        sampler=train_sampler,
+        num_workers=num_worker,
+        pin_memory=True,
+    )
+    test_sampler = torch.utils.data.distributed.DistributedSampler(testset)
+    testloader = torch.utils.data.DataLoader(
+        testset,
+        batch_size=test_batch_size,
+        sampler=test_sampler,
+        num_workers=num_worker,
+        pin_memory=True,
+    )
+    return trainloader, testloader
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pack a dataset into uint8 memory-mapped files")
+    parser.add_argument("--dataset", type=str, default="CIFAR100", choices=["CIFAR100", "ImageNet"])
+    parser.add_argument("--root", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+    if args.dataset == "CIFAR100":
+        for split, train in [("train", True), ("test", False)]:
+            dataset = torchvision.datasets.CIFAR100(root=args.root, train=train, download=True)
+            pack_dataset(dataset, os.path.join(args.output, split), num_workers=args.num_workers)
+    else:
+        splits = [
+            ("train", transforms.Resize(256)),
+            ("val", transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224)])),
+        ]
+        for split, transform in splits:
+            dataset = torchvision.datasets.ImageFolder(os.path.join(args.root, split))
+            pack_dataset(
+                dataset, os.path.join(args.output, split), transform, num_workers=args.num_workers
+            )
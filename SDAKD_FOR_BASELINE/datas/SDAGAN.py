@@ -6,6 +6,7 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from datas.Augmention import Mulit_Augmentation
 from datas.pretrain.CIFAR100_color import run_cifar100_color
 from datas.pretrain.CIFAR100_stn import run_cifar100_stn
+from datas.pretrain.engine import run_distributed_pretrain
 from datas.pretrain.ImageNet_color import run_imagenet_color
 from datas.pretrain.ImageNet_stn import run_imagenet_stn
 
@@ -96,15 +97,65 @@ class AugmentationFeatureEncoder(nn.Module):
         return self.classifier(out_feature)
 
 
+class AugmentPrefetcher:
+    """
+    Double-buffered augmentation with the frozen SDA: batch k+1 is moved to the device and
+    augmented on a side CUDA stream while the caller trains on batch k. The hand-off is synchronised by a CUDA event recorded on the side stream.
+    Only valid while the SDA parameters are not updated, i.e. outside the convertor epochs.
+    """
+
+    def __init__(self, dataloader, prepare, augment, gpu=None):
+        self.dataloader = dataloader
+        self.prepare = prepare
+        self.augment = augment
+        self.stream = torch.cuda.Stream(device=gpu)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _load(self, batch):
+        index, input, target = batch
+        input, target, *extra = self.prepare(input, target)
+        augment_input, augment_target = self.augment(input, target, *extra)
+        return index, input, target, augment_input, augment_target
+
+    def _preload(self, loader):
+        try:
+            batch = next(loader)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            result = self._load(batch)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return result, event
+
+    def __iter__(self):
+        loader = iter(self.dataloader)
+        next_batch = self._preload(loader)
+        while next_batch is not None:
+            result, event = next_batch
+            torch.cuda.current_stream().wait_event(event)
+            for tensor in result:
+                if isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+                    tensor.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(loader)
+            yield result
+
+
 class SDAGenerator:
     def __init__(self, yaml, gpu):
         self.lr = yaml["SDA"]["lr"]
         self.gpu = gpu
+        self.yaml = yaml
+        # TODO: the surrogates must exist before Mulit_Augmentation loads them
+        self.pretrain()
         self.SDA = DDP(
             Mulit_Augmentation(
                 pretrain_path=yaml["SDA"]["pretrain_path"],
                 dataset_type=yaml["SDA"]["dataset_type"],
                 solve_number=yaml["SDA"]["solve_number"],
+                fused=yaml["SDA"]["fused"] if "fused" in yaml["SDA"] else False,
             ).cuda(gpu),
             device_ids=[gpu],
             find_unused_parameters=True if yaml["SDA"]["solve_number"] <= 2 else False,
@@ -115,7 +166,8 @@ class SDAGenerator:
         self.scheduler = ALRS(self.optimizer)
         self.scaler = torch.cuda.amp.GradScaler()
         self.num_classes = yaml["num_classes"]
-        self.pretrain()
+        # TODO: > 1 trains the convertor on micro-batches, see memory_efficient_step
+        self.convertor_chunks = yaml["SDA"]["convertor_chunks"] if "convertor_chunks" in yaml["SDA"] else 1
 
     def reset(self):
         del self.scaler
@@ -125,37 +177,40 @@ class SDAGenerator:
         self.scheduler = ALRS(self.optimizer)
         self.scaler = torch.cuda.amp.GradScaler()
 
-    def __call__(self, student, teacher, x, y, if_learning=True, if_afe=False):
-        augment_x, augment_y = self.step(student, teacher, x, y, if_learning)
+    def __call__(self, student, teacher, x, y, if_learning=True, if_afe=False, x_uint8=None):
+        """
+        x_uint8: the uint8 batch x was normalised from, if any, shared with the no-learning ops
+        """
+        augment_x, augment_y = self.step(student, teacher, x, y, if_learning, x_uint8)
         return augment_x, augment_y, self.loss_s, self.loss_t
 
-    def step(self, student, teacher, x, y, if_learning):
+    def step(self, student, teacher, x, y, if_learning, x_uint8=None):
         self.loss_t = 0
         self.loss_s = 0
 
-        if not self.yaml["only_stage_one"] and if_learning:
+        if not self.yaml["only_stage_one"] and if_learning and self.convertor_chunks > 1:
+            augment_x, augment_y = self.memory_efficient_step(student, teacher, x, y, x_uint8)
+        elif not self.yaml["only_stage_one"] and if_learning:
             student.eval()
             student.requires_grad_(False)
             augment_x = x.clone()
             augment_y = y.clone()
             augment_x.requires_grad = True
-            augment_x = self.SDA(augment_x)
+            augment_x = self.SDA(augment_x, x_uint8)
             student_out = student(augment_x)
-            if "convnext" in self.yaml["tarch"] or "swin" in self.yaml["tarch"]:
-                teacher_tuple, teacher_out = teacher(augment_x)
-            else:
-                teacher_tuple, teacher_out = teacher(augment_x, is_feat=True)
-            self.aug_stduent_logits_confidence = student_out.softmax(1)[y.bool()].mean().item()
-            self.aug_teacher_logits_confidence = teacher_out.softmax(1)[y.bool()].mean().item()
+            teacher_out = self.teacher_logits(teacher, augment_x)
+            # TODO: keep the statistics on device, they are moved to host by the metric flush
+            self.aug_stduent_logits_confidence = student_out.detach().softmax(1)[y.bool()].mean()
+            self.aug_teacher_logits_confidence = teacher_out.detach().softmax(1)[y.bool()].mean()
             loss_t, loss_s = self.criticion(student_out, teacher_out, augment_y)
             self.optimizer.zero_grad()
             loss = loss_s + loss_t
             self.scaler.scale(loss).backward()
             self.scaler.step(self.optimizer)
             self.scaler.update()
-            self.loss = loss.item()
-            self.loss_t = loss_t.item()
-            self.loss_s = loss_s.item()
+            self.loss = loss.detach()
+            self.loss_t = loss_t.detach()
+            self.loss_s = loss_s.detach()
             # give back
             student.train()
             student.requires_grad_(True)
@@ -163,10 +218,62 @@ class SDAGenerator:
             self.loss = 0.0
         if not if_learning:
             with torch.no_grad():
-                augment_x = self.SDA.module(x.clone())
+                augment_x = self.SDA.module(x.clone(), x_uint8)
                 augment_y = y.clone()
         return augment_x.detach(), augment_y.detach()
 
+    def teacher_logits(self, teacher, x):
+        if "convnext" in self.yaml["tarch"] or "swin" in self.yaml["tarch"]:
+            teacher_tuple, teacher_out = teacher(x)
+        else:
+            teacher_tuple, teacher_out = teacher(x, is_feat=True)
+        return teacher_out
+
+    def memory_efficient_step(self, student, teacher, x, y, x_uint8=None):
+        """
+        step(if_learning=True) with bounded activation memory: the SDA runs once on the whole batch, the
+        gradient of the loss w.r.t. its output is accumulated over convertor_chunks micro-batches, the
+        teacher and the student each forward and backward one micro-batch at a time (t_loss only depends
+        on the teacher, s_loss only on the student), and the SDA gets it as one vector-Jacobian product.
+        """
+        student.eval()
+        student.requires_grad_(False)
+        augment_x = x.clone()
+        augment_y = y.clone()
+        augment_x.requires_grad = True
+        augment_x = self.SDA(augment_x, x_uint8)
+        leaf_x = augment_x.detach().requires_grad_(True)
+        loss_t, loss_s = 0.0, 0.0
+        student_confidence, teacher_confidence = [], []
+        for index in torch.arange(x.shape[0], device=x.device).chunk(self.convertor_chunks):
+            chunk_y = augment_y[index]
+            # the criticion averages over the labels of the batch, a micro-batch is weighted by its share
+            weight = chunk_y.bool().sum() / augment_y.bool().sum()
+            teacher_out = self.teacher_logits(teacher, leaf_x[index])
+            chunk_loss_t, _ = self.criticion(teacher_out, teacher_out, chunk_y)
+            self.scaler.scale(chunk_loss_t * weight).backward()
+            student_out = student(leaf_x[index])
+            _, chunk_loss_s = self.criticion(student_out, student_out, chunk_y)
+            self.scaler.scale(chunk_loss_s * weight).backward()
+            teacher_confidence.append(teacher_out.detach().softmax(1)[chunk_y.bool()])
+            student_confidence.append(student_out.detach().softmax(1)[chunk_y.bool()])
+            loss_t = loss_t + chunk_loss_t.detach() * weight
+            loss_s = loss_s + chunk_loss_s.detach() * weight
+            del teacher_out, student_out
+        self.aug_stduent_logits_confidence = torch.cat(student_confidence).mean()
+        self.aug_teacher_logits_confidence = torch.cat(teacher_confidence).mean()
+        self.optimizer.zero_grad()
+        augment_x.backward(leaf_x.grad)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.loss = loss_t + loss_s
+        self.loss_t = loss_t
+        self.loss_s = loss_s
+        # give back
+        student.train()
+        student.requires_grad_(True)
+        return augment_x, augment_y
+
     def quick_step(self, input, target, teacher_model, student_model):
         if target.ndim == 2 and target.shape[1] == 1:
             target = F.one_hot(target, num_classes=self.num_classes).float()
@@ -184,7 +291,7 @@ class SDAGenerator:
         total_ne_t_ce_loss = 0
         total_ne_s_ce_loss = 0
         total_sample = 0
-        for batch_idx, (samples, targets) in enumerate(dataloader):
+        for batch_idx, (samples, targets, *_) in enumerate(dataloader):
             samples = samples.cuda(non_blocking=True)
             targets = targets.cuda(non_blocking=True)
             samples, targets = mixup_fn(samples, targets)
@@ -194,8 +301,8 @@ class SDAGenerator:
             total_ne_t_ce_loss += ne_t_ce_loss * samples.shape[0]
             total_ne_s_ce_loss += ne_s_ce_loss * samples.shape[0]
             total_sample += samples.shape[0]
-        total_ne_t_ce_loss = total_ne_t_ce_loss / total_sample
-        total_ne_s_ce_loss = total_ne_s_ce_loss / total_sample
+        total_ne_t_ce_loss = float(total_ne_t_ce_loss / total_sample)
+        total_ne_s_ce_loss = float(total_ne_s_ce_loss / total_sample)
 
         self.scheduler.step(total_ne_s_ce_loss + total_ne_t_ce_loss)
         print(
@@ -204,14 +311,23 @@ class SDAGenerator:
         )
 
     def quick_multi_epoch(
-        self, dataloader, teacher_model, student_model, epoch_number=1, mixup_fn=None
+        self, dataloader, teacher_model, student_model, epoch_number=1, mixup_fn=None, sampler_epoch=None
     ):
+        """
+        with sampler_epoch, pass i first calls dataloader.sampler.set_epoch(sampler_epoch + i),
+        e.g. to draw a new convertor coreset every pass
+        """
         self.reset()
         for i in range(epoch_number):
+            if sampler_epoch is not None:
+                dataloader.sampler.set_epoch(sampler_epoch + i)
             self.quick_epoch(dataloader, teacher_model, student_model, mixup_fn)
 
     def pretrain(self):
-        if self.yaml["SDA"]["dataset_type"] == "CIFAR":
+        if "pretrain_engine" in self.yaml["SDA"] and self.yaml["SDA"]["pretrain_engine"] == True:
+            # TODO: all surrogates in one data pass, sharded over the ranks and resumable
+            run_distributed_pretrain(self.yaml, self.gpu)
+        elif self.yaml["SDA"]["dataset_type"] == "CIFAR":
             run_cifar100_stn(self.yaml)
             run_cifar100_color(self.yaml)
         else:
@@ -18,6 +18,8 @@ from torchvision.transforms.autoaugment import (
     Tensor,
 )
 
+from datas.TargetCache import AlignmentTargetCache
+
 
 class Normalize(nn.Module):
     def __init__(self):
@@ -135,7 +137,7 @@ class FreezeSTN(nn.Module):
         prob = relaxed_bernoulli(logits, temp, device=logits.device)
         return (1 - prob) * self.i_matrix + prob * A
 
-    def forward(self, x, magnitude, rg=True):
+    def matrix(self, x, magnitude, rg=True):
         if isinstance(magnitude, (float, int)):
             magnitude = torch.Tensor([magnitude]).to(x.device)
             magnitude = magnitude.view(1, -1).expand(x.shape[0], -1)
@@ -146,15 +148,33 @@ class FreezeSTN(nn.Module):
         H = self.fc(H).view(-1, 2, 3)
         if rg == True:
             H = self.sample(H)
+        return H
+
+    def forward(self, x, magnitude, rg=True):
+        H = self.matrix(x, magnitude, rg)
         grid = torch.nn.functional.affine_grid(H, x.size())
         x = torch.nn.functional.grid_sample(x, grid)
         return x
 
 
 class Alignment:
-    def __init__(self, policy_name, img_size, save_path, STN, dataset_type, epoch=10):
+    def __init__(
+        self,
+        policy_name,
+        img_size,
+        save_path,
+        STN,
+        dataset_type,
+        epoch=10,
+        target_cache=None,
+        target_cache_views=1,
+    ):
         self.policy_name = policy_name
         self.img_size = img_size
+        self.dataset_type = dataset_type
+        # TODO: directory of the memory-mapped target cache, None to recompute every epoch
+        self.target_cache = target_cache
+        self.target_cache_views = target_cache_views
         self.stn = STN().cuda()
         self.epoch = epoch
         self.optimizer = torch.optim.AdamW(self.stn.parameters(), 1e-3)
@@ -191,46 +211,89 @@ class Alignment:
             "Invert": (torch.tensor(0.0), False),
         }
 
+    def _draw(self, image, augmentation_space):
+        """
+        (magnitude fed to the surrogate, torchvision magnitude, magnitude bin, sign) of one batch
+        """
+        magnitude = random.random()
+        magnitudes, signed = augmentation_space[self.policy_name]
+        magnitude_id = min(max(int(magnitude * 10), 0), 9)
+        if magnitudes.numel() > 0:
+            magnitude_new = float(magnitudes[magnitude_id].item())
+        else:
+            magnitude_new = 0.0
+        sign = int(signed and torch.randint(2, (1,)).item())
+
+        if sign:
+            magnitude_new *= -1.0
+            magnitude *= -1.0
+        magnitude = (
+            torch.Tensor([magnitude]).to(image.device)[None, ...].expand(image.shape[0], -1)
+        )
+        return magnitude, magnitude_new, magnitude_id, sign
+
+    def _target(self, image, augmentation_space):
+        magnitude, magnitude_new, _, _ = self._draw(image, augmentation_space)
+        return magnitude, self._freeze(image, magnitude_new)
+
+    def _freeze(self, image, magnitude_new):
+        _image = image.mul(torch.Tensor(self.std)[None, :, None, None].cuda()).add(
+            torch.Tensor(self.mean)[None, :, None, None].cuda()
+        )
+        _image = _image * 255
+        _image = torch.floor(_image + 0.5)
+        torch.clip_(_image, 0, 255)
+        _image = _image.type(torch.uint8)
+        freeze_image = _apply_op(
+            _image,
+            self.policy_name,
+            magnitude_new,
+            interpolation=InterpolationMode.NEAREST,
+            fill=None,
+        )
+        return self.tran(freeze_image / 255).float()
+
+    def _step(self, i, j, image, magnitude, freeze_image):
+        stn_image = self.stn(image, magnitude, False)
+        loss = self.criticion(stn_image, freeze_image)
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        self.scheduler.step()
+        print(f"epoch = {i}, iter = {j}, loss = {round(loss.item(), 3)}")
+
     def fit(self, dataloader):
 
         augmentation_space = self._augmentation_space(10, self.img_size)
         self.stn.train()
+        cache = None
+        if self.target_cache is not None:
+            image, _ = dataloader.dataset[0]
+            cache = AlignmentTargetCache(
+                self.target_cache,
+                self.policy_name,
+                self.dataset_type,
+                len(dataloader.dataset),
+                tuple(image.shape),
+                views=self.target_cache_views,
+            )
         for i in range(self.epoch):
-            for j, (image, _) in enumerate(dataloader):
-                image = image.cuda()
-                magnitude = random.random()
-                magnitudes, signed = augmentation_space[self.policy_name]
-                magnitude_id = min(max(int(magnitude * 10), 0), 9)
-                if magnitudes.numel() > 0:
-                    magnitude_new = float(magnitudes[magnitude_id].item())
-                else:
-                    magnitude_new = 0.0
-                sign = torch.randint(2, (1,))
-                if signed and sign:
-                    magnitude_new *= -1.0
-                    magnitude *= -1.0
-                _image = image.mul(torch.Tensor(self.std)[None, :, None, None].cuda()).add(
-                    torch.Tensor(self.mean)[None, :, None, None].cuda()
-                )
-                _image = _image * 255
-                _image = torch.floor(_image + 0.5)
-                torch.clip_(_image, 0, 255)
-                _image = _image.type(torch.uint8)
-                freeze_image = _apply_op(
-                    _image,
-                    self.policy_name,
-                    magnitude_new,
-                    interpolation=InterpolationMode.NEAREST,
-                    fill=None,
-                )
-                freeze_image = self.tran(freeze_image / 255).float()
-                stn_image = self.stn(image, magnitude, False)
-                loss = self.criticion(stn_image, freeze_image)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                self.scheduler.step()
-                print(f"epoch = {i}, iter = {j}, loss = {round(loss.item(), 3)}")
+            view = i % self.target_cache_views
+            if cache is not None:
+                # the stored input of every image, the targets of its drawn (bin, sign) are computed once
+                for j, (index, image, _) in enumerate(cache.loader(dataloader)):
+                    image = cache.inputs(view, index, image.cuda(non_blocking=True))
+                    magnitude, magnitude_new, magnitude_id, sign = self._draw(image, augmentation_space)
+                    freeze_image = cache.targets(
+                        view, index, magnitude_id, sign, image, lambda x: self._freeze(x, magnitude_new)
+                    )
+                    self._step(i, j, image, magnitude, freeze_image)
+                cache.flush()
+            else:
+                for j, (image, _) in enumerate(dataloader):
+                    image = image.cuda()
+                    magnitude, freeze_image = self._target(image, augmentation_space)
+                    self._step(i, j, image, magnitude, freeze_image)
             torch.save(self.stn.state_dict(), self.save_path)
 
 
@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+
+from datas.IndexDataset import IndexDataset
+
+
+class AlignmentTargetCache:
+    """
+    Memory-mapped fp16 store of the torchvision targets of one Alignment policy, keyed by
+    (view, image, magnitude bin, sign). Every image keeps the input of the first epoch of each of
+    the `views` input views (crop/flip frozen), the magnitude is still drawn every batch and the
+    target of a (bin, sign) is computed the first time it is drawn for that input, later draws read
+    it back instead of re-running the augmentation and the de-normalise/re-normalise round trip.
+
+    Rank 0 creates and fills the store, the other ranks wait for the files, read the entries rank 0
+    has flushed and compute the missing ones without writing them. The files are sparse, only the
+    drawn keys take disk space. New entries are only marked done by flush() (once per epoch, every
+    key is drawn at most once per epoch and view), after their inputs and targets reached the disk.
+    """
+
+    def __init__(self, path, policy_name, dataset_type, dataset_len, img_shape, views=1, num_bins=10):
+        self.views = views
+        self.dataset_len = dataset_len
+        distributed = dist.is_available() and dist.is_initialized()
+        self.writer = not distributed or dist.get_rank() == 0
+        prefix = os.path.join(path, f"{policy_name}_{dataset_type}_{dataset_len}_{views}_{num_bins}")
+        self.paths = {
+            "input": prefix + "_input.npy",
+            "input_done": prefix + "_input_done.npy",
+            "target": prefix + "_target.npy",
+            "done": prefix + "_done.npy",
+        }
+        shapes = {
+            "input": ((views, dataset_len, *img_shape), np.float16),
+            "input_done": ((views, dataset_len), np.uint8),
+            "target": ((views, num_bins, 2, dataset_len, *img_shape), np.float16),
+            "done": ((views, num_bins, 2, dataset_len), np.uint8),
+        }
+        if self.writer and not all(os.path.exists(p) for p in self.paths.values()):
+            os.makedirs(path, exist_ok=True)
+            for key, (shape, dtype) in shapes.items():
+                # written under a temporary name, a crash never leaves a truncated store behind
+                tmp_path = f"{self.paths[key]}.{os.getpid()}.tmp.npy"
+                array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+                array.flush()
+                del array
+                os.replace(tmp_path, self.paths[key])
+        if distributed:
+            dist.barrier()
+        mode = "r+" if self.writer else "r"
+        self.arrays = {key: np.load(p, mmap_mode=mode) for key, p in self.paths.items()}
+        self.pending = []
+
+    def loader(self, dataloader):
+        """
+        dataloader over (index, image, label) with the batch size and workers of dataloader
+        """
+        return DataLoader(
+            IndexDataset(dataloader.dataset),
+            batch_size=dataloader.batch_size,
+            shuffle=True,
+            num_workers=dataloader.num_workers,
+            pin_memory=torch.cuda.is_available(),
+        )
+
+    def inputs(self, view, index, image):
+        """
+        replace every image of the batch by its stored input of view, store the new ones
+        """
+        index = index.numpy()
+        image = image.half().float()
+        stored = self.arrays["input_done"][view, index].astype(bool)
+        if stored.any():
+            image[torch.from_numpy(stored).to(image.device)] = torch.from_numpy(
+                np.array(self.arrays["input"][view, index[stored]])
+            ).to(image.device, image.dtype)
+        if self.writer and not stored.all():
+            rows = index[~stored]
+            new = torch.from_numpy(~stored).to(image.device)
+            self.arrays["input"][view, rows] = image[new].half().cpu().numpy()
+            self.pending.append(("input_done", (view, rows)))
+        return image
+
+    def targets(self, view, index, magnitude_id, sign, image, compute):
+        """
+        targets of (view, index, magnitude_id, sign), compute(image) fills and stores the missing ones
+        """
+        index = index.numpy()
+        done = self.arrays["done"][view, magnitude_id, sign, index].astype(bool)
+        target = torch.empty_like(image)
+        if done.any():
+            target[torch.from_numpy(done).to(image.device)] = torch.from_numpy(
+                np.array(self.arrays["target"][view, magnitude_id, sign, index[done]])
+            ).to(image.device, image.dtype)
+        if not done.all():
+            missing = torch.from_numpy(~done).to(image.device)
+            target[missing] = compute(image[missing])
+            if self.writer:
+                rows = index[~done]
+                self.arrays["target"][view, magnitude_id, sign, rows] = target[missing].half().cpu().numpy()
+                self.pending.append(("done", (view, magnitude_id, sign, rows)))
+        return target
+
+    def flush(self):
+        """
+        write the new inputs and targets, then mark them done, a crash never marks a lost entry
+        """
+        if not self.writer or len(self.pending) == 0:
+            return
+        self.arrays["input"].flush()
+        self.arrays["target"].flush()
+        for key, index in self.pending:
+            self.arrays[key][index] = 1
+        self.arrays["input_done"].flush()
+        self.arrays["done"].flush()
+        self.pending = []
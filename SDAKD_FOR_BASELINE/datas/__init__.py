@@ -6,6 +6,7 @@ from .ImageNet import (
     LR_Few_Shot_DataLoader_ImageNet,
     Original_DataLoader_ImageNet,
 )
+from .PackedDataset import Packed_DataLoader_C100, Packed_DataLoader_ImageNet
 
 __all__ = [
     "DataLoader_C100",
@@ -17,4 +18,6 @@ __all__ = [
     "Few_Shot_DataLoader_ImageNet",
     "LR_Few_Shot_DataLoader_ImageNet",
     "LargeResolution_Dataloader_ImageNet",
+    "Packed_DataLoader_C100",
+    "Packed_DataLoader_ImageNet",
 ]
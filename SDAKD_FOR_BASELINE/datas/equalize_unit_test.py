@@ -0,0 +1,57 @@
+import time
+import unittest
+
+import torch
+from torchvision.transforms import functional as F
+
+from datas.COLOR import batched_equalize
+
+
+class Test_BatchedEqualize(unittest.TestCase):
+    def setUp(self):
+        self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        # CIFAR and MS-COCO resolution
+        self.shapes = [(256, 3, 32, 32), (2, 3, 800, 1333)]
+
+    def test_equal_to_torchvision(self):
+        for shape in self.shapes:
+            input = torch.randint(0, 256, shape, dtype=torch.uint8, device=self.device)
+            input[0, 0] = 128  # a constant channel keeps its values
+            expected = torch.stack([F.equalize(image) for image in input])
+            self.assertTrue(torch.equal(expected, batched_equalize(input)))
+
+    def test_speed(self, times=20):
+        def synchronize():
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+
+        for shape in self.shapes:
+            input = torch.randint(0, 256, shape, dtype=torch.uint8, device=self.device)
+
+            def run_torchvision(t=times):
+                for _ in range(t):
+                    F.equalize(input)
+
+            def run_batched(t=times):
+                for _ in range(t):
+                    batched_equalize(input)
+
+            run_torchvision(1)
+            run_batched(1)
+            synchronize()
+            t1 = time.time()
+            run_torchvision()
+            synchronize()
+            t2 = time.time()
+            run_batched()
+            synchronize()
+            t3 = time.time()
+            print(
+                f"\nshape {shape}: torchvision {(t2 - t1) * 1000 / times:.3f} ms, "
+                f"batched {(t3 - t2) * 1000 / times:.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    unittest.main(verbosity=2)
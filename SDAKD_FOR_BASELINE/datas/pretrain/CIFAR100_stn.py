@@ -20,6 +20,10 @@ def run_cifar100_stn(yaml):
                 os.path.join(yaml["SDA"]["pretrain_path"], f"{Stn_Translate_List[index]}.pth"),
                 FreezeSTN,
                 dataset_type=yaml["SDA"]["dataset_type"],
+                target_cache=yaml["SDA"]["target_cache"] if "target_cache" in yaml["SDA"] else None,
+                target_cache_views=yaml["SDA"]["target_cache_views"]
+                if "target_cache_views" in yaml["SDA"]
+                else 1,
             )
             trainset = torchvision.datasets.CIFAR100(
                 root=yaml["data_path"],
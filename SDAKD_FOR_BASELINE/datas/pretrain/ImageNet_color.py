@@ -5,6 +5,7 @@ from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 from torchvision.datasets import CIFAR100
 
+from datas.LabelIndex import IndexedImageFolder, dataset_labels, stratified_split
 from datas.COLOR import Alignment, ColorAugmentation
 
 
@@ -20,9 +21,13 @@ def run_imagenet_color(yaml):
                 os.path.join(yaml["SDA"]["pretrain_path"], f"{Color_Translate_List[index]}.pth"),
                 ColorAugmentation,
                 dataset_type=yaml["SDA"]["dataset_type"],
+                target_cache=yaml["SDA"]["target_cache"] if "target_cache" in yaml["SDA"] else None,
+                target_cache_views=yaml["SDA"]["target_cache_views"]
+                if "target_cache_views" in yaml["SDA"]
+                else 1,
                 epoch=10,
             )
-            trainset = torchvision.datasets.ImageFolder(
+            trainset = IndexedImageFolder(
                 root=yaml["data_path"],
                 transform=transforms.Compose(
                     [
@@ -34,16 +39,12 @@ def run_imagenet_color(yaml):
                 ),
             )
 
-            import numpy as np
             import torch
-            from sklearn.model_selection import StratifiedShuffleSplit
 
             few_shot_ratio = 0.1
-            labels = trainset.targets
-            ss = StratifiedShuffleSplit(n_splits=1, test_size=1 - few_shot_ratio, random_state=0)
-            train_indices, valid_indices = list(ss.split(np.array(labels)[:, np.newaxis], labels))[
-                0
-            ]
+            train_indices, valid_indices = stratified_split(
+                dataset_labels(trainset), 1 - few_shot_ratio
+            )
             trainset = torch.utils.data.Subset(trainset, train_indices)
 
             train_dataloader = DataLoader(
@@ -0,0 +1,325 @@
+"""
+train all STN/Color augmentation surrogates in one data pass, resumable and shardable across devices
+python -m datas.pretrain.engine --config_file configs/{name} --devices cuda:0 cuda:1 cpu
+"""
+import argparse
+import os
+import random
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+import torchvision
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from torchvision.transforms.autoaugment import InterpolationMode
+
+from datas.COLOR import Alignment as ColorAlignment
+from datas.COLOR import ColorAugmentation, _apply_op
+from datas.LabelIndex import IndexedImageFolder, dataset_labels, stratified_split
+from datas.PackedDataset import dataset_mean_std
+from datas.STN import FreezeSTN
+
+STN_LIST = ["ShearX", "ShearY", "TranslateX", "TranslateY", "Rotate"]
+COLOR_LIST = ["Brightness", "Color", "Contrast", "Sharpness", "Posterize", "Solarize"]
+
+
+def pretrain_epochs(dataset_type):
+    # TODO: the same epochs as datas/pretrain/CIFAR100_* and ImageNet_*
+    if dataset_type == "CIFAR":
+        return {"STN": 10, "COLOR": 20}
+    return {"STN": 5, "COLOR": 10}
+
+
+def build_pretrain_dataloader(yaml, device, batch_size=64, num_workers=4):
+    mean, std = dataset_mean_std(yaml["SDA"]["dataset_type"])
+    if yaml["SDA"]["dataset_type"] == "CIFAR":
+        trainset = torchvision.datasets.CIFAR100(
+            root=yaml["data_path"],
+            train=True,
+            download=True,
+            transform=transforms.Compose(
+                [
+                    transforms.RandomCrop(32, padding=4),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    transforms.Normalize(mean, std),
+                ]
+            ),
+        )
+    else:
+        trainset = IndexedImageFolder(
+            root=yaml["data_path"],
+            transform=transforms.Compose(
+                [
+                    transforms.RandomResizedCrop(56),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    transforms.Normalize(mean, std),
+                ]
+            ),
+        )
+        few_shot_ratio = 0.1
+        train_indices, valid_indices = stratified_split(dataset_labels(trainset), 1 - few_shot_ratio)
+        trainset = torch.utils.data.Subset(trainset, train_indices)
+    return DataLoader(
+        trainset,
+        shuffle=True,
+        num_workers=num_workers,
+        batch_size=batch_size,
+        pin_memory=device.type == "cuda",
+    )
+
+
+def atomic_save(obj, path):
+    """
+    torch.save under a temporary name and rename, readers and resumes never see a half written file
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class PretrainEngine:
+    """
+    Train the surrogates of several ops together: every batch is loaded and de-normalised once,
+    each op draws its own magnitude and ground-truth target from the shared uint8 batch and the
+    per-op MSE losses are summed into one backward. After every epoch each op saves a resume
+    checkpoint (model, optimizer, scheduler, epoch) under pretrain_path/resume, and the final
+    {op}.pth consumed by Mulit_Augmentation is only written once the op finished all its epochs.
+    """
+
+    def __init__(self, yaml, op_names, device, log_each=100):
+        self.dataset_type = yaml["SDA"]["dataset_type"]
+        self.pretrain_path = yaml["SDA"]["pretrain_path"]
+        self.resume_path = os.path.join(self.pretrain_path, "resume")
+        self.device = device
+        self.log_each = log_each
+        self.img_size = [32, 32] if self.dataset_type == "CIFAR" else [56, 56]
+        mean, std = dataset_mean_std(self.dataset_type)
+        self.mean = torch.Tensor(mean)[None, :, None, None].to(device)
+        self.std = torch.Tensor(std)[None, :, None, None].to(device)
+        self.augmentation_space = ColorAlignment._augmentation_space(10, self.img_size)
+        epochs = pretrain_epochs(self.dataset_type)
+        self.ops = {}
+        for name in op_names:
+            if name in STN_LIST:
+                model = FreezeSTN().to(device)
+                optimizer = torch.optim.AdamW(model.parameters(), 1e-3)
+                total_epoch = epochs["STN"]
+            else:
+                model = ColorAugmentation(dataset_type=self.dataset_type).to(device)
+                optimizer = torch.optim.AdamW(model.parameters(), 1e-3, weight_decay=0)
+                total_epoch = epochs["COLOR"]
+            scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.999)
+            self.ops[name] = {
+                "model": model,
+                "optimizer": optimizer,
+                "scheduler": scheduler,
+                "epoch": 0,
+                "total_epoch": total_epoch,
+            }
+            self._resume(name)
+
+    def _resume(self, name):
+        path = os.path.join(self.resume_path, f"{name}.pth")
+        if not os.path.exists(path):
+            return
+        op = self.ops[name]
+        state = torch.load(path, map_location=self.device)
+        op["model"].load_state_dict(state["model"])
+        op["optimizer"].load_state_dict(state["optimizer"])
+        op["scheduler"].load_state_dict(state["scheduler"])
+        op["epoch"] = state["epoch"]
+        print(f"resume {name} from epoch {op['epoch']}")
+
+    def _save(self, name):
+        op = self.ops[name]
+        if not os.path.isdir(self.resume_path):
+            os.makedirs(self.resume_path, exist_ok=True)
+        atomic_save(
+            {
+                "epoch": op["epoch"],
+                "model": op["model"].state_dict(),
+                "optimizer": op["optimizer"].state_dict(),
+                "scheduler": op["scheduler"].state_dict(),
+            },
+            os.path.join(self.resume_path, f"{name}.pth"),
+        )
+        if op["epoch"] >= op["total_epoch"]:
+            state_dict = {k: v.cpu() for k, v in op["model"].state_dict().items()}
+            atomic_save(state_dict, os.path.join(self.pretrain_path, f"{name}.pth"))
+
+    def pre_tran(self, image):
+        _image = image.mul(self.std).add(self.mean)
+        _image = _image * 255
+        _image = torch.floor(_image + 0.5)
+        torch.clip_(_image, 0, 255)
+        return _image.type(torch.uint8)
+
+    def after_tran(self, image):
+        return image.float().div_(255).sub_(self.mean).div_(self.std)
+
+    def sample(self, name, image_uint8):
+        """
+        draw a magnitude as Alignment.fit does and build the ground-truth target of op name
+        """
+        magnitude = random.random()
+        magnitudes, signed = self.augmentation_space[name]
+        magnitude_id = min(max(int(magnitude * 10), 0), 9)
+        magnitude_new = float(magnitudes[magnitude_id].item())
+        sign = torch.randint(2, (1,))
+        if signed and sign:
+            magnitude_new *= -1.0
+            magnitude *= -1.0
+        target = _apply_op(
+            image_uint8, name, magnitude_new, interpolation=InterpolationMode.NEAREST, fill=None
+        )
+        return self.after_tran(target), magnitude
+
+    def fit(self, dataloader):
+        if len(self.ops) == 0:
+            return
+        start_epoch = min(op["epoch"] for op in self.ops.values())
+        end_epoch = max(op["total_epoch"] for op in self.ops.values())
+        for model in [op["model"] for op in self.ops.values()]:
+            model.train()
+        for epoch in range(start_epoch, end_epoch):
+            active = [
+                name
+                for name, op in self.ops.items()
+                if op["epoch"] == epoch and epoch < op["total_epoch"]
+            ]
+            if len(active) == 0:
+                continue
+            total_loss = {name: 0.0 for name in active}
+            for j, (image, _) in enumerate(dataloader):
+                image = image.to(self.device, non_blocking=True)
+                image_uint8 = self.pre_tran(image)
+                loss = 0.0
+                for name in active:
+                    target, magnitude = self.sample(name, image_uint8)
+                    magnitude = torch.full((image.shape[0], 1), magnitude, device=self.device)
+                    output = self.ops[name]["model"](image, magnitude, False)
+                    op_loss = F.mse_loss(output, target)
+                    total_loss[name] = total_loss[name] + op_loss.detach()
+                    loss = loss + op_loss
+                for name in active:
+                    self.ops[name]["optimizer"].zero_grad()
+                loss.backward()
+                for name in active:
+                    self.ops[name]["optimizer"].step()
+                    self.ops[name]["scheduler"].step()
+                if j % self.log_each == 0:
+                    print(f"epoch = {epoch}, iter = {j}, loss = {round(float(loss), 3)}")
+            for name in active:
+                self.ops[name]["epoch"] += 1
+                self._save(name)
+                print(f"{name}: epoch = {epoch}, loss = {round(float(total_loss[name]) / len(dataloader), 4)}")
+
+
+def pending_ops(yaml):
+    return [
+        name
+        for name in STN_LIST + COLOR_LIST
+        if not os.path.exists(os.path.join(yaml["SDA"]["pretrain_path"], f"{name}.pth"))
+    ]
+
+
+def run_pretrain_engine(yaml, op_names=None, shard_id=0, num_shards=1, device=None):
+    """
+    train the ops of shard shard_id out of num_shards on device
+    """
+    if device is None:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    device = torch.device(device)
+    if op_names is None:
+        op_names = pending_ops(yaml)
+    op_names = op_names[shard_id::num_shards]
+    if len(op_names) == 0:
+        return
+    print(f"shard {shard_id}/{num_shards} pretrains {op_names} on {device}")
+    engine = PretrainEngine(yaml, op_names, device)
+    engine.fit(build_pretrain_dataloader(yaml, device))
+
+
+def wait_for_ops(yaml, op_names, poll_seconds=30, stall_seconds=4 * 3600):
+    """
+    block until the final {op}.pth of every op in op_names is written. the owners save a resume
+    checkpoint every epoch, raise when none of the missing ops made progress for stall_seconds
+    (its rank most likely died)
+    """
+    pretrain_path = yaml["SDA"]["pretrain_path"]
+    last_progress = time.time()
+    while True:
+        missing = [
+            name for name in op_names if not os.path.exists(os.path.join(pretrain_path, f"{name}.pth"))
+        ]
+        if len(missing) == 0:
+            return
+        for name in missing:
+            resume = os.path.join(pretrain_path, "resume", f"{name}.pth")
+            if os.path.exists(resume):
+                last_progress = max(last_progress, os.path.getmtime(resume))
+        if time.time() - last_progress > stall_seconds:
+            raise RuntimeError(
+                f"no progress on the surrogates {missing} for {stall_seconds}s, restart to resume them"
+            )
+        time.sleep(poll_seconds)
+
+
+def run_distributed_pretrain(yaml, gpu):
+    """
+    shard the pending ops over the ranks of the initialised process group. the ranks only meet
+    again through the saved {op}.pth files, a collective would time out while the ranks with
+    more (or all) of the ops are still pretraining
+    """
+    if dist.is_available() and dist.is_initialized():
+        op_names = [pending_ops(yaml) if dist.get_rank() == 0 else None]
+        dist.broadcast_object_list(op_names, src=0)
+        op_names = op_names[0]
+        run_pretrain_engine(
+            yaml, op_names, dist.get_rank(), dist.get_world_size(), torch.device("cuda", gpu)
+        )
+        wait_for_ops(yaml, op_names)
+    else:
+        run_pretrain_engine(yaml, device=torch.device("cuda", gpu))
+
+
+def run_parallel_pretrain(yaml, devices):
+    """
+    one process per device, devices like ["cuda:0", "cuda:1", "cpu"]
+    """
+    op_names = pending_ops(yaml)
+    ctx = mp.get_context("spawn")
+    processes = [
+        ctx.Process(target=run_pretrain_engine, args=(yaml, op_names, i, len(devices), device))
+        for i, device in enumerate(devices)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    from omegaconf import OmegaConf
+
+    parser = argparse.ArgumentParser(description="pretrain SDA surrogates")
+    parser.add_argument(
+        "--config_file",
+        type=str,
+        default="./configs/wrn40_2_wrn16_2_c100_diversify.yaml",
+        help="path to configuration file",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        nargs="+",
+        default=["cuda:0" if torch.cuda.is_available() else "cpu"],
+        help="one shard of ops per device",
+    )
+    args = parser.parse_args()
+    run_parallel_pretrain(OmegaConf.load(args.config_file), args.devices)
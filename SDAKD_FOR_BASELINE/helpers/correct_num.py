@@ -1,3 +1,7 @@
+import torch
+import torch.distributed as dist
+
+
 def correct_num(output, target, topk=(1,)):
     """
     compute the top1 and top5
@@ -16,3 +20,55 @@ def correct_num(output, target, topk=(1,)):
         correct_k = correct[:k].contiguous().view(-1).float().sum(0, keepdim=True)
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
+
+
+def correct_count(output, target, topk=(1,)):
+    """
+    count the top-k correct samples, same matching rule as correct_num
+    """
+    maxk = max(topk)
+    _, pred = output.topk(maxk, 1, True, True)
+    pred = pred.t()
+    if target.shape != output.shape:
+        correct = pred.eq(target.view(1, -1).expand_as(pred))
+    else:
+        correct = pred.eq(target.argmax(1).view(1, -1).expand_as(pred))
+    return torch.stack([correct[:k].float().sum() for k in topk])
+
+
+class AccuracyMeter:
+    """
+    Deferred accuracy reduction: the top-k correct counts, the sample count and the summed loss
+    are accumulated on device, and all ranks are reduced with one all_reduce when reduce is called
+    (once per log interval or epoch). The result is the exact accuracy over all samples.
+    """
+
+    def __init__(self, device, topk=(1,)):
+        self.device = device
+        self.topk = topk
+        self.reset()
+
+    def reset(self):
+        # correct top-k..., samples, loss sum
+        self.state = torch.zeros(len(self.topk) + 2, device=self.device)
+
+    @torch.no_grad()
+    def update(self, output, target, loss=None):
+        batch_size = target.size(0)
+        count = correct_count(output, target, self.topk)
+        self.state[: len(self.topk)] += count
+        self.state[-2] += batch_size
+        if loss is not None:
+            self.state[-1] += loss.detach().float() * batch_size
+
+    @torch.no_grad()
+    def reduce(self):
+        """
+        return [top-k accuracy (%)..., mean loss] over all ranks as python floats
+        """
+        state = self.state.clone()
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(state, op=dist.ReduceOp.SUM)
+        samples = state[-2].clamp(min=1)
+        result = torch.cat([state[: len(self.topk)] * 100.0 / samples, state[-1:] / samples])
+        return result.tolist()
@@ -0,0 +1,164 @@
+import json
+import queue
+import threading
+
+import torch
+
+
+class NullSink:
+    """
+    drop every record, used for offline runs and non-zero ranks
+    """
+
+    def write(self, records):
+        pass
+
+    def close(self):
+        pass
+
+
+class WandbSink(NullSink):
+    def __init__(self, wandb):
+        self.wandb = wandb
+
+    def write(self, records):
+        for record in records:
+            record = dict(record)
+            step = record.pop("step")
+            self.wandb.log(record, step=step)
+
+    def close(self):
+        self.wandb.finish()
+
+
+class JsonlSink(NullSink):
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ConsoleSink(NullSink):
+    """
+    print the mean of every flushed window of records
+    """
+
+    def write(self, records):
+        if len(records) == 0:
+            return
+        sums, counts = {}, {}
+        for record in records:
+            for key, value in record.items():
+                if key == "step" or not isinstance(value, (int, float)):
+                    continue
+                if key.startswith("p_") or key.startswith("m_"):
+                    continue
+                sums[key] = sums.get(key, 0.0) + value
+                counts[key] = counts.get(key, 0) + 1
+        message = ", ".join(f"{key}: {sums[key] / counts[key]:.4f}" for key in sums)
+        print(f"step {records[-1]['step']}, {message}", flush=True)
+
+
+class Metrics:
+    """
+    Metric accumulation decoupled from the training step.
+    Tensor scalars (or vectors, logged as name_0, name_1, ...) stay on the device and are moved to
+    the host every flush_each steps with a single torch.cat(...).cpu(), the host records are then
+    handed to the sinks by a background thread. Without sinks every call is a no-op.
+    """
+
+    def __init__(self, sinks, flush_each=100):
+        self.sinks = sinks
+        self.flush_each = flush_each
+        self.enabled = len(sinks) > 0
+        self.pending = []
+        self.count = 0
+        if self.enabled:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def log(self, scalars, step):
+        if not self.enabled:
+            return
+        host, device = {}, {}
+        for name, value in scalars.items():
+            if isinstance(value, torch.Tensor):
+                device[name] = value.detach().float().view(-1)
+            else:
+                host[name] = value
+        self.pending.append((step, host, device))
+        self.count += 1
+        if self.count % self.flush_each == 0:
+            self.flush()
+
+    def flush(self):
+        if not self.enabled or len(self.pending) == 0:
+            return
+        tensors = [tensor for _, _, device in self.pending for tensor in device.values()]
+        values = torch.cat(tensors).cpu().tolist() if len(tensors) > 0 else []
+        records, offset = [], 0
+        for step, host, device in self.pending:
+            record = {"step": step, **host}
+            for name, tensor in device.items():
+                value = values[offset: offset + tensor.numel()]
+                offset += tensor.numel()
+                if tensor.numel() == 1:
+                    record[name] = value[0]
+                else:
+                    record.update({f"{name}_{i}": v for i, v in enumerate(value)})
+            records.append(record)
+        self.pending = []
+        self.queue.put(records)
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def _run(self):
+        while True:
+            records = self.queue.get()
+            if records is None:
+                break
+            for sink in self.sinks:
+                sink.write(records)
+
+
+def build_metrics(yaml, wandb=None, path=None):
+    """
+    yaml["metrics"]["sinks"] selects among wandb, jsonl, console and none,
+    by default wandb (when given) plus a jsonl file at path plus the console.
+    """
+    config = yaml["metrics"] if "metrics" in yaml else {}
+    flush_each = config["flush_each"] if "flush_each" in config else yaml["log_each"]
+    if "sinks" in config:
+        names = list(config["sinks"])
+    else:
+        names = (["wandb"] if wandb is not None else []) + ["jsonl", "console"]
+    sinks = []
+    for name in names:
+        if name == "wandb":
+            if wandb is None:
+                print("wandb is not available, skip the wandb sink")
+                continue
+            sinks.append(WandbSink(wandb))
+        elif name == "jsonl":
+            sinks.append(JsonlSink(config["path"] if "path" in config else path))
+        elif name == "console":
+            sinks.append(ConsoleSink())
+        elif name == "none":
+            continue
+        else:
+            raise NotImplementedError(f"unknown metric sink {name}")
+    return Metrics(sinks, flush_each=flush_each)
@@ -87,6 +87,86 @@ def window_reverse(windows, window_size, H, W):
     return windows
 
 
+# process-wide cache of the relative_position_index / attn_mask buffers, one tensor per
+# (name, resolution, window, shift, device, dtype) shared by every block that needs it
+_SHARED_BUFFERS = {}
+
+
+def share_buffer(key, tensor):
+    if tensor is None:
+        return None
+    return _SHARED_BUFFERS.setdefault(key + (str(tensor.device), tensor.dtype), tensor)
+
+
+def get_relative_position_index(window_size):
+    """
+    Args:
+        window_size (tuple[int]): The height and width of the window.
+
+    Returns:
+        relative_position_index: (Wh*Ww, Wh*Ww)
+    """
+    key = ("relative_position_index", tuple(window_size))
+    index = _SHARED_BUFFERS.get(key + ("cpu", torch.int64))
+    if index is None:
+        # get pair-wise relative position index for each token inside the window
+        coords_h = torch.arange(window_size[0])
+        coords_w = torch.arange(window_size[1])
+        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
+        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
+        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
+        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
+        relative_coords[:, :, 0] += window_size[0] - 1  # shift to start from 0
+        relative_coords[:, :, 1] += window_size[1] - 1
+        relative_coords[:, :, 0] *= 2 * window_size[1] - 1
+        index = share_buffer(key, relative_coords.sum(-1))  # Wh*Ww, Wh*Ww
+    return index
+
+
+def get_attn_mask(input_resolution, window_size, shift_size):
+    """
+    Args:
+        input_resolution (tuple[int]): Input resulotion.
+        window_size (int): Window size.
+        shift_size (int): Shift size for SW-MSA.
+
+    Returns:
+        attn_mask: (nW, window_size*window_size, window_size*window_size) or None
+    """
+    if shift_size == 0:
+        return None
+    key = ("attn_mask", tuple(input_resolution), window_size, shift_size)
+    attn_mask = _SHARED_BUFFERS.get(key + ("cpu", torch.float32))
+    if attn_mask is None:
+        # calculate attention mask for SW-MSA
+        H, W = input_resolution
+        img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
+        h_slices = (
+            slice(0, -window_size),
+            slice(-window_size, -shift_size),
+            slice(-shift_size, None),
+        )
+        w_slices = (
+            slice(0, -window_size),
+            slice(-window_size, -shift_size),
+            slice(-shift_size, None),
+        )
+        cnt = 0
+        for h in h_slices:
+            for w in w_slices:
+                img_mask[:, h, w, :] = cnt
+                cnt += 1
+
+        mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+        mask_windows = mask_windows.view(-1, window_size * window_size)
+        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
+            attn_mask == 0, float(0.0)
+        )
+        attn_mask = share_buffer(key, attn_mask)
+    return attn_mask
+
+
 class WindowAttention(nn.Module):
     r"""Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -124,18 +204,10 @@ class WindowAttention(nn.Module):
             torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1), num_heads)
         )  # 2*Wh-1 * 2*Ww-1, nH
 
-        # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
+        # get pair-wise relative position index for each token inside the window, shared by the blocks
+        self.register_buffer(
+            "relative_position_index", get_relative_position_index(self.window_size)
+        )
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
@@ -145,6 +217,14 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=0.02)
         self.softmax = nn.Softmax(dim=-1)
 
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # keep one copy per device after .cuda() / .half()
+        self.relative_position_index = share_buffer(
+            ("relative_position_index", tuple(self.window_size)), self.relative_position_index
+        )
+        return self
+
     def forward(self, x, mask=None):
         """
         Args:
@@ -271,40 +351,21 @@ class SwinTransformerBlock(nn.Module):
             in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop
         )
 
-        if self.shift_size > 0:
-            # calculate attention mask for SW-MSA
-            H, W = self.input_resolution
-            img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-            h_slices = (
-                slice(0, -self.window_size),
-                slice(-self.window_size, -self.shift_size),
-                slice(-self.shift_size, None),
-            )
-            w_slices = (
-                slice(0, -self.window_size),
-                slice(-self.window_size, -self.shift_size),
-                slice(-self.shift_size, None),
-            )
-            cnt = 0
-            for h in h_slices:
-                for w in w_slices:
-                    img_mask[:, h, w, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(
-                img_mask, self.window_size
-            )  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
-                attn_mask == 0, float(0.0)
-            )
-        else:
-            attn_mask = None
+        # attention mask for SW-MSA, shared by the blocks with the same resolution, window and shift
+        attn_mask = get_attn_mask(self.input_resolution, self.window_size, self.shift_size)
 
         self.register_buffer("attn_mask", attn_mask)
         self.fused_window_process = fused_window_process
 
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # keep one copy per device after .cuda() / .half()
+        self.attn_mask = share_buffer(
+            ("attn_mask", tuple(self.input_resolution), self.window_size, self.shift_size),
+            self.attn_mask,
+        )
+        return self
+
     def forward(self, x):
         H, W = self.input_resolution
         B, L, C = x.shape
@@ -17,9 +17,14 @@ from omegaconf import OmegaConf
 from torch.fx import symbolic_trace
 from torch.nn.parallel import DistributedDataParallel as DDP
 
-import wandb
 from Env.Environment_SDA import *
 
+try:
+    import wandb
+except ImportError:
+    # TODO: air-gapped nodes run without wandb, metrics go to the jsonl/console sinks
+    wandb = None
+
 sys.path.append(os.path.join(os.getcwd()))
 import datas
 import losses
@@ -104,7 +109,12 @@ def main_worker(gpu, yaml_config, ngpus_per_node, world_size, dist_url):
     )
 
     # TODO: LLA_DFD
-    if gpu == 0:
+    use_wandb = wandb is not None and (
+        "metrics" not in yaml_config
+        or "sinks" not in yaml_config["metrics"]
+        or "wandb" in yaml_config["metrics"]["sinks"]
+    )
+    if gpu == 0 and use_wandb:
         wandb.init(project="LLA_DFD", entity="you name")
     tnet = getattr(models, yaml_config["tarch"])(num_classes=yaml_config["num_classes"])
     ROOT = yaml_config["ckpt_root"]
@@ -181,7 +191,7 @@ def main_worker(gpu, yaml_config, ngpus_per_node, world_size, dist_url):
             gamma=yaml_config["scheduler"]["gamma"],
         )
 
-    if gpu == 0:
+    if gpu == 0 and use_wandb:
         wandb.config = yaml_config
     env = LearnDiversifyEnv(
         dataloader=trainloader,
@@ -192,7 +202,7 @@ def main_worker(gpu, yaml_config, ngpus_per_node, world_size, dist_url):
         optimizer=optimizer,
         loss=criticion,
         yaml=yaml_config,
-        wandb=wandb if gpu == 0 else None,
+        wandb=wandb if gpu == 0 and use_wandb else None,
         gpu=gpu,
     )
     env.training_in_all_epoch()
@@ -1,2 +1,3 @@
 from .ema import ModelEMA
 from .load_model import *
+from .teacher_cache import TeacherLogitCache
@@ -0,0 +1,69 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class TeacherLogitCache(object):
+    """
+    On-disk, memory-mapped store of the frozen teacher's logits on clean (un-augmented) images.
+
+    A row is addressed by the IndexDataset index and the augmentation view of that sample
+    (see IndexDataset.aug_views), the file name carries a hash of the augmentation seed, the
+    number of views and the teacher, so a changed setting never reads stale logits.
+    Rows are filled lazily the first time a (index, view) pair is met and served afterwards.
+    """
+
+    def __init__(self, path, dataset_len, num_views, num_classes, aug_seed=0, tag=""):
+        key = f"{tag}-{aug_seed}-{num_views}-{num_classes}-{dataset_len}"
+        name = hashlib.md5(key.encode()).hexdigest()[:16]
+        self.logit_path = os.path.join(path, f"teacher_logits_{name}.npy")
+        self.filled_path = os.path.join(path, f"teacher_filled_{name}.npy")
+        self.num_views = num_views
+        self.num_classes = num_classes
+        distributed = dist.is_available() and dist.is_initialized()
+        # the global rank 0 creates the files, on several nodes a local rank 0 on each would race
+        creator = not distributed or dist.get_rank() == 0
+        if creator and not (os.path.exists(self.logit_path) and os.path.exists(self.filled_path)):
+            os.makedirs(path, exist_ok=True)
+            shapes = [
+                (self.logit_path, np.float16, (dataset_len, num_views, num_classes)),
+                (self.filled_path, np.uint8, (dataset_len, num_views)),
+            ]
+            for file_path, dtype, shape in shapes:
+                # written under a temporary name, the other ranks never open a half created file
+                tmp_path = f"{file_path}.{os.getpid()}.tmp.npy"
+                array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+                array.flush()
+                del array
+                os.replace(tmp_path, file_path)
+        if distributed:
+            dist.barrier()
+        self.logits = np.load(self.logit_path, mmap_mode="r+")
+        self.filled = np.load(self.filled_path, mmap_mode="r+")
+        print(f"teacher logit cache: {self.logit_path}, {self.hit_ratio() * 100:.2f}% filled")
+
+    def hit_ratio(self):
+        return float(self.filled.mean())
+
+    def lookup(self, keys):
+        """
+        keys: LongTensor of shape (B, 2) holding (index, view) on cpu.
+        return a bool hit mask of shape (B,) and the cached logits of the hit rows.
+        """
+        keys = keys.numpy()
+        hit = self.filled[keys[:, 0], keys[:, 1]].astype(np.bool_)
+        rows = keys[hit]
+        logits = torch.from_numpy(np.ascontiguousarray(self.logits[rows[:, 0], rows[:, 1]]))
+        return torch.from_numpy(hit), logits
+
+    def write(self, keys, logits):
+        keys = keys.numpy()
+        self.logits[keys[:, 0], keys[:, 1]] = logits.detach().half().cpu().numpy()
+        self.filled[keys[:, 0], keys[:, 1]] = 1
+
+    def flush(self):
+        self.logits.flush()
+        self.filled.flush()
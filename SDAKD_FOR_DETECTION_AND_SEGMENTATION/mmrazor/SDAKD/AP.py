@@ -1,4 +1,5 @@
 import random,math
+import torch
 import torch.nn as nn
 from torchvision import transforms
 from torchvision.transforms import functional as F
@@ -103,3 +104,26 @@ def _apply_op(
         raise ValueError(f"The provided operator {op_name} is not recognized.")
     return img
 
+
+def batched_equalize(img: Tensor):
+    """
+    Histogram equalisation of a uint8 image batch (..., C, H, W), equal to F.equalize.
+    All B*C histograms are one bincount over a flattened (B*C) index, the cumulative
+    LUTs are built together and the remap is a single gather.
+    """
+    shape = img.shape
+    flat = img.reshape(-1, shape[-2] * shape[-1]).long()
+    n = flat.shape[0]
+    offset = torch.arange(n, device=img.device).view(-1, 1) * 256
+    hist = torch.bincount((flat + offset).view(-1), minlength=n * 256).view(n, 256)
+    # the count of the last non-zero bin is excluded from step, as in torchvision
+    last = (torch.arange(256, device=img.device) * (hist > 0)).argmax(1, keepdim=True)
+    step = torch.div(hist.sum(1, keepdim=True) - hist.gather(1, last), 255, rounding_mode="floor")
+    lut = torch.div(
+        hist.cumsum(1) + torch.div(step, 2, rounding_mode="floor"),
+        step.clamp(min=1),
+        rounding_mode="floor",
+    )
+    lut = torch.nn.functional.pad(lut, [1, 0])[:, :-1].clamp(0, 255)
+    out = torch.where(step == 0, flat, lut.gather(1, flat))
+    return out.to(torch.uint8).reshape(shape)
@@ -13,7 +13,7 @@ from mmdet.datasets.pipelines.transforms import CutOut
 import mmcv
 from .DC import DetectionColorAugmentation
 from .DS import DetectionFreezeSTN
-from .AP import _apply_op
+from .AP import _apply_op, batched_equalize
 
 
 def relaxed_bernoulli(logits, temp=0.05):
@@ -23,9 +23,10 @@ def relaxed_bernoulli(logits, temp=0.05):
 
 
 def pre_tran(image, mean, std):
-    _image = image.mul(torch.Tensor(std)[None, :, None, None].cuda()).add(
-        torch.Tensor(mean)[None, :, None, None].cuda()
-    )
+    """
+    de-normalise to uint8, mean and std are (1, C, 1, 1) tensors on the device of image
+    """
+    _image = image.mul(std).add(mean)
     _image = _image * 255
     _image = torch.floor(_image + 0.5)
     torch.clip_(_image, 0, 255)
@@ -33,6 +34,13 @@ def pre_tran(image, mean, std):
     return _image
 
 
+def after_tran(image, mean, std):
+    """
+    re-normalise a uint8 image, equal to transforms.Normalize(mean, std)(image / 255)
+    """
+    return image.float().div_(255).sub_(mean).div_(std)
+
+
 class LAMBDA_AUG(nn.Module):
     def __init__(self, lambda_function):
         """
@@ -44,14 +52,32 @@ class LAMBDA_AUG(nn.Module):
         super(LAMBDA_AUG, self).__init__()
         self.mean = [123.675 / 255, 116.28 / 255, 103.53 / 255]
         self.std = [58.395 / 255, 57.12 / 255, 57.375 / 255]
-        self.tran = transforms.Normalize(mean=self.mean, std=self.std)
-        self.pre_tran = lambda x: pre_tran(x, self.mean, self.std)
-        self.after_tran = lambda x: self.tran(x / 255)
+        # persistent device copies of mean and std, moved once on first use
+        self.mean_tensor = torch.Tensor(self.mean)[None, :, None, None]
+        self.std_tensor = torch.Tensor(self.std)[None, :, None, None]
         self.aug = lambda_function
 
-    def forward(self, x, boxes):
-        x = self.pre_tran(x)
-        x = self.aug(x)
+    def _to(self, device):
+        if self.mean_tensor.device != device:
+            self.mean_tensor = self.mean_tensor.to(device)
+            self.std_tensor = self.std_tensor.to(device)
+
+    def pre_tran(self, x):
+        self._to(x.device)
+        return pre_tran(x, self.mean_tensor, self.std_tensor)
+
+    def after_tran(self, x):
+        self._to(x.device)
+        return after_tran(x, self.mean_tensor, self.std_tensor)
+
+    def forward(self, x, boxes, x_uint8=None):
+        """
+        Args:
+            x_uint8: the de-normalised x, shared among several LAMBDA_AUG in one forward
+        """
+        if x_uint8 is None:
+            x_uint8 = self.pre_tran(x)
+        x = self.aug(x_uint8)
         x = self.after_tran(x)
         return x, boxes
 
@@ -124,9 +150,7 @@ class Mulit_Augmentation(nn.Module):
         self._freeze_parameter()  # TODO: FREEZE
 
         equailize = LAMBDA_AUG(
-            lambda_function=lambda _image: _apply_op(
-                _image, "Equalize", 0.0, interpolation=InterpolationMode.NEAREST, fill=None
-            ),
+            lambda_function=batched_equalize,
         )
         self.nolearning_model_list.append(equailize)
         invert = LAMBDA_AUG(
@@ -197,9 +221,15 @@ class Mulit_Augmentation(nn.Module):
             p_iter += 1
             m_iter += 1
 
+        image_uint8 = None
         for tran in self.nolearning_model_list:
             if p_iter in index:
-                now_image, _ = tran(image, boxes)
+                if isinstance(tran, LAMBDA_AUG):
+                    if image_uint8 is None:
+                        image_uint8 = tran.pre_tran(image)
+                    now_image, _ = tran(image, boxes, image_uint8)
+                else:
+                    now_image, _ = tran(image, boxes)
                 now_image = p[p_iter] * now_image + (1 - p[p_iter]) * image
                 color_result.append(now_image - image)
             p_iter += 1
@@ -235,11 +265,11 @@ class Mulit_Augmentation(nn.Module):
         semantic_seg = semantic_seg.contiguous().long()
         return x, semantic_seg
 
-    def forward_box(self, boxes, labels, H, size):
-        b, c, h, w = size
-        center_h, center_w = h / 2, w / 2
-        result_boxes = []
-        result_labels = []
+    @staticmethod
+    def _invert_affine(H):
+        """
+        inverse of the (B, 2, 3) affine matrices, mapping output coordinates back to input ones
+        """
         _w = H[:, 0, 0] * H[:, 1, 1] - H[:, 1, 0] * H[:, 0, 1]
         new00 = H[:, 1, 1] / _w
         new01 = - H[:, 0, 1] / _w
@@ -251,59 +281,53 @@ class Mulit_Augmentation(nn.Module):
         new00, new01, new02, new10, new11, new12 = new00.clone(), new01.clone(), new02.clone(), new10.clone(), new11.clone(), new12.clone()
         H = torch.stack([torch.stack([new00, new10], dim=-1), torch.stack([new01, new11], dim=-1),
                          torch.stack([new02, new12], dim=-1)], dim=-1)
-        H = H.contiguous()
-        for i, box in enumerate(boxes):  # min_x,min_y,max_x,_max_y
-            label = labels[i]
-            min_x, min_y, max_x, max_y = torch.split(
-                box, 1, dim=-1)
-            # [1,1] [-1,1]
-            # [1,-1] [-1,-1]
-            # xold = xnew * w00 + ynew* w01 + w02
-            # yold = xnew * w10 + ynew* w11 + w12
-            # => xold*w11 = xnew * w00*w11 + ynew * w01 * w11 + w02 * w11
-            # => yold*w01 = xnew * w10*w01 + ynew * w01 * w11 + w12 * w01
-            # => ((xold*w11-yold*w01) + w02*w11 - w12*w01 )/(w00*w11-w10*w01) = xnew
-            # => w11/(w00*w11-w10*w01) * xold + (-w01)/(w00*w11-w10*w01) + (w02*w11 - w12*w01)/(w00*w11-w10*w01) = xnew
-            #
-            # => xold*w10 = xnew * w00*w10 + ynew * w01 * w10 + w02 * w10
-            # => yold*w00 = xnew * w10*w00+ ynew * w11 * w00 + w12 * w00
-            # => xold * w10 - yold * w00 + (w02*w10 - w12 * w00) = ynew * (w01*w10 - w11*w00)
-            # => w10/(w01*w10-w11*w00) * xold + (-w00)/(w01*w10-w11*w00) * yold + (w02*w10-w12*w00)/(w01*w10 - w11*w00) = ynew
-            min_x, min_y, max_x, max_y = -(min_x - center_w) / center_w, -(min_y - center_h) / center_h, -(
-                    max_x - center_w) / center_w, -(max_y - center_h) / center_h
-            coordinates = torch.stack([torch.stack([min_x, min_y]), torch.stack([max_x, min_y]),
-                                       torch.stack([min_x, max_y]), torch.stack([max_x, max_y])])  # [4, 2, nb_bbox, 1]
-            coordinates = torch.cat(
-                (coordinates,
-                 torch.ones(4, 1, coordinates.shape[2], 1, dtype=coordinates.dtype).to(coordinates.device)),
-                dim=1)  # [4, 3, nb_bbox, 1]
-            coordinates = coordinates.permute(2, 0, 1, 3)  # [nb_bbox, 4, 3, 1]
-            coordinates = torch.matmul(H[i], coordinates)  # [nb_bbox, 4, 2, 1]
-            coordinates = coordinates[..., 0]  # [nb_bbox, 4, 2]
-            coordinates[:, :, 1] = coordinates[:, :, 1] * -center_h + center_h
-            coordinates[:, :, 0] = coordinates[:, :, 0] * -center_w + center_w
-            min_x, min_y = torch.min(coordinates[:, :, 0], dim=1)[0], torch.min(coordinates[:, :, 1], dim=1)[0]
-            max_x, max_y = torch.max(coordinates[:, :, 0], dim=1)[0], torch.max(coordinates[:, :, 1], dim=1)[0]
-            min_x[min_x < 0] = 0
-            min_x[min_x > w] = w
-            min_y[min_y < 0] = 0
-            min_y[min_y > h] = h
-            max_x = torch.where(max_x < min_x, min_x, max_x)
-            max_x[max_x > w] = w
-            max_y = torch.where(max_y < min_y, min_y, max_y)
-            max_y[max_y > h] = h
-
-            box = torch.stack([min_x, min_y, max_x, max_y],
-                              dim=-1)
-            mask = (box[:, 0] != box[:, 2]) & (box[:, 1] != box[:, 3])
-            box = box[mask, :]
-            label = label[mask]
-            if box.shape[0] > 0:
-                result_boxes.append(box)
-                result_labels.append(label)
-            else:
-                result_boxes.append(box)
-                result_labels.append(label)
-                print("[WARNING] box.shape[0]==0")
+        return H.contiguous()
 
+    def forward_box(self, boxes, labels, H, size):
+        """
+        Map the boxes of every image through the inverse of its affine matrix without a per-image loop:
+        all boxes are packed into one zero padded (B, M, 4) tensor, the corners of every image go
+        through a single bmm against its inverted affine matrix, then the boxes are clamped,
+        degenerate ones dropped and the rest unpacked into per-image lists.
+        """
+        b, c, h, w = size
+        center_h, center_w = h / 2, w / 2
+        counts = [box.shape[0] for box in boxes]
+        max_count = max(counts) if len(counts) > 0 else 0
+        if max_count == 0:
+            print("[WARNING] box.shape[0]==0")
+            return list(boxes), list(labels)
+        H = self._invert_affine(H)
+        packed_boxes = torch.cat(list(boxes), 0)
+        packed_labels = torch.cat(list(labels), 0)
+        device = packed_boxes.device
+        counts = torch.tensor(counts, device=device)
+        image_index = torch.repeat_interleave(torch.arange(b, device=device), counts)
+        offsets = torch.cumsum(counts, 0) - counts
+        slot = torch.arange(packed_boxes.shape[0], device=device) - offsets[image_index]
+        padded = packed_boxes.new_zeros(b, max_count, 4)
+        padded[image_index, slot] = packed_boxes
+
+        center = packed_boxes.new_tensor([center_w, center_h, center_w, center_h])
+        padded = -(padded - center) / center
+        # corners (min_x,min_y), (max_x,min_y), (min_x,max_y), (max_x,max_y) as homogeneous points
+        xs = padded[..., [0, 2, 0, 2]]
+        ys = padded[..., [1, 1, 3, 3]]
+        coordinates = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(b, max_count * 4, 3)
+        coordinates = torch.bmm(coordinates, H.to(coordinates.dtype).transpose(1, 2))
+        coordinates = coordinates.view(b, max_count, 4, 2)
+        x = coordinates[..., 0] * -center_w + center_w
+        y = coordinates[..., 1] * -center_h + center_h
+        min_x = x.min(-1)[0].clamp(0, w)
+        min_y = y.min(-1)[0].clamp(0, h)
+        max_x = torch.max(x.max(-1)[0], min_x).clamp(max=w)
+        max_y = torch.max(y.max(-1)[0], min_y).clamp(max=h)
+
+        box = torch.stack([min_x, min_y, max_x, max_y], dim=-1)[image_index, slot]
+        mask = (box[:, 0] != box[:, 2]) & (box[:, 1] != box[:, 3])
+        keep_counts = torch.bincount(image_index[mask], minlength=b).tolist()
+        result_boxes = list(torch.split(box[mask], keep_counts))
+        result_labels = list(torch.split(packed_labels[mask], keep_counts))
+        if min(keep_counts) == 0:
+            print("[WARNING] box.shape[0]==0")
         return result_boxes, result_labels
@@ -25,15 +25,6 @@ class OSDTeacherDistiller(SingleTeacherDistiller):
     def unset_convertor_training(self):
         self.convertor_training = False
 
-    def teacher_forward_pre_hook(self, module, input, same_indices):
-        input = list(input)
-        s_module_name = self.teacher_student_name_map[self.teacher_module2name[module]]
-        for idx, item in zip(same_indices, self.student_inputs[s_module_name].pop(0)):
-            if input[idx].shape != item.shape:
-                input[idx].resize_(item.shape)
-            input[idx].copy_(item)
-        return tuple(input)
-
     def student_forward_pre_hook(self, module, input, same_indices):
         if not module.training and not self.convertor_training:
             return input
@@ -52,8 +43,9 @@ class OSDTeacherDistiller(SingleTeacherDistiller):
             outputs (tuple): The output of the module.
         """
         if self.training or self.convertor_training:
-            self.teacher_outputs[self.teacher_module2name[module]].append(
-                outputs)
+            # The convertor step does not compute the distillation loss.
+            self.record_teacher_output(module, outputs,
+                                       stream=not self.convertor_training)
 
     def student_forward_output_hook(self, module, inputs, outputs):
         """Save the module's forward output.
@@ -79,11 +71,14 @@ class OSDTeacherDistiller(SingleTeacherDistiller):
         self.reset_ctx_teacher_mode(True)
         # Clear the saved data of the last forward。
         self.reset_outputs(self.teacher_outputs)
+        self.streamed_losses = dict()
 
+        self.current_data = data
         if self.teacher_trainable or self.convertor_training:
             output = self.teacher(**data)
         else:
             with torch.no_grad():
                 output = self.teacher(**data)
+        self.current_data = None
 
         return output
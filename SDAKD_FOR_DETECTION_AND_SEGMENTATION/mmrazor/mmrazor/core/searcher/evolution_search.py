@@ -7,7 +7,7 @@ import mmcv.fileio
 from mmcv.runner import get_dist_info
 
 from ..builder import SEARCHERS
-from ..utils import broadcast_object_list
+from ..utils import CachedDataLoader, broadcast_object_list
 
 
 @SEARCHERS.register_module()
@@ -33,6 +33,14 @@ class EvolutionSearcher():
         mutate_prob (float): The probability of mutation.
         resume_from (str): Specify the path of saved .pkl file for resuming
             searching
+        cache_dataloader (bool): Whether to keep the batches of the first
+            evaluation in memory and evaluate the other candidates on them.
+            Every rank holds its share of the collated batches in host
+            memory, tens of GB for full resolution COCO or ImageNet val.
+            Defaults to False.
+        cache_max_batches (int, optional): Evaluate on the dataloader
+            without caching when it has more batches than this. Defaults to
+            None, no limit.
     """
 
     def __init__(self,
@@ -52,12 +60,16 @@ class EvolutionSearcher():
                  num_crossover=25,
                  mutate_prob=0.1,
                  resume_from=None,
+                 cache_dataloader=False,
+                 cache_max_batches=None,
                  **search_kwargs):
 
         if not hasattr(algorithm, 'module'):
             raise NotImplementedError('Do not support searching with cpu.')
         self.algorithm = algorithm.module
         self.algorithm_for_test = algorithm
+        if cache_dataloader:
+            dataloader = CachedDataLoader(dataloader, cache_max_batches)
         self.dataloader = dataloader
         self.constraints = constraints
         self.metrics = metrics
@@ -2,13 +2,18 @@
 import copy
 import os
 import os.path as osp
+import random
 
 import mmcv
+import numpy as np
 import torch
+import torch.distributed as dist
 from mmcv.runner import get_dist_info
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.data import DataLoader, DistributedSampler
 
 from ..builder import SEARCHERS
-from ..utils import broadcast_object_list
+from ..utils import CachedDataLoader, broadcast_object_list
 
 
 @SEARCHERS.register_module()
@@ -44,6 +49,21 @@ class GreedySearcher():
             Defaults to `accuracy_top-1`.
         resume_from (str, optional): Specify the path of saved .pkl file for
             resuming searching. Defaults to None.
+        cache_dataloader (bool): Whether to keep the batches of the first
+            evaluation in memory and evaluate the other candidates on them.
+            Every rank holds its share of the collated batches in host
+            memory, tens of GB for full resolution COCO or ImageNet val.
+            Defaults to False.
+        cache_max_batches (int, optional): Evaluate on the dataloader
+            without caching when it has more batches than this. Defaults to
+            None, no limit.
+        proxy_num_samples (int): The size of the fixed calibration subset of
+            the dataset the channel groups are first scored on, with the BN
+            statistics re-estimated on it. 0 scores every group on the whole
+            dataset. Defaults to 0.
+        proxy_top_m (int): The number of groups with the best proxy scores
+            that are evaluated on the whole dataset. Defaults to 5.
+        proxy_seed (int): The seed of the calibration subset. Defaults to 0.
     """
 
     def __init__(self,
@@ -59,6 +79,11 @@ class GreedySearcher():
                  metric_options=None,
                  score_key='accuracy_top-1',
                  resume_from=None,
+                 cache_dataloader=False,
+                 cache_max_batches=None,
+                 proxy_num_samples=0,
+                 proxy_top_m=5,
+                 proxy_seed=0,
                  **search_kwargs):
         super(GreedySearcher, self).__init__()
         if not hasattr(algorithm, 'module'):
@@ -66,6 +91,8 @@ class GreedySearcher():
 
         self.algorithm = algorithm.module
         self.algorithm_for_test = algorithm
+        if cache_dataloader:
+            dataloader = CachedDataLoader(dataloader, cache_max_batches)
         self.dataloader = dataloader
         self.target_flops = sorted(target_flops, reverse=True)
         self.test_fn = test_fn
@@ -77,6 +104,125 @@ class GreedySearcher():
         self.metric_options = metric_options
         self.score_key = score_key
         self.resume_from = resume_from
+        self.proxy_top_m = proxy_top_m
+        self.proxy_dataloader = None
+        if proxy_num_samples > 0:
+            self.proxy_dataloader = self.build_proxy_dataloader(
+                proxy_num_samples, proxy_seed)
+
+    def build_proxy_dataloader(self, num_samples, seed):
+        """Build a dataloader over a fixed random subset of the dataset.
+
+        The subset is a shallow copy of the dataset whose per-sample
+        attributes (``data_infos`` and, for mmdet datasets, ``img_ids``,
+        ``flag`` and ``proposals``) are indexed by the sampled indices, so
+        that ``evaluate`` matches the results with the sampled samples.
+        """
+        dataloader = getattr(self.dataloader, 'dataloader', self.dataloader)
+        dataset = dataloader.dataset
+        if not hasattr(dataset, 'data_infos'):
+            raise NotImplementedError(
+                'Proxy evaluation needs a dataset with `data_infos`, got '
+                f'{type(dataset).__name__}.')
+        num_samples = min(num_samples, len(dataset))
+        indices = sorted(
+            random.Random(seed).sample(range(len(dataset)), num_samples))
+        proxy_dataset = copy.copy(dataset)
+        for attr in ['data_infos', 'img_ids', 'flag', 'proposals']:
+            value = getattr(dataset, attr, None)
+            if value is None:
+                continue
+            if len(value) != len(dataset):
+                raise NotImplementedError(
+                    f'Can not subset `{attr}` of {type(dataset).__name__}, '
+                    f'it has {len(value)} entries for {len(dataset)} '
+                    'samples.')
+            if isinstance(value, np.ndarray):
+                value = value[indices]
+            else:
+                value = [value[i] for i in indices]
+            setattr(proxy_dataset, attr, value)
+
+        rank, world_size = get_dist_info()
+        sampler = None
+        if world_size > 1:
+            sampler = DistributedSampler(
+                proxy_dataset, world_size, rank, shuffle=False)
+        proxy_dataloader = DataLoader(
+            proxy_dataset,
+            batch_size=dataloader.batch_size,
+            sampler=sampler,
+            num_workers=dataloader.num_workers,
+            collate_fn=dataloader.collate_fn,
+            pin_memory=False)
+        # The subset is read once for every candidate.
+        return CachedDataLoader(proxy_dataloader)
+
+    @torch.no_grad()
+    def calibrate_bn(self, dataloader):
+        """Re-estimate the BN statistics of the current subnet on
+        ``dataloader``.
+
+        Returns:
+            dict: The BN states before calibration, for ``restore_bn``.
+        """
+        bn_states = dict()
+        for name, module in self.algorithm.named_modules():
+            if isinstance(module, _BatchNorm) and module.track_running_stats:
+                bn_states[name] = (module.momentum,
+                                   module.running_mean.clone(),
+                                   module.running_var.clone(),
+                                   module.num_batches_tracked.clone())
+                module.reset_running_stats()
+                # cumulative moving average
+                module.momentum = None
+                module.train()
+
+        for data in dataloader:
+            self.algorithm_for_test(return_loss=False, **data)
+
+        _, world_size = get_dist_info()
+        for name, module in self.algorithm.named_modules():
+            if name in bn_states:
+                if world_size > 1:
+                    dist.all_reduce(module.running_mean.div_(world_size))
+                    dist.all_reduce(module.running_var.div_(world_size))
+                module.eval()
+        return bn_states
+
+    def restore_bn(self, bn_states):
+        """Put back the BN states saved by ``calibrate_bn``."""
+        for name, module in self.algorithm.named_modules():
+            if name in bn_states:
+                momentum, running_mean, running_var, num_batches_tracked = \
+                    bn_states[name]
+                module.momentum = momentum
+                module.running_mean.copy_(running_mean)
+                module.running_var.copy_(running_var)
+                module.num_batches_tracked.copy_(num_batches_tracked)
+
+    def evaluate(self, dataloader):
+        """Evaluate the current subnet on ``dataloader`` and broadcast its
+        score to the whole group."""
+        rank, _ = get_dist_info()
+        outputs = self.test_fn(self.algorithm_for_test, dataloader)
+        broadcast_scores = [None]
+        if rank == 0:
+            eval_result = dataloader.dataset.evaluate(
+                outputs, self.metrics, self.metric_options)
+            broadcast_scores = [eval_result[self.score_key]]
+
+        # Broadcasts scores in broadcast_scores to the whole
+        # group.
+        broadcast_scores = broadcast_object_list(broadcast_scores)
+        return broadcast_scores[0]
+
+    def proxy_evaluate(self):
+        """Score the current subnet on the calibration subset."""
+        bn_states = self.calibrate_bn(self.proxy_dataloader)
+        score = self.evaluate(self.proxy_dataloader)
+        self.restore_bn(bn_states)
+        return score
 
     def search(self):
         """Greedy Slimming."""
@@ -90,9 +236,12 @@ class GreedySearcher():
             result_flops = searcher_resume['result_flops']
             subnet = searcher_resume['subnet']
             flops = searcher_resume['flops']
+            history = searcher_resume.get('history', [])
             self.logger.info(f'Resume from subnet: {subnet}')
         else:
             result_subnet, result_flops = [], []
+            # The scores and the shrunk group of every step.
+            history = []
             # We start with the largest model
             algorithm.pruner.set_max_channel()
             max_subnet = algorithm.pruner.get_max_channel_bins(
@@ -118,10 +267,12 @@ class GreedySearcher():
                 # search which layer needs to shrink
                 best_score = None
                 best_subnet = None
+                best_name = None
 
                 # During distributed training, the order of ``subnet.keys()``
                 # on different ranks may be different. So we need to sort it
                 # first.
+                candidates = []
                 for i, name in enumerate(sorted(subnet.keys())):
                     new_subnet = copy.deepcopy(subnet)
                     # we prune the very last channel bin
@@ -132,27 +283,40 @@ class GreedySearcher():
                     if torch.sum(new_subnet[name]) < self.min_channel_bins:
                         # subnet is invalid
                         continue
+                    candidates.append((name, new_subnet))
+
+                # Only the groups with the best scores on the calibration
+                # subset are evaluated on the whole dataset.
+                proxy_scores = dict()
+                if self.proxy_dataloader is not None and \
+                        len(candidates) > self.proxy_top_m:
+                    for name, new_subnet in candidates:
+                        algorithm.pruner.set_channel_bins(
+                            new_subnet, self.max_channel_bins)
+                        proxy_scores[name] = self.proxy_evaluate()
+                        self.logger.info(
+                            f'Slimming group {name}, proxy '
+                            f'{self.score_key}: {proxy_scores[name]}')
+                    # ``sorted`` is stable, ties keep the group order.
+                    kept = sorted(
+                        candidates, key=lambda c: proxy_scores[c[0]],
+                        reverse=True)[:self.proxy_top_m]
+                    kept = [name for name, _ in kept]
+                    candidates = [c for c in candidates if c[0] in kept]
 
+                scores = dict()
+                for name, new_subnet in candidates:
                     algorithm.pruner.set_channel_bins(new_subnet,
                                                       self.max_channel_bins)
 
-                    outputs = self.test_fn(self.algorithm_for_test,
-                                           self.dataloader)
-                    broadcast_scores = [None]
-                    if rank == 0:
-                        eval_result = self.dataloader.dataset.evaluate(
-                            outputs, self.metrics, self.metric_options)
-                        broadcast_scores = [eval_result[self.score_key]]
-
-                    # Broadcasts scores in broadcast_scores to the whole
-                    # group.
-                    broadcast_scores = broadcast_object_list(broadcast_scores)
-                    score = broadcast_scores[0]
+                    score = self.evaluate(self.dataloader)
+                    scores[name] = score
                     self.logger.info(
                         f'Slimming group {name}, {self.score_key}: {score}')
                     if best_score is None or score > best_score:
                         best_score = score
                         best_subnet = new_subnet
+                        best_name = name
 
                 if best_subnet is None:
                     raise RuntimeError(
@@ -165,12 +329,20 @@ class GreedySearcher():
                 flops = algorithm.get_subnet_flops()
                 self.logger.info(
                     f'Greedy find model, score: {best_score}, FLOPS: {flops}')
+                history.append(
+                    dict(
+                        shrink=best_name,
+                        score=best_score,
+                        flops=flops,
+                        scores=scores,
+                        proxy_scores=proxy_scores))
 
                 save_for_resume = dict()
                 save_for_resume['result_subnet'] = result_subnet
                 save_for_resume['result_flops'] = result_flops
                 save_for_resume['subnet'] = subnet
                 save_for_resume['flops'] = flops
+                save_for_resume['history'] = history
                 mmcv.fileio.dump(save_for_resume,
                                  osp.join(self.work_dir, 'latest.pkl'))
 
@@ -1,5 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 from .broadcast import broadcast_object_list
+from .cached_loader import CachedDataLoader
 from .lr import set_lr
 
-__all__ = ['broadcast_object_list', 'set_lr']
+__all__ = ['broadcast_object_list', 'CachedDataLoader', 'set_lr']
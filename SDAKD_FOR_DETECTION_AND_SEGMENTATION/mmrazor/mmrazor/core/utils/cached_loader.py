@@ -0,0 +1,48 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+
+
+class CachedDataLoader():
+    """Replay the batches of a dataloader from memory.
+
+    The first pass iterates ``dataloader`` and keeps every collated batch, the
+    following passes yield the same batches without reading or decoding any
+    sample. Searchers evaluate many candidates on the same validation set, so
+    the data pipeline cost is paid once per search instead of once per
+    candidate. The dataloader must not shuffle, and ``test_fn`` must not
+    modify the batches in place.
+
+    Every rank keeps its whole share of the collated batches in host memory,
+    e.g. tens of GB for the full resolution COCO or ImageNet val sets. Past
+    ``max_batches`` batches nothing is kept and every pass reads
+    ``dataloader``.
+
+    Args:
+        dataloader (:obj:`torch.nn.Dataloader`): Pytorch data loader.
+        max_batches (int, optional): The maximum number of batches to keep.
+            Defaults to None, no limit.
+    """
+
+    def __init__(self, dataloader, max_batches=None):
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.max_batches = max_batches
+        self.batches = None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if self.batches is not None:
+            return iter(self.batches)
+        if self.max_batches is not None and \
+                len(self.dataloader) > self.max_batches:
+            return iter(self.dataloader)
+        return self._cache()
+
+    def _cache(self):
+        batches = []
+        for data in self.dataloader:
+            batches.append(data)
+            yield data
+        # Only a complete pass is replayed.
+        self.batches = batches
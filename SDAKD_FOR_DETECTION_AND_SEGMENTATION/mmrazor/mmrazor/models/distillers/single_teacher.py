@@ -1,7 +1,9 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+from collections import deque
 from functools import partial
 import torch
 import torch.nn as nn
+from mmcv.runner.fp16_utils import cast_tensor_type
 from torch.nn.modules.batchnorm import _BatchNorm
 
 from ..builder import DISTILLERS, MODELS, build_loss
@@ -21,7 +23,14 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
             Batch Norm and its variants only. Default: True.
         components (dict): The details of the distillation. It usually includes
             the module names of the teacher and the student, and the losses
-            used in the distillation.
+            used in the distillation. Each entry of
+            ``modules_with_student_inputs`` may set ``share_inputs=True`` to
+            hand the student's tensors to the teacher module by reference
+            instead of copying them into the teacher's tensors.
+        streaming_loss (bool): Whether to compute the losses of a component
+            as soon as the teacher module outputs, when the student forward
+            has already run, and drop the teacher's output right away instead
+            of keeping it until ``compute_distill_loss``. Default: False.
     """
 
     def __init__(self,
@@ -29,10 +38,12 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
                  teacher_trainable=False,
                  teacher_norm_eval=True,
                  components=tuple(),
+                 streaming_loss=False,
                  **kwargs):
         super().__init__(**kwargs)
         self.teacher_trainable = teacher_trainable
         self.teacher_norm_eval = teacher_norm_eval
+        self.streaming_loss = streaming_loss
         self.teacher = self.build_teacher(teacher)
 
         self.components = components
@@ -45,6 +56,10 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
         self.student_inputs = dict()
         self.teacher_inputs = dict()
         self.teacher_student_name_map = dict()
+        # The losses computed during the teacher forward, and the data of that
+        # forward for the losses that read it.
+        self.streamed_losses = dict()
+        self.current_data = None
 
         for i, component in enumerate(self.components):
             student_module_name = component['student_module']
@@ -132,6 +147,9 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
             self.teacher_module2name[module] = name
         self.teacher_name2module = dict(self.teacher.named_modules())
 
+        # Teacher modules whose shared student inputs have been checked.
+        self.shared_inputs_checked = set()
+
         # Register forward hooks for modules that need to participate in loss
         # calculation.
         for component in self.components:
@@ -151,18 +169,47 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
                     s_module_name = mod['student_module']
                     t_module_name = mod['teacher_module']
                     self.teacher_student_name_map[t_module_name] = s_module_name
-                    self.student_inputs[s_module_name] = list()
+                    # One entry per call of the student module, emptied by
+                    # ``exec_student_forward``, so the inputs of a student
+                    # forward whose teacher forward is skipped are dropped.
+                    self.student_inputs[s_module_name] = deque()
                     self.teacher_inputs[t_module_name] = list()
                     same_indices = mod['same_indices']
+                    share_inputs = mod.get('share_inputs', False)
                     s_module = self.student_name2module[s_module_name]
                     t_module = self.teacher_name2module[t_module_name]
                     s_module.register_forward_pre_hook(partial(self.student_forward_pre_hook, same_indices=same_indices))
-                    t_module.register_forward_pre_hook(partial(self.teacher_forward_pre_hook, same_indices=same_indices))
-
-    def teacher_forward_pre_hook(self, module, input, same_indices):
+                    t_module.register_forward_pre_hook(partial(self.teacher_forward_pre_hook, same_indices=same_indices,
+                                                               share_inputs=share_inputs))
+
+    def check_shared_inputs(self, module, input, same_indices, student_input):
+        """Check once per teacher module that the student's tensors can
+        replace the teacher's ones."""
+        if module in self.shared_inputs_checked:
+            return
+        for idx, item in zip(same_indices, student_input):
+            assert item.device == input[idx].device and \
+                item.dtype == input[idx].dtype and \
+                item.dim() == input[idx].dim(), \
+                f'student input {idx} of {self.teacher_module2name[module]} ' \
+                f'is {item.dtype} {tuple(item.shape)} on {item.device}, ' \
+                f'the teacher expects {input[idx].dtype} ' \
+                f'{tuple(input[idx].shape)} on {input[idx].device}'
+        self.shared_inputs_checked.add(module)
+
+    def teacher_forward_pre_hook(self, module, input, same_indices,
+                                 share_inputs=False):
         input = list(input)
         s_module_name = self.teacher_student_name_map[self.teacher_module2name[module]]
-        for idx, item in zip(same_indices, self.student_inputs[s_module_name].pop(0)):
+        student_input = self.student_inputs[s_module_name].popleft()
+        if share_inputs:
+            # The teacher module reads the student's tensors, the teacher's
+            # own tensors are left untouched for the rest of its forward.
+            self.check_shared_inputs(module, input, same_indices, student_input)
+            for idx, item in zip(same_indices, student_input):
+                input[idx] = item
+            return tuple(input)
+        for idx, item in zip(same_indices, student_input):
             if input[idx].shape != item.shape:
                 input[idx].resize_(item.shape)
             input[idx].copy_(item)
@@ -186,8 +233,46 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
             outputs (tuple): The output of the module.
         """
         if self.training:
-            self.teacher_outputs[self.teacher_module2name[module]].append(
-                outputs)
+            self.record_teacher_output(module, outputs)
+
+    def record_teacher_output(self, module, outputs, stream=True):
+        """Save the teacher module's output, or with ``streaming_loss``
+        compute the losses on it right away."""
+        teacher_module_name = self.teacher_module2name[module]
+        self.teacher_outputs[teacher_module_name].append(outputs)
+        if stream and self.streaming_loss:
+            self.stream_distill_loss(teacher_module_name)
+
+    def stream_distill_loss(self, teacher_module_name):
+        """Compute the losses of the last output of ``teacher_module_name``
+        against the matching student output and drop the teacher output.
+
+        The output is kept for ``compute_distill_loss`` if a component has no
+        student output to pair it with yet.
+        """
+        teacher_outputs = self.teacher_outputs[teacher_module_name]
+        out_idx = len(teacher_outputs) - 1
+        components = [(i, component)
+                      for i, component in enumerate(self.components)
+                      if component['teacher_module'] == teacher_module_name]
+        for _, component in components:
+            if out_idx >= len(self.student_outputs[component['student_module']]):
+                return
+        for i, component in components:
+            student_outputs = self.student_outputs[component['student_module']]
+            # The teacher forward may run under no_grad, and under the
+            # autocast of ``auto_fp16``, the losses are computed in fp32.
+            with torch.enable_grad(), torch.cuda.amp.autocast(enabled=False):
+                s_out = cast_tensor_type(student_outputs[out_idx],
+                                         torch.half, torch.float)
+                t_out = cast_tensor_type(teacher_outputs[out_idx],
+                                         torch.half, torch.float)
+                s_out = self.align_student_output(i, s_out, out_idx,
+                                                  len(student_outputs))
+                self.compute_component_loss(component, out_idx, s_out, t_out,
+                                            self.streamed_losses,
+                                            self.current_data)
+        teacher_outputs[out_idx] = None
 
     def student_forward_output_hook(self, module, inputs, outputs):
         """Save the module's forward output.
@@ -206,6 +291,11 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
         for key in outputs.keys():
             outputs[key] = list()
 
+    def reset_student_inputs(self):
+        """Drop the student inputs a skipped teacher forward left behind."""
+        for buffer in self.student_inputs.values():
+            buffer.clear()
+
     def exec_teacher_forward(self, data):
         """Execute the teacher's forward function.
 
@@ -217,12 +307,15 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
         self.reset_ctx_teacher_mode(True)
         # Clear the saved data of the last forward。
         self.reset_outputs(self.teacher_outputs)
+        self.streamed_losses = dict()
 
+        self.current_data = data
         if self.teacher_trainable:
             output = self.teacher(**data)
         else:
             with torch.no_grad():
                 output = self.teacher(**data)
+        self.current_data = None
 
         return output
 
@@ -236,6 +329,7 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
         self.reset_ctx_teacher_mode(False)
         # Clear the saved data of the last forward。
         self.reset_outputs(self.student_outputs)
+        self.reset_student_inputs()
 
         output = student(**data)
         return output
@@ -252,6 +346,34 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
         """Get the outputs according module name."""
         return self.teacher_outputs[teacher_module_name]
 
+    def align_student_output(self, i, s_out, out_idx, num_outputs):
+        """Align the ``out_idx``-th of the ``num_outputs`` outputs of the
+        student module of the ``i``-th component with the teacher."""
+        align_module_name = f'component_{i}'
+        if align_module_name not in self.align_modules:
+            return s_out
+        align_module = self.align_modules[align_module_name]
+        if not isinstance(align_module, nn.ModuleList):
+            return align_module(s_out)
+        assert isinstance(s_out, (list, tuple))
+        if len(align_module) == num_outputs:
+            return tuple([align_module[out_idx](x) for x in s_out])
+        assert len(s_out) == len(align_module)
+        return tuple([module(x) for module, x in zip(align_module, s_out)])
+
+    def compute_component_loss(self, component, out_idx, s_out, t_out,
+                               losses, data=None):
+        """Compute the losses of a component on one output pair."""
+        for loss in component.losses:
+            loss_module = self.losses[loss.name]
+            loss_name = f'{loss.name}.{out_idx}'
+            # TODO ugly implementation.
+            # Pass the gt_label to loss function.
+            # Only used by WSLD.
+            loss_module.current_data = data
+            losses[loss_name] = loss_module(s_out, t_out)
+            loss_module.current_data = None
+
     def compute_distill_loss(self, data=None):
         """Compute the distillation loss."""
 
@@ -262,29 +384,6 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
             student_module_name = component['student_module']
             student_outputs = self.student_outputs[student_module_name]
 
-            # Align student output's channels with teacher.
-            align_module_name = f'component_{i}'
-            if align_module_name in self.align_modules:
-                align_module = self.align_modules[align_module_name]
-                if not isinstance(align_module, nn.ModuleList):
-                    student_outputs = [
-                        align_module(s_out) for s_out in student_outputs
-                    ]
-                else:
-                    student_outputs_ = []
-                    if len(align_module) == len(student_outputs):
-                        for module, s_out in zip(align_module, student_outputs):
-                            assert isinstance(s_out, (list, tuple))
-                            s_out = tuple([module(x) for x in s_out])
-                            student_outputs_.append(s_out)
-                    else:
-                        for s_out in student_outputs:
-                            assert isinstance(s_out, (list, tuple))
-                            assert len(s_out) == len(align_module)
-                            s_out = tuple([module(x) for module, x in zip(align_module, s_out)])
-                            student_outputs_.append(s_out)
-                    student_outputs = student_outputs_
-
             # Get the teacher's outputs.
             teacher_module_name = component['teacher_module']
             teacher_outputs = self.get_teacher_outputs(teacher_module_name)
@@ -293,15 +392,16 @@ class SingleTeacherDistiller(BaseDistiller): # TODO: distillation component
             # RetinaNet.
             for out_idx, (s_out, t_out) in enumerate(
                     zip(student_outputs, teacher_outputs)):
-
-                for loss in component.losses:
-                    loss_module = self.losses[loss.name]
-                    loss_name = f'{loss.name}.{out_idx}'
-                    # TODO ugly implementation.
-                    # Pass the gt_label to loss function.
-                    # Only used by WSLD.
-                    loss_module.current_data = data
-                    losses[loss_name] = loss_module(s_out, t_out)
-                    loss_module.current_data = None
-
+                # Already computed by stream_distill_loss.
+                if t_out is None:
+                    continue
+
+                # Align student output's channels with teacher.
+                s_out = self.align_student_output(i, s_out, out_idx,
+                                                  len(student_outputs))
+                self.compute_component_loss(component, out_idx, s_out, t_out,
+                                            losses, data)
+
+        losses.update(self.streamed_losses)
+        self.streamed_losses = dict()
         return losses
@@ -8,20 +8,25 @@ from ..builder import LOSSES
 
 def dice_coeff(inputs):
     # inputs: [B, T, H*W]
-    pred = inputs[:, None, :, :]
-    target = inputs[:, :, None, :]
+    # pairwise dice of the T masks from their [B, T, T] Gram matrix
+    gram = inputs @ inputs.transpose(1, 2)
+    norm = torch.diagonal(gram, dim1=1, dim2=2) + 1e-12  # [B, T]
 
-    mask = pred.new_ones(pred.size(0), target.size(1), pred.size(2))
+    mask = gram.new_ones(gram.size(0), gram.size(1), gram.size(2))
     mask[:, torch.arange(mask.size(1)), torch.arange(mask.size(2))] = 0
 
-    a = torch.sum(pred * target, -1)
-    b = torch.sum(pred * pred, -1) + 1e-12
-    c = torch.sum(target * target, -1) + 1e-12
-    d = (2 * a) / (b + c)
+    d = (2 * gram) / (norm[:, None, :] + norm[:, :, None])
     d = (d * mask).sum() / mask.sum()
     return d
 
 
+def masked_mse(y_s, y_t, mask):
+    """sum over H*W of ((y_s - y_t) * mask_t)**2, [N, T, C], without the [N, T, C, H, W] tensor"""
+    N, C, H, W = y_s.shape
+    diff = (y_s - y_t)**2
+    return diff.view(N, C, H * W) @ (mask**2).view(N, -1, H * W).transpose(1, 2)  # [N, C, T]
+
+
 class MaskModule(nn.Module):
 
     def __init__(self, channels, num_tokens=8, weight_mask=False):
@@ -60,13 +65,15 @@ class MaskModule(nn.Module):
 
     def forward_train(self, x):
         mask = self.forward_mask(x)
-        out = x.unsqueeze(1) * mask.unsqueeze(2)  # [N, T, C, H, W]
-        # probs
+        # sum_t x * mask_t * prob_t == x * sum_t mask_t * prob_t, the token dim is reduced on the
+        # [N, T, H, W] masks and x is multiplied once
         if self.weight_mask:
             mask_probs = self.forward_prob(x)
             #print(mask_probs.detach().flatten(1))
-            out = out * mask_probs
-        out = out.sum(1)
+            weight = (mask * mask_probs.flatten(1)[:, :, None, None]).sum(1, keepdim=True)
+        else:
+            weight = mask.sum(1, keepdim=True)
+        out = x * weight  # [N, C, H, W]
         # loss
         mask_loss = dice_coeff(mask.flatten(2))
         return out, mask_loss
@@ -119,15 +126,8 @@ class MasKDLoss(nn.Module):
                     mask_s = mask_module.forward_mask(y_s)  # [N, T, H, W]
                 mask = mask * mask_s
 
-            # get the masked features
-            masked_y_s = y_s.unsqueeze(1) * \
-                mask.unsqueeze(2)  # [N, n_masks, C, H, W]
-            masked_y_t = y_t.unsqueeze(1) * \
-                mask.unsqueeze(2)  # [N, n_masks, C, H, W]
-
             # masked distillation
-            loss = (masked_y_s - masked_y_t)**2
-            loss = loss.sum((3, 4))  # [N, n_masks, C]
+            loss = masked_mse(y_s, y_t, mask).transpose(1, 2)  # [N, n_masks, C]
             loss = loss / mask.sum((2, 3)).unsqueeze(-1)
             if self.weight_mask:
                 weights = mask_module.forward_prob(y_t).flatten(1)  # [N, T]
@@ -352,3 +352,98 @@ def test_cwd():
     # test algorithm train_step
     losses = algorithm.train_step(mm_inputs, None)
     assert losses['loss'].item() > 0
+
+
+def _build_general_distill(modules_with_student_inputs=None,
+                           **distiller_kwargs):
+    model_cfg = dict(
+        type='mmcls.ImageClassifier',
+        backbone=dict(
+            type='mmcls.ResNet',
+            depth=18,
+            num_stages=4,
+            out_indices=(3, ),
+            style='pytorch'),
+        neck=dict(type='mmcls.GlobalAveragePooling'),
+        head=dict(
+            type='mmcls.LinearClsHead',
+            num_classes=10,
+            in_channels=512,
+            loss=dict(type='mmcls.CrossEntropyLoss', loss_weight=1.0),
+            topk=(1, 5),
+        ))
+
+    distiller_cfg = dict(
+        type='SingleTeacherDistiller',
+        teacher=deepcopy(model_cfg),
+        teacher_trainable=False,
+        components=[
+            dict(
+                student_module='head.fc',
+                teacher_module='head.fc',
+                losses=[
+                    dict(
+                        type='KLDivergence',
+                        name='loss_kd',
+                        tau=1,
+                        loss_weight=1,
+                    )
+                ],
+                modules_with_student_inputs=modules_with_student_inputs),
+        ],
+        **distiller_kwargs)
+
+    algorithm_cfg = ConfigDict(
+        type='GeneralDistill',
+        architecture=dict(type='MMClsArchitecture', model=model_cfg),
+        distiller=distiller_cfg,
+        with_student_loss=False)
+    return ALGORITHMS.build(algorithm_cfg)
+
+
+def test_general_distill_streaming_loss():
+    imgs = torch.randn(4, 3, 32, 32)
+    label = torch.randint(0, 10, (4, ))
+
+    algorithm = _build_general_distill()
+    streaming = _build_general_distill(streaming_loss=True)
+    streaming.load_state_dict(algorithm.state_dict())
+
+    outputs = algorithm.train_step({'img': imgs, 'gt_label': label}, None)
+    streamed = streaming.train_step({'img': imgs, 'gt_label': label}, None)
+
+    # The loss is computed during the teacher forward and equals the one of
+    # compute_distill_loss, the teacher output is dropped right away.
+    assert torch.allclose(outputs['loss'], streamed['loss'])
+    assert streaming.distiller.teacher_outputs['head.fc'] == [None]
+    assert len(streaming.distiller.streamed_losses) == 0
+
+    # The streamed loss is differentiable w.r.t. the student.
+    streamed['loss'].backward()
+    fc = streaming.architecture.model.head.fc
+    assert fc.weight.grad is not None and fc.weight.grad.abs().sum() > 0
+
+
+def test_general_distill_share_inputs():
+    imgs = torch.randn(4, 3, 32, 32)
+    label = torch.randint(0, 10, (4, ))
+
+    for streaming_loss in [False, True]:
+        algorithm = _build_general_distill(
+            modules_with_student_inputs=[
+                dict(
+                    student_module='head.fc',
+                    teacher_module='head.fc',
+                    same_indices=[0],
+                    share_inputs=True)
+            ],
+            streaming_loss=streaming_loss)
+        # The teacher head reads the student's features, with the same
+        # weights both heads output the same logits.
+        algorithm.distiller.teacher.load_state_dict(
+            algorithm.architecture.model.state_dict())
+
+        outputs = algorithm.train_step({'img': imgs, 'gt_label': label},
+                                       None)
+        assert outputs['loss'].item() < 1e-5
+        assert len(algorithm.distiller.student_inputs['head.fc']) == 0
@@ -33,6 +33,19 @@ _C.DATA.INTERPOLATION = 'bicubic'
 _C.DATA.ZIP_MODE = False
 # Cache Data in Memory, could be overwritten by command line argument
 _C.DATA.CACHE_MODE = 'part'
+# Number of threads reading the zip members into the cache
+_C.DATA.CACHE_WORKERS = 16
+# Directory of the persistent shard cache of the zip members (reused after restarts and by any
+# world size), the in-memory cache is built at every start when empty
+_C.DATA.CACHE_DIR = ''
+# Number of shards of the persistent cache, independent of the world size (at least the world size)
+_C.DATA.CACHE_SHARDS = 256
+# Directory of the top-k teacher soft labels of the train crops (main_for_sdakd), disabled when empty
+_C.DATA.SOFT_LABEL_PATH = ''
+# Number of stored crops per train sample, epoch e replays crop e % SOFT_LABEL_VIEWS
+_C.DATA.SOFT_LABEL_VIEWS = 4
+# Number of teacher logits kept per crop
+_C.DATA.SOFT_LABEL_TOPK = 10
 # Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.
 _C.DATA.PIN_MEMORY = True
 # Number of data loading threads
@@ -297,6 +310,8 @@ def update_config(config, args):
         config.DATA.ZIP_MODE = True
     if _check_args('cache_mode'):
         config.DATA.CACHE_MODE = args.cache_mode
+    if _check_args('cache_dir'):
+        config.DATA.CACHE_DIR = args.cache_dir
     if _check_args('pretrained'):
         config.MODEL.PRETRAINED = args.pretrained
     if _check_args('resume'):
@@ -17,6 +17,7 @@ from timm.data import create_transform
 from .cached_image_folder import CachedImageFolder
 from .imagenet22k_dataset import IN22KDATASET
 from .samplers import SubsetRandomSampler
+from .soft_label import SoftLabelDataset, SoftLabelStore, soft_label_transform
 
 try:
     from torchvision.transforms import InterpolationMode
@@ -52,13 +53,24 @@ def build_loader(config):
     num_tasks = dist.get_world_size()
     global_rank = dist.get_rank()
     if config.DATA.ZIP_MODE and config.DATA.CACHE_MODE == 'part':
-        indices = np.arange(dist.get_rank(), len(dataset_train), dist.get_world_size())
+        if hasattr(dataset_train, 'shard_indices'):
+            indices = dataset_train.shard_indices(global_rank, num_tasks)
+        else:
+            indices = np.arange(dist.get_rank(), len(dataset_train), dist.get_world_size())
         sampler_train = SubsetRandomSampler(indices)
     else:
         sampler_train = torch.utils.data.DistributedSampler(
             dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
         )
 
+    if config.DATA.SOFT_LABEL_PATH:
+        # the random resized crop and the flip are replayed from the soft label store
+        store = SoftLabelStore(config.DATA.SOFT_LABEL_PATH, len(dataset_train), config.DATA.SOFT_LABEL_VIEWS,
+                               config.DATA.SOFT_LABEL_TOPK)
+        transform = soft_label_transform(dataset_train.transform)
+        dataset_train = SoftLabelDataset(dataset_train, store, transform, config.DATA.IMG_SIZE,
+                                         _pil_interp(config.DATA.INTERPOLATION))
+
     if config.TEST.SEQUENTIAL:
         sampler_val = torch.utils.data.SequentialSampler(dataset_val)
     else:
@@ -103,7 +115,10 @@ def build_dataset(is_train, config):
             ann_file = prefix + "_map.txt"
             prefix = prefix + ".zip@/"
             dataset = CachedImageFolder(config.DATA.DATA_PATH, ann_file, prefix, transform,
-                                        cache_mode=config.DATA.CACHE_MODE if is_train else 'part')
+                                        cache_mode=config.DATA.CACHE_MODE if is_train else 'part',
+                                        cache_workers=config.DATA.CACHE_WORKERS,
+                                        cache_dir=config.DATA.CACHE_DIR,
+                                        cache_shards=config.DATA.CACHE_SHARDS)
         else:
             root = os.path.join(config.DATA.DATA_PATH, prefix)
             dataset = datasets.ImageFolder(root, transform=transform)
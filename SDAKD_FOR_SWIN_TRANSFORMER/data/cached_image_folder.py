@@ -6,8 +6,11 @@
 # --------------------------------------------------------
 
 import io
+import mmap
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch.distributed as dist
 import torch.utils.data as data
 from PIL import Image
@@ -68,6 +71,72 @@ def make_dataset_with_ann(ann_file, img_prefix, extensions):
     return images
 
 
+class ShardCache(object):
+    """On-disk cache of the raw member bytes of a zip dataset, split into a fixed number of shards.
+
+    Sample i lives in shard i % num_shards whatever the world size, rank r owns the shards
+    k % world_size == r. A shard is written once as shard_<k>.bin plus its offsets in shard_<k>.npy
+    (the .npy is renamed in last and marks the shard complete) and is mmapped by later runs, so a
+    restarted or resumed job, also with another world size, only builds the missing shards.
+    The world size must not exceed num_shards (DATA.CACHE_SHARDS), a rank without shards would have
+    no samples and hang the other ranks.
+    Put cache_dir on /dev/shm for a RAM-backed cache that outlives the training processes.
+    """
+
+    def __init__(self, cache_dir, n_sample, num_shards):
+        self.n_sample = n_sample
+        self.num_shards = num_shards
+        self.cache_dir = os.path.join(cache_dir, f'{n_sample}_{num_shards}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def shard_path(self, k):
+        return os.path.join(self.cache_dir, f'shard_{k}')
+
+    def shard_samples(self, k):
+        return np.arange(k, self.n_sample, self.num_shards)
+
+    def owned_shards(self, rank, world_size):
+        assert world_size <= min(self.num_shards, self.n_sample), \
+            f'{world_size} ranks need at least {world_size} cache shards, got {self.num_shards} ' \
+            f'for {self.n_sample} samples, raise DATA.CACHE_SHARDS'
+        return list(range(rank, self.num_shards, world_size))
+
+    def shard_indices(self, rank, world_size):
+        """the sample indices of rank, padded by repetition to the same length on every rank"""
+        indices = np.concatenate([self.shard_samples(k) for k in self.owned_shards(rank, world_size)])
+        num_samples = max(sum(len(self.shard_samples(k)) for k in self.owned_shards(r, world_size))
+                          for r in range(world_size))
+        if len(indices) < num_samples:
+            indices = np.resize(indices, num_samples)
+        return np.sort(indices)
+
+    def is_complete(self, k):
+        return os.path.exists(self.shard_path(k) + '.npy')
+
+    def build(self, k, read):
+        path = self.shard_path(k)
+        indices = self.shard_samples(k)
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        with open(path + f'.{os.getpid()}.tmp', 'wb') as f:
+            for j, index in enumerate(indices):
+                data = read(index)
+                f.write(data)
+                offsets[j + 1] = offsets[j] + len(data)
+        os.replace(path + f'.{os.getpid()}.tmp', path + '.bin')
+        np.save(path + f'.{os.getpid()}.tmp.npy', offsets)
+        os.replace(path + f'.{os.getpid()}.tmp.npy', path + '.npy')
+
+    def load(self, k):
+        """zero-copy views of the members of shard k, in shard_samples(k) order"""
+        path = self.shard_path(k)
+        offsets = np.load(path + '.npy').tolist()
+        if offsets[-1] == 0:
+            return [memoryview(b'') for _ in range(len(offsets) - 1)]
+        with open(path + '.bin', 'rb') as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return [view[offsets[j]: offsets[j + 1]] for j in range(len(offsets) - 1)]
+
+
 class DatasetFolder(data.Dataset):
     """A generic data loader where the samples are arranged in this way: ::
         root/class_x/xxx.ext
@@ -90,7 +159,7 @@ class DatasetFolder(data.Dataset):
     """
 
     def __init__(self, root, loader, extensions, ann_file='', img_prefix='', transform=None, target_transform=None,
-                 cache_mode="no"):
+                 cache_mode="no", cache_workers=16, cache_dir='', cache_shards=256):
         # image folder mode
         if ann_file == '':
             _, class_to_idx = find_classes(root)
@@ -117,31 +186,87 @@ class DatasetFolder(data.Dataset):
         self.target_transform = target_transform
 
         self.cache_mode = cache_mode
+        self.cache_workers = cache_workers
+        # persistent shard cache, keyed by the annotation file, the in-RAM cache when cache_dir is ''
+        self.cache_dir = os.path.join(cache_dir, os.path.splitext(ann_file)[0]) if cache_dir else ''
+        self.cache_shards = cache_shards
+        self.shard_cache = None
         if self.cache_mode != "no":
             self.init_cache()
 
     def init_cache(self):
         assert self.cache_mode in ["part", "full"]
+        if self.cache_dir:
+            return self.init_shard_cache()
         n_sample = len(self.samples)
         global_rank = dist.get_rank()
         world_size = dist.get_world_size()
 
-        samples_bytes = [None for _ in range(n_sample)]
+        def load_chunk(start):
+            chunk = []
+            for index in range(start, min(start + chunk_size, n_sample)):
+                path, target = self.samples[index]
+                if self.cache_mode == "full" or index % world_size == global_rank:
+                    # stored members are zero-copy views of the mmapped archive
+                    chunk.append((ZipReader.read(path), target))
+                else:
+                    chunk.append((path, target))
+            return chunk
+
+        # zlib and the page faults of the mmap release the GIL, so the chunks are read by a thread pool
+        chunk_size = max(1, min(4096, n_sample // (self.cache_workers * 4) + 1))
+        starts = list(range(0, n_sample, chunk_size))
+        samples_bytes = []
         start_time = time.time()
-        for index in range(n_sample):
-            if index % (n_sample // 10) == 0:
-                t = time.time() - start_time
-                print(f'global_rank {dist.get_rank()} cached {index}/{n_sample} takes {t:.2f}s per block')
-                start_time = time.time()
-            path, target = self.samples[index]
-            if self.cache_mode == "full":
-                samples_bytes[index] = (ZipReader.read(path), target)
-            elif self.cache_mode == "part" and index % world_size == global_rank:
-                samples_bytes[index] = (ZipReader.read(path), target)
-            else:
-                samples_bytes[index] = (path, target)
+        with ThreadPoolExecutor(max_workers=self.cache_workers) as executor:
+            for i, chunk in enumerate(executor.map(load_chunk, starts)):
+                samples_bytes.extend(chunk)
+                if i % max(1, len(starts) // 10) == 0:
+                    t = time.time() - start_time
+                    print(f'global_rank {dist.get_rank()} cached {len(samples_bytes)}/{n_sample} takes {t:.2f}s')
         self.samples = samples_bytes
 
+    def init_shard_cache(self):
+        global_rank = dist.get_rank()
+        world_size = dist.get_world_size()
+        cache = ShardCache(self.cache_dir, len(self.samples), self.cache_shards)
+        self.shard_cache = cache
+
+        def build_missing(shards):
+            missing = [k for k in shards if not cache.is_complete(k)]
+            if len(missing) == 0:
+                return
+            start_time = time.time()
+            read = lambda index: ZipReader.read(self.samples[index][0])
+            with ThreadPoolExecutor(max_workers=self.cache_workers) as executor:
+                list(executor.map(lambda k: cache.build(k, read), missing))
+            t = time.time() - start_time
+            print(f'global_rank {global_rank} built {len(missing)}/{len(shards)} cache shards in {t:.2f}s')
+
+        shards = cache.owned_shards(global_rank, world_size)
+        build_missing(shards)
+        if self.cache_mode == "full":
+            # the shards of the other ranks are only rebuilt here when the cache dir is not shared
+            dist.barrier()
+            shards = list(range(cache.num_shards))
+            build_missing(shards)
+        samples = list(self.samples)
+        for k in shards:
+            for index, view in zip(cache.shard_samples(k).tolist(), cache.load(k)):
+                samples[index] = (view, samples[index][1])
+        self.samples = samples
+
+    def shard_indices(self, rank, world_size):
+        """indices of the "part" cache of rank, the train sampler draws from these"""
+        if self.shard_cache is not None:
+            return self.shard_cache.shard_indices(rank, world_size)
+        return np.arange(rank, len(self.samples), world_size)
+
+    @property
+    def targets(self):
+        """class index of every sample, read without loading any image"""
+        return [target for _, target in self.samples]
+
     def __getitem__(self, index):
         """
         Args:
@@ -177,7 +302,7 @@ IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif']
 
 def pil_loader(path):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
-    if isinstance(path, bytes):
+    if isinstance(path, (bytes, memoryview)):
         img = Image.open(io.BytesIO(path))
     elif is_zip_path(path):
         data = ZipReader.read(path)
@@ -226,11 +351,12 @@ class CachedImageFolder(DatasetFolder):
     """
 
     def __init__(self, root, ann_file='', img_prefix='', transform=None, target_transform=None,
-                 loader=default_img_loader, cache_mode="no"):
+                 loader=default_img_loader, cache_mode="no", cache_workers=16, cache_dir='', cache_shards=256):
         super(CachedImageFolder, self).__init__(root, loader, IMG_EXTENSIONS,
                                                 ann_file=ann_file, img_prefix=img_prefix,
                                                 transform=transform, target_transform=target_transform,
-                                                cache_mode=cache_mode)
+                                                cache_mode=cache_mode, cache_workers=cache_workers,
+                                                cache_dir=cache_dir, cache_shards=cache_shards)
         self.imgs = self.samples
 
     def __getitem__(self, index):
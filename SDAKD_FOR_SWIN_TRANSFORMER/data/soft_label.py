@@ -0,0 +1,287 @@
+# --------------------------------------------------------
+# Swin Transformer
+# Copyright (c) 2021 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ze Liu
+# --------------------------------------------------------
+
+import hashlib
+import json
+import math
+import os
+import random
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data as data
+from torchvision import transforms
+from torchvision.transforms import functional as TF
+from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+from timm.data.mixup import mixup_target
+from timm.data.transforms import RandomResizedCropAndInterpolation
+
+
+class SoftLabelStore(object):
+    """Memory-mapped top-k teacher logits of `views` random crops of every train sample.
+
+    For each (view, sample) it keeps the crop (top, left, height, width, flip), the indices and
+    logits of the top-k classes and the logsumexp of all the logits, so the clean half of a batch
+    is distilled without a teacher forward. `done` marks the filled entries, a partially built
+    store is completed by the next launch. The teacher, image size, interpolation and seed it was
+    built with are kept in a metadata file, a store built with other ones is never reused.
+    """
+
+    def __init__(self, path, num_samples, views, topk):
+        self.path = path
+        self.views = views
+        self.num_samples = num_samples
+        self.topk = topk
+        prefix = os.path.join(path, f'{num_samples}_{views}_{topk}')
+        self.paths = {
+            'crop': prefix + '_crop.npy',
+            'index': prefix + '_index.npy',
+            'logit': prefix + '_logit.npy',
+            'lse': prefix + '_lse.npy',
+            'done': prefix + '_done.npy',
+        }
+        self.meta_path = prefix + '_meta.json'
+        self.shapes = {
+            'crop': ((views, num_samples, 5), np.int32),
+            'index': ((views, num_samples, topk), np.int32),
+            'logit': ((views, num_samples, topk), np.float32),
+            'lse': ((views, num_samples), np.float32),
+            'done': ((views, num_samples), np.uint8),
+        }
+        self.arrays = None  # opened lazily, once per worker
+
+    def exists(self):
+        return all(os.path.exists(p) for p in list(self.paths.values()) + [self.meta_path])
+
+    def create(self, meta):
+        os.makedirs(os.path.dirname(self.paths['done']), exist_ok=True)
+        for key, (shape, dtype) in self.shapes.items():
+            array = np.lib.format.open_memmap(self.paths[key], mode='w+', dtype=dtype, shape=shape)
+            array[:] = 0
+            array.flush()
+            del array
+        # written last, a store without metadata is rebuilt
+        with open(self.meta_path, 'w') as f:
+            json.dump(meta, f, sort_keys=True)
+
+    def check(self, meta):
+        with open(self.meta_path) as f:
+            stored = json.load(f)
+        if stored != meta:
+            raise ValueError(f'soft label store {self.meta_path} was built with {stored}, not {meta}, '
+                             f'remove it or set another DATA.SOFT_LABEL_PATH')
+
+    def open(self, mode='r'):
+        if self.arrays is None:
+            self.arrays = {key: np.load(p, mmap_mode=mode) for key, p in self.paths.items()}
+        return self.arrays
+
+    def write(self, view, indices, crops, index, logit, lse):
+        arrays = self.open('r+')
+        arrays['crop'][view, indices] = crops
+        arrays['index'][view, indices] = index
+        arrays['logit'][view, indices] = logit
+        arrays['lse'][view, indices] = lse
+        arrays['done'][view, indices] = 1
+
+    def flush(self):
+        for array in self.open().values():
+            if hasattr(array, 'flush'):
+                array.flush()
+
+
+def file_fingerprint(path, chunk_size=1 << 24):
+    """sha1 of the content of path"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def soft_label_transform(transform):
+    """The train transform without the random resized crop and the horizontal flip replayed from the
+    store"""
+    transforms_ = transform.transforms
+    assert isinstance(transforms_[0], (RandomResizedCropAndInterpolation, transforms.RandomResizedCrop)), \
+        f'soft labels replay a random resized crop, the train transform starts with {transforms_[0]}'
+    assert not any(isinstance(t, transforms.RandomVerticalFlip) for t in transforms_), \
+        'soft labels do not replay vertical flips'
+    return transforms.Compose([
+        t for t in transforms_
+        if not isinstance(t, (RandomResizedCropAndInterpolation, transforms.RandomResizedCrop,
+                              transforms.RandomHorizontalFlip))
+    ])
+
+
+def sample_crop(width, height, rng, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
+    """RandomResizedCrop.get_params drawn from rng"""
+    area = height * width
+    log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+    for _ in range(10):
+        target_area = area * rng.uniform(*scale)
+        aspect_ratio = math.exp(rng.uniform(*log_ratio))
+        w = int(round(math.sqrt(target_area * aspect_ratio)))
+        h = int(round(math.sqrt(target_area / aspect_ratio)))
+        if 0 < w <= width and 0 < h <= height:
+            return rng.randint(0, height - h), rng.randint(0, width - w), h, w
+    # fallback to central crop
+    in_ratio = width / height
+    if in_ratio < min(ratio):
+        w = width
+        h = int(round(w / min(ratio)))
+    elif in_ratio > max(ratio):
+        h = height
+        w = int(round(h * max(ratio)))
+    else:
+        w = width
+        h = height
+    return (height - h) // 2, (width - w) // 2, h, w
+
+
+class _SoftLabelCrops(data.Dataset):
+    """The crops of one view, drawn from a generator seeded by (seed, view, index) so a
+    restarted build draws the same crops again"""
+
+    def __init__(self, dataset, view, img_size, interpolation, seed=0):
+        self.dataset = dataset
+        self.view = view
+        self.img_size = img_size
+        self.interpolation = interpolation
+        self.seed = seed
+        self.transform = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
+        ])
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        path, _ = self.dataset.samples[index]
+        image = self.dataset.loader(path)
+        rng = random.Random(f'{self.seed}-{self.view}-{index}')
+        top, left, height, width = sample_crop(image.size[0], image.size[1], rng)
+        flip = int(rng.random() < 0.5)
+        image = TF.resized_crop(image, top, left, height, width, [self.img_size, self.img_size],
+                                self.interpolation)
+        if flip:
+            image = TF.hflip(image)
+        return self.transform(image), index, torch.IntTensor([top, left, height, width, flip])
+
+
+class SoftLabelDataset(data.Dataset):
+    """Replay the stored crops of the view of the current epoch.
+
+    Wraps a dataset with `samples` and `loader` (CachedImageFolder / ImageFolder): the random resized
+    crop and the flip of the train transform are read from the store, `transform` is the rest of the
+    train transform, and every item carries the top-k logits of the teacher on that crop.
+    """
+
+    def __init__(self, dataset, store, transform, img_size, interpolation):
+        self.dataset = dataset
+        self.store = store
+        self.transform = transform
+        self.img_size = img_size
+        self.interpolation = interpolation
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        view = self.epoch % self.store.views
+        arrays = self.store.open()
+        path, target = self.dataset.samples[index]
+        image = self.dataset.loader(path)
+        top, left, height, width, flip = arrays['crop'][view, index].tolist()
+        image = TF.resized_crop(image, top, left, height, width, [self.img_size, self.img_size],
+                                self.interpolation)
+        if flip:
+            image = TF.hflip(image)
+        if self.transform is not None:
+            image = self.transform(image)
+        return (image, target,
+                torch.from_numpy(np.array(arrays['index'][view, index])),
+                torch.from_numpy(np.array(arrays['logit'][view, index])),
+                torch.from_numpy(np.array(arrays['lse'][view, index])))
+
+
+@torch.no_grad()
+def build_soft_labels(config, teacher_model, dataset, logger, teacher_fingerprint):
+    """Fill the missing entries of every view of the store of dataset with the teacher outputs,
+    each rank labels its own (cached) part of the samples"""
+    store = SoftLabelStore(dataset.store.path, len(dataset), dataset.store.views, dataset.store.topk)
+    meta = {
+        'teacher': teacher_fingerprint,
+        'img_size': config.DATA.IMG_SIZE,
+        'interpolation': config.DATA.INTERPOLATION,
+        'seed': config.SEED,
+    }
+    if dist.get_rank() == 0 and not store.exists():
+        store.create(meta)
+    dist.barrier()
+    store.check(meta)
+    store.open('r+')
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if hasattr(dataset.dataset, 'shard_indices'):
+        indices = np.unique(dataset.dataset.shard_indices(rank, world_size))
+    else:
+        indices = np.arange(rank, len(dataset), world_size)
+    training = teacher_model.training
+    teacher_model.eval()
+    for view in range(store.views):
+        todo = indices[store.open()['done'][view, indices] == 0]
+        if len(todo) == 0:
+            continue
+        logger.info(f'soft labels of view {view}: {len(todo)} samples on rank {rank}')
+        data_loader = torch.utils.data.DataLoader(
+            _SoftLabelCrops(dataset.dataset, view, dataset.img_size, dataset.interpolation, config.SEED),
+            sampler=todo.tolist(),
+            batch_size=config.DATA.BATCH_SIZE,
+            num_workers=config.DATA.NUM_WORKERS,
+            pin_memory=config.DATA.PIN_MEMORY,
+        )
+        for idx, (images, index, crops) in enumerate(data_loader):
+            images = images.cuda(non_blocking=True)
+            with torch.cuda.amp.autocast(enabled=config.AMP_ENABLE):
+                _, output = teacher_model(images)
+            output = output.float()
+            logit, topk_index = output.topk(store.topk, dim=1)
+            lse = torch.logsumexp(output, dim=1)
+            store.write(view, index.numpy(), crops.numpy(), topk_index.int().cpu().numpy(),
+                        logit.cpu().numpy(), lse.cpu().numpy())
+            if idx % config.PRINT_FREQ == 0:
+                logger.info(f'soft labels of view {view}: [{idx}/{len(data_loader)}]')
+        store.flush()
+    teacher_model.train(training)
+    dist.barrier()
+
+
+def soft_label_prob(topk_index, topk_logit, lse, num_classes):
+    """teacher probabilities from the top-k logits, the mass left spread evenly over the other classes"""
+    topk_prob = (topk_logit.float() - lse.float().unsqueeze(1)).exp()
+    rest = (1. - topk_prob.sum(1, keepdim=True)).clamp(min=0.) / max(num_classes - topk_prob.shape[1], 1)
+    prob = rest.expand(-1, num_classes).contiguous()
+    return prob.scatter_(1, topk_index.long(), topk_prob)
+
+
+def mixup_soft_label(mixup_fn, x, target, prob):
+    """Mixup.__call__ that also mixes the teacher probabilities with the same lam and pairing"""
+    assert len(x) % 2 == 0, 'Batch size should be even when using this'
+    if mixup_fn.mode == 'elem':
+        lam = mixup_fn._mix_elem(x)
+    elif mixup_fn.mode == 'pair':
+        lam = mixup_fn._mix_pair(x)
+    else:
+        lam = mixup_fn._mix_batch(x)
+    target = mixup_target(target, mixup_fn.num_classes, lam, mixup_fn.label_smoothing)
+    prob = prob * lam + prob.flip(0) * (1. - lam)
+    return x, target, prob
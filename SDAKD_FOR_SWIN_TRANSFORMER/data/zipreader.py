@@ -6,7 +6,11 @@
 # --------------------------------------------------------
 
 import os
+import mmap
+import struct
+import threading
 import zipfile
+import zlib
 import io
 import numpy as np
 from PIL import Image
@@ -20,13 +24,98 @@ def is_zip_path(img_or_path):
     return '.zip@' in img_or_path
 
 
+class ZipIndex(object):
+    """Persistent (name -> data offset, compressed size, size, compression) index of a zip archive.
+
+    Built once from the central directory and the local headers, saved as <zip>.index.npz and
+    reused while the archive size and mtime are unchanged.
+    """
+    LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.index_path = zip_path + '.index.npz'
+        stat = os.stat(zip_path)
+        self.key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        names, table = self.load()
+        if names is None:
+            names, table = self.build()
+            self.save(names, table)
+        self.table = table
+        self.lookup = {name: i for i, name in enumerate(names)}
+
+    def build(self):
+        names, rows = [], []
+        with zipfile.ZipFile(self.zip_path, 'r') as zfile, open(self.zip_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for info in zfile.infolist():
+                if info.is_dir():
+                    continue
+                offset = info.header_offset
+                header = self.LOCAL_HEADER.unpack_from(mm, offset)
+                # the local extra field may differ from the central one, so read both lengths here
+                data_offset = offset + self.LOCAL_HEADER.size + header[-2] + header[-1]
+                names.append(str.strip(info.filename, '/'))
+                rows.append((data_offset, info.compress_size, info.file_size, info.compress_type))
+            mm.close()
+        return names, np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return None, None
+        index = np.load(self.index_path)
+        if not np.array_equal(index['key'], self.key):
+            return None, None
+        names = index['names'].tobytes().decode('utf-8').split('\n')
+        return names, index['table']
+
+    def save(self, names, table):
+        tmp_path = self.index_path + '.%d.tmp.npz' % os.getpid()
+        try:
+            np.savez(tmp_path, key=self.key, table=table,
+                     names=np.frombuffer('\n'.join(names).encode('utf-8'), dtype=np.uint8))
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print("can not save the zip index %s: %s" % (self.index_path, e))
+
+    def get(self, name):
+        i = self.lookup.get(name)
+        if i is None:
+            return None
+        return self.table[i].tolist()
+
+
 class ZipReader(object):
     """A class to read zipped files"""
     zip_bank = dict()
+    # mmap and index of each archive, opened once per process (DataLoader workers inherit them)
+    mmap_bank = dict()
+    index_bank = dict()
+    # the cache_workers threads of the cached datasets read at once, the first of them opens the archive
+    bank_lock = threading.Lock()
 
     def __init__(self):
         super(ZipReader, self).__init__()
 
+    @staticmethod
+    def get_mmap(path):
+        mmap_bank = ZipReader.mmap_bank
+        if path not in mmap_bank:
+            with ZipReader.bank_lock:
+                if path not in mmap_bank:
+                    with open(path, 'rb') as f:
+                        mmap_bank[path] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return mmap_bank[path]
+
+    @staticmethod
+    def get_index(path):
+        index_bank = ZipReader.index_bank
+        if path not in index_bank:
+            with ZipReader.bank_lock:
+                if path not in index_bank:
+                    index_bank[path] = ZipIndex(path)
+        return index_bank[path]
+
     @staticmethod
     def get_zipfile(path):
         zip_bank = ZipReader.zip_bank
@@ -84,7 +173,16 @@ class ZipReader(object):
 
     @staticmethod
     def read(path):
+        """return a zero-copy memoryview of the mmap for stored members, bytes otherwise"""
         zip_path, path_img = ZipReader.split_zip_style_path(path)
+        entry = ZipReader.get_index(zip_path).get(path_img)
+        if entry is not None:
+            offset, compress_size, _, compress_type = entry
+            data = ZipReader.get_mmap(zip_path)[offset: offset + compress_size]
+            if compress_type == zipfile.ZIP_STORED:
+                return data
+            if compress_type == zipfile.ZIP_DEFLATED:
+                return zlib.decompress(data, -15)
         zfile = ZipReader.get_zipfile(zip_path)
         data = zfile.read(path_img)
         return data
@@ -92,8 +190,7 @@ class ZipReader(object):
     @staticmethod
     def imread(path):
         zip_path, path_img = ZipReader.split_zip_style_path(path)
-        zfile = ZipReader.get_zipfile(zip_path)
-        data = zfile.read(path_img)
+        data = ZipReader.read(path)
         try:
             im = Image.open(io.BytesIO(data))
         except:
@@ -5,11 +5,16 @@
 # --------------------------------------------------------
 
 import torch
-import swin_window_process
+try:
+    import swin_window_process
+except ImportError:
+    swin_window_process = None
 import random
 import time
 import unittest
 
+from window_process_gather import WindowProcessGather, WindowProcessReverseGather
+
 
 class WindowProcess(torch.autograd.Function):
     @staticmethod
@@ -119,6 +124,7 @@ def copy_one_tensor(input, requires_grad=True):
     input1 = input.clone().detach().requires_grad_(requires_grad).cuda()
     return input1
 
+@unittest.skipIf(swin_window_process is None or not torch.cuda.is_available(), 'fused window process is not installed')
 class Test_WindowProcess(unittest.TestCase):
     def setUp(self):
         self.B = 192
@@ -244,6 +250,101 @@ class Test_WindowProcess(unittest.TestCase):
         self.test_forward_backward_speed(dtype=dtype, times=times)
 
 
+
+class Test_WindowProcessGather(unittest.TestCase):
+    def setUp(self):
+        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.B = 192 if self.device.type == 'cuda' else 16
+        self.H = 56
+        self.W = 56
+        self.C = 96
+        self.shift_size = 2
+        self.window_size = 7
+        self.nH = self.H // self.window_size
+        self.nW = self.W // self.window_size
+
+    def copy_one_tensor(self, input, requires_grad=True):
+        return input.clone().detach().to(self.device).requires_grad_(requires_grad)
+
+    def test_roll_and_window_partition(self, dtype=torch.float32):
+        input = torch.randn((self.B, self.H, self.W, self.C), dtype=dtype)
+        d_loss_tensor = torch.randn((self.B*self.nW*self.nH, self.window_size, self.window_size, self.C), dtype=dtype).to(self.device)
+
+        input1 = self.copy_one_tensor(input, True)
+        input2 = self.copy_one_tensor(input, True)
+
+        # ori
+        expected = pyt_forward(input1, self.shift_size, self.window_size)
+        expected.backward(d_loss_tensor)
+        # index gather
+        gather_output = WindowProcessGather.apply(input2, self.B, self.H, self.W, self.C, -self.shift_size, self.window_size)
+        gather_output.backward(d_loss_tensor)
+
+        self.assertTrue(torch.equal(expected, gather_output))
+        self.assertTrue(torch.equal(input1.grad, input2.grad))
+
+    def test_window_merge_and_roll(self, dtype=torch.float32):
+        input = torch.randn((self.B*self.nH*self.nW, self.window_size, self.window_size, self.C), dtype=dtype)
+        d_loss_tensor = torch.randn((self.B, self.H, self.W, self.C), dtype=dtype).to(self.device)
+
+        input1 = self.copy_one_tensor(input, True)
+        input2 = self.copy_one_tensor(input, True)
+
+        # ori
+        expected = reverse_pyt_forward(input1, self.shift_size, self.window_size, self.H, self.W)
+        expected.backward(d_loss_tensor)
+        # index gather
+        gather_output = WindowProcessReverseGather.apply(input2, self.B, self.H, self.W, self.C, self.shift_size, self.window_size)
+        gather_output.backward(d_loss_tensor)
+
+        self.assertTrue(torch.equal(expected, gather_output))
+        self.assertTrue(torch.equal(input1.grad, input2.grad))
+
+    def test_forward_backward_speed(self, dtype=torch.float32, times=None):
+        times = times or (1000 if self.device.type == 'cuda' else 50)
+        input = torch.randn((self.B*self.nH*self.nW, self.window_size, self.window_size, self.C), dtype=dtype)
+        d_loss_tensor = torch.randn((self.B, self.H, self.W, self.C), dtype=dtype).to(self.device)
+
+        input1 = self.copy_one_tensor(input, True)
+        input2 = self.copy_one_tensor(input, True)
+
+        def synchronize():
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        # SwinTransformer official
+        def run_pyt(t=1000):
+            for _ in range(t):
+                expected = reverse_pyt_forward(input1, self.shift_size, self.window_size, self.H, self.W)
+                expected.backward(d_loss_tensor)
+
+        # index gather
+        def run_gather(t=1000):
+            for _ in range(t):
+                gather_output = WindowProcessReverseGather.apply(input2, self.B, self.H, self.W, self.C, self.shift_size, self.window_size)
+                gather_output.backward(d_loss_tensor)
+
+        run_gather(t=1)
+        synchronize()
+        t1 = time.time()
+        run_pyt(t=times)
+        synchronize()
+        t2 = time.time()
+        run_gather(t=times)
+        synchronize()
+        t3 = time.time()
+
+        print('Run {} times on {}'.format(times, self.device))
+        print('Original time cost: {}'.format(t2 - t1))
+        print('Index gather time cost: {}'.format(t3 - t2))
+
+    def test_roll_and_window_partition_fp16(self, dtype=torch.float16):
+        self.test_roll_and_window_partition(dtype=dtype)
+
+    def test_window_merge_and_roll_fp16(self, dtype=torch.float16):
+        self.test_window_merge_and_roll(dtype=dtype)
+
+
 if __name__ == '__main__':
     print('Pass only two tensors are exactly the same (using torch.equal).\n')
     torch.manual_seed(0)
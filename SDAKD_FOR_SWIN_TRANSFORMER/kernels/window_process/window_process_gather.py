@@ -0,0 +1,80 @@
+# --------------------------------------------------------
+# Portable window process for SwinTransformer
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import torch
+
+_GATHER_INDEX = {}
+
+
+def window_gather_index(H, W, shift_size, window_size, device):
+    """
+    Flat (H*W) index of roll(shifts=(shift_size, shift_size)) + window_partition, cached per
+    (H, W, shift_size, window_size, device). windows[j] = x.view(B, H*W, C)[:, index[j]].
+    """
+    key = (H, W, shift_size, window_size, str(device))
+    index = _GATHER_INDEX.get(key)
+    if index is None:
+        index = torch.arange(H * W).view(H, W)
+        if shift_size != 0:
+            index = torch.roll(index, shifts=(shift_size, shift_size), dims=(0, 1))
+        index = index.view(H // window_size, window_size, W // window_size, window_size)
+        index = index.permute(0, 2, 1, 3).reshape(-1).to(device)
+        _GATHER_INDEX[key] = index
+    return index
+
+
+def _partition(input, B, H, W, C, shift_size, window_size):
+    index = window_gather_index(H, W, shift_size, window_size, input.device)
+    output = input.reshape(B, H * W, C).index_select(1, index)
+    return output.view(-1, window_size, window_size, C)
+
+
+def _merge(input, B, H, W, C, shift_size, window_size):
+    # window_merge_and_roll with shift_size undoes roll_and_window_partition with -shift_size
+    index = window_gather_index(H, W, -shift_size, window_size, input.device)
+    output = input.new_empty(B, H * W, C).index_copy_(1, index, input.reshape(B, H * W, C))
+    return output.view(B, H, W, C)
+
+
+class WindowProcessGather(torch.autograd.Function):
+    """WindowProcess as one index_select, the gradient is the matching index_copy"""
+
+    @staticmethod
+    def forward(ctx, input, B, H, W, C, shift_size, window_size):
+        output = _partition(input, B, H, W, C, shift_size, window_size)
+
+        ctx.B = B
+        ctx.H = H
+        ctx.W = W
+        ctx.C = C
+        ctx.shift_size = shift_size
+        ctx.window_size = window_size
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_in):
+        grad_out = _merge(grad_in, ctx.B, ctx.H, ctx.W, ctx.C, -ctx.shift_size, ctx.window_size)
+        return grad_out, None, None, None, None, None, None
+
+
+class WindowProcessReverseGather(torch.autograd.Function):
+    """WindowProcessReverse as one index_copy, the gradient is the matching index_select"""
+
+    @staticmethod
+    def forward(ctx, input, B, H, W, C, shift_size, window_size):
+        output = _merge(input, B, H, W, C, shift_size, window_size)
+
+        ctx.B = B
+        ctx.H = H
+        ctx.W = W
+        ctx.C = C
+        ctx.shift_size = shift_size
+        ctx.window_size = window_size
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_in):
+        grad_out = _partition(grad_in, ctx.B, ctx.H, ctx.W, ctx.C, -ctx.shift_size, ctx.window_size)
+        return grad_out, None, None, None, None, None, None
@@ -26,6 +26,7 @@ from torch.fx import symbolic_trace
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
 from timm.utils import accuracy, AverageMeter
 
+from SDAKD_FOR_BASELINE.datas.ConvertorSampler import ConvertorSubsetSampler
 from SDAKD_FOR_BASELINE.datas.SDAGAN import SDAGenerator
 from SDAKD_FOR_BASELINE.models.swin_transformer import swin_transformer_large
 from SDAKD_FOR_BASELINE.utils.load_model import load_model_from_url
@@ -33,6 +34,7 @@ from SDAKD_FOR_BASELINE.utils.load_model import load_model_from_url
 from config import get_config
 from models import build_model
 from data import build_loader
+from data.soft_label import build_soft_labels, file_fingerprint, soft_label_prob, mixup_soft_label
 from lr_scheduler import build_scheduler
 from optimizer import build_optimizer
 from logger import create_logger
@@ -59,6 +61,8 @@ def parse_option():
                         help='no: no cache, '
                              'full: cache all data, '
                              'part: sharding the dataset into nonoverlapping pieces and only cache one piece')
+    parser.add_argument('--cache-dir', type=str,
+                        help='directory of the persistent shard cache, reused across restarts and world sizes')
     parser.add_argument('--pretrained',
                         help='pretrained weight from checkpoint, could be imagenet22k pretrained weight')
     parser.add_argument('--resume', help='resume from checkpoint')
@@ -92,7 +96,7 @@ def parse_option():
     return args, config
 
 
-def KDLoss(student_output, teacher_output, targets=None, temperature=4):
+def KDLoss(student_output, teacher_output, targets=None, temperature=4, teacher_prob=None):
     global config
     if config.AUG.MIXUP > 0.:
         # smoothing is handled with mixup label transform
@@ -103,9 +107,15 @@ def KDLoss(student_output, teacher_output, targets=None, temperature=4):
         criterion = torch.nn.CrossEntropyLoss()
 
     import torch.nn.functional as F
+    if teacher_prob is not None:
+        # teacher_prob ** (1 / T) renormalised is softmax(teacher_output / T)
+        teacher_prob = teacher_prob.pow(1. / temperature)
+        teacher_prob = teacher_prob / teacher_prob.sum(dim=1, keepdim=True)
+    else:
+        teacher_prob = torch.softmax(teacher_output / temperature, dim=1)
     soft_loss = F.kl_div(
         torch.log_softmax(student_output / temperature, dim=1),
-        torch.softmax(teacher_output / temperature, dim=1),
+        teacher_prob,
         reduction="batchmean",
     )
     hard_loss = (
@@ -147,6 +157,31 @@ def main(config):
     )
     model_without_ddp = [model, sda]
     teacher_model.requires_grad_(False)
+    if config.DATA.SOFT_LABEL_PATH:
+        build_soft_labels(config, teacher_model, dataset_train, logger,
+                          file_fingerprint(os.path.join(sda_yaml["local_ckpt_path"], sda_yaml["tcheckpoint"])))
+    # the convertor epochs iterate a random or class-balanced coreset of the training set
+    convertor_sampler = None
+    data_loader_convertor = data_loader_train
+    if "convertor_subset" in sda_yaml["SDA"]:
+        subset_yaml = sda_yaml["SDA"]["convertor_subset"]
+        subset_kwargs = {}
+        if config.DATA.ZIP_MODE and config.DATA.CACHE_MODE == 'part':
+            # every rank draws its coreset from its own cached part, as the train sampler does
+            indices = dataset_train.dataset.shard_indices(dist.get_rank(), dist.get_world_size()) \
+                if hasattr(dataset_train, 'dataset') else \
+                dataset_train.shard_indices(dist.get_rank(), dist.get_world_size())
+            subset_kwargs = dict(indices=indices, num_replicas=1, rank=0)
+        convertor_sampler = ConvertorSubsetSampler(dataset_train, ratio=subset_yaml["ratio"], mode=subset_yaml["mode"],
+                                                   seed=subset_yaml["seed"] if "seed" in subset_yaml else 0,
+                                                   **subset_kwargs)
+        data_loader_convertor = torch.utils.data.DataLoader(
+            dataset_train, sampler=convertor_sampler,
+            batch_size=config.DATA.BATCH_SIZE,
+            num_workers=config.DATA.NUM_WORKERS,
+            pin_memory=config.DATA.PIN_MEMORY,
+            drop_last=True,
+        )
     # TODO: END
 
     optimizer = build_optimizer(config, model)
@@ -192,10 +227,16 @@ def main(config):
     start_time = time.time()
     for epoch in range(config.TRAIN.START_EPOCH, config.TRAIN.EPOCHS):
         data_loader_train.sampler.set_epoch(epoch)
+        if hasattr(dataset_train, 'set_epoch'):
+            dataset_train.set_epoch(epoch)
         # TODO: CONVERTOR TRAIN
         if epoch in sda_yaml["SDA"]["convertor_training_epoch"]:
-            sda.quick_multi_epoch(dataloader=data_loader_train, student_model=model, teacher_model=teacher_model,
-                                  epoch_number=sda_yaml["SDA"]["convertor_epoch_number"], mixup_fn=mixup_fn)
+            convertor_epoch_number = sda_yaml["SDA"]["convertor_epoch_number"]
+            # a new coreset for every convertor pass
+            sampler_epoch = epoch * convertor_epoch_number if convertor_sampler is not None else None
+            sda.quick_multi_epoch(dataloader=data_loader_convertor, student_model=model, teacher_model=teacher_model,
+                                  epoch_number=convertor_epoch_number, mixup_fn=mixup_fn,
+                                  sampler_epoch=sampler_epoch)
 
         train_one_epoch(config, model, teacher_model, sda, data_loader_train, optimizer, epoch, mixup_fn, lr_scheduler,
                         loss_scaler)
@@ -226,20 +267,32 @@ def train_one_epoch(config, model, teacher_model, sda, data_loader, optimizer, e
 
     start = time.time()
     end = time.time()
-    for idx, (samples, targets) in enumerate(data_loader):
+    for idx, (samples, targets, *soft_label) in enumerate(data_loader):
         samples = samples.cuda(non_blocking=True)
         targets = targets.cuda(non_blocking=True)
         samples_aug, targets_aug,_,_ = sda(model, teacher_model, samples, targets, False, False)
+        teacher_output, teacher_prob = None, None
+        if len(soft_label) > 0:
+            # the clean half is labelled by the soft label store, only the SDA half runs the teacher
+            soft_label = [t.cuda(non_blocking=True) for t in soft_label]
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=config.AMP_ENABLE):
+                _, teacher_output = teacher_model(samples_aug)
+            teacher_prob = torch.cat([soft_label_prob(*soft_label, config.MODEL.NUM_CLASSES),
+                                      torch.softmax(teacher_output.float(), dim=1)])
         samples = torch.cat([samples, samples_aug])
         targets = torch.cat([targets, targets_aug])
         if mixup_fn is not None:
-            samples, targets = mixup_fn(samples, targets)
+            if teacher_prob is not None:
+                samples, targets, teacher_prob = mixup_soft_label(mixup_fn, samples, targets, teacher_prob)
+            else:
+                samples, targets = mixup_fn(samples, targets)
 
         with torch.cuda.amp.autocast(enabled=config.AMP_ENABLE):
             outputs = model(samples)
-            with torch.no_grad():
-                _, teacher_output = teacher_model(samples)
-        loss = KDLoss(outputs, teacher_output, targets, 1)
+            if teacher_prob is None:
+                with torch.no_grad():
+                    _, teacher_output = teacher_model(samples)
+        loss = KDLoss(outputs, teacher_output, targets, 1, teacher_prob)
         loss = loss / config.TRAIN.ACCUMULATION_STEPS
 
         # this attribute is added by timm on one optimizer (adahessian)